@@ -0,0 +1,173 @@
+"""
+MFCC feature extraction for the audio emotion model.
+
+Compared with running ``torchaudio.functional.resample`` + MFCC on the full clip:
+- resampling kernels are built once per source sample rate and kept in a small
+  LRU cache (``EMOTION_RESAMPLER_CACHE_SIZE``). Source rates are checked first:
+  ``T.Resample`` builds a kernel of roughly ``(16000 / g) * (sr / g)`` taps with
+  ``g = gcd(sr, 16000)``, so an odd rate like 44101 Hz would need gigabytes.
+  Every standard rate (8 kHz to 192 kHz) passes ``check_sample_rate``;
+- channels are downmixed to mono *before* resampling and MFCC;
+- the waveform is truncated to the samples needed for ``max_len`` frames first,
+  so long uploads don't pay for frames that get thrown away;
+- ``batch_mfcc`` computes features for many clips in one transform call.
+"""
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+import torchaudio.transforms as T
+
+TARGET_SR = 16000
+N_FFT = 400
+HOP_LENGTH = 160
+N_MELS = 128
+N_MFCC = 128
+MAX_LEN = 200
+
+mfcc_transform = T.MFCC(
+    sample_rate=TARGET_SR,
+    n_mfcc=N_MFCC,
+    melkwargs={"n_fft": N_FFT, "hop_length": HOP_LENGTH, "n_mels": N_MELS}
+)
+
+MIN_SAMPLE_RATE = 4000
+MAX_SAMPLE_RATE = 192000
+# ต้นทาง/ปลายทางหลังหารด้วย gcd ต้องไม่เกินค่านี้ (44.1 kHz -> 16 kHz = 441/160)
+MAX_RESAMPLE_TERMS = 1000
+RESAMPLER_CACHE_SIZE = int(os.environ.get("EMOTION_RESAMPLER_CACHE_SIZE", "8"))
+
+_resamplers = OrderedDict()
+_resamplers_lock = threading.Lock()
+
+
+class UnsupportedSampleRate(ValueError):
+    """sample rate อยู่นอกช่วงหรือทำให้ kernel ของ resampler ใหญ่เกินไป"""
+
+
+def check_sample_rate(sr):
+    """คืน sample rate เป็น int ถ้ารองรับ ไม่เช่นนั้น raise UnsupportedSampleRate"""
+    try:
+        rate = int(sr)
+    except (TypeError, ValueError):
+        raise UnsupportedSampleRate(f"Invalid sample rate {sr!r}") from None
+    if rate != sr or not MIN_SAMPLE_RATE <= rate <= MAX_SAMPLE_RATE:
+        raise UnsupportedSampleRate(
+            f"Unsupported sample rate {sr}: expected an integer in [{MIN_SAMPLE_RATE}, {MAX_SAMPLE_RATE}] Hz"
+        )
+    g = math.gcd(rate, TARGET_SR)
+    if rate // g > MAX_RESAMPLE_TERMS or TARGET_SR // g > MAX_RESAMPLE_TERMS:
+        raise UnsupportedSampleRate(f"Unsupported sample rate {rate} Hz: use a standard rate such as 44100 or 48000")
+    return rate
+
+
+def get_resampler(orig_sr):
+    """คืน T.Resample(orig_sr -> 16000) ที่สร้าง kernel ไว้แล้ว (LRU ตาม sample rate ต้นทาง)"""
+    orig_sr = check_sample_rate(orig_sr)
+    with _resamplers_lock:
+        resampler = _resamplers.get(orig_sr)
+        if resampler is not None:
+            _resamplers.move_to_end(orig_sr)
+            return resampler
+    # สร้าง kernel นอก lock: rate อื่นที่แคชไว้แล้วไม่ต้องรอ
+    resampler = T.Resample(orig_sr, TARGET_SR)
+    with _resamplers_lock:
+        resampler = _resamplers.setdefault(orig_sr, resampler)
+        _resamplers.move_to_end(orig_sr)
+        while len(_resamplers) > max(1, RESAMPLER_CACHE_SIZE):
+            _resamplers.popitem(last=False)
+    return resampler
+
+
+def cached_sample_rates():
+    with _resamplers_lock:
+        return sorted(_resamplers)
+
+
+def samples_needed(max_len=MAX_LEN):
+    """
+    จำนวน sample (ที่ 16 kHz) ที่พอสำหรับ MFCC ``max_len`` เฟรมแรก
+    (center=True: เฟรม t ครอบคลุม [t*hop - n_fft/2, t*hop + n_fft/2))
+    """
+    return (max_len - 1) * HOP_LENGTH + N_FFT // 2 + 1
+
+
+def to_mono(waveform):
+    if waveform.dim() == 1:
+        return waveform
+    if waveform.shape[0] == 1:
+        return waveform[0]
+    return waveform.mean(dim=0)
+
+
+def prepare_waveform(waveform, sr, max_len=MAX_LEN):
+    """downmix -> ตัดความยาว -> resample เป็น 16 kHz คืน tensor 1 มิติ"""
+    mono = to_mono(waveform)
+    if mono.dtype != torch.float32:
+        mono = mono.float()
+    need = samples_needed(max_len) if max_len else None
+    if sr != TARGET_SR:
+        if need is not None:
+            # เผื่อ sample ต้นทางไว้ ~20ms สำหรับความกว้างของ filter ตอน resample
+            src_need = int(math.ceil(need * sr / TARGET_SR)) + max(64, int(sr) // 50)
+            mono = mono[:src_need]
+        mono = get_resampler(sr)(mono)
+    if need is not None:
+        mono = mono[:need]
+    return mono
+
+
+def fit_frames(mfcc, max_len):
+    if mfcc.shape[-1] < max_len:
+        return nn.functional.pad(mfcc, (0, max_len - mfcc.shape[-1]))
+    return mfcc[..., :max_len]
+
+
+def mel_to_mfcc(mel):
+    """
+    mel [n_mels, T] ของคลิปเดียว -> MFCC [n_mfcc, T] (เหมือน T.MFCC.forward)
+    top_db ของ AmplitudeToDB อ้างอิงค่าสูงสุดของคลิปนี้เท่านั้น จึงต้องทำทีละคลิปแม้ใน batch
+    """
+    db = mfcc_transform.amplitude_to_DB(mel)
+    return torch.matmul(db.transpose(-1, -2), mfcc_transform.dct_mat).transpose(-1, -2)
+
+
+def mfcc_features(waveform, sr, max_len=MAX_LEN):
+    """คืน MFCC shape [1, 3, n_mfcc, max_len] สำหรับ ResNet18 (3 แชนเนลซ้ำกัน)"""
+    x = prepare_waveform(waveform, sr, max_len)
+    mel = mfcc_transform.MelSpectrogram(x)[:, :max_len]
+    mfcc = fit_frames(mel_to_mfcc(mel), max_len)
+    return mfcc.unsqueeze(0).expand(3, -1, -1).unsqueeze(0)
+
+
+def batch_mfcc(clips, max_len=MAX_LEN):
+    """
+    MFCC ของหลายคลิป โดยรวม STFT + mel filterbank เป็นการเรียกครั้งเดียว
+    ``clips`` เป็น list ของ (waveform, sr) คืน tensor [B, 3, n_mfcc, max_len]
+    ที่ให้ผลเท่ากับเรียก ``mfcc_features`` ทีละคลิป
+    """
+    if len(clips) == 0:
+        return torch.empty(0, 3, N_MFCC, max_len)
+    prepared = [prepare_waveform(w, sr, max_len) for w, sr in clips]
+    pad = N_FFT // 2
+    # ต่อท้ายแต่ละคลิปด้วย reflect padding ของตัวเอง ก่อนเติมศูนย์ให้ยาวเท่ากัน
+    # เฟรมที่อยู่ในช่วงคลิปจึงเห็น sample ชุดเดียวกับตอนคำนวณแยกทีละคลิป
+    extended = []
+    for x in prepared:
+        if x.numel() > pad:
+            x = nn.functional.pad(x.view(1, 1, -1), (0, pad), mode="reflect").view(-1)
+        extended.append(x)
+    length = max(x.numel() for x in extended)
+    padded = torch.zeros(len(extended), length)
+    for i, x in enumerate(extended):
+        padded[i, :x.numel()] = x
+
+    mel = mfcc_transform.MelSpectrogram(padded)  # [B, n_mels, T]
+    out = torch.zeros(len(prepared), N_MFCC, max_len)
+    for i, x in enumerate(prepared):
+        frames = min(max_len, x.numel() // HOP_LENGTH + 1, mel.shape[-1])
+        out[i, :, :frames] = mel_to_mfcc(mel[i, :, :frames])
+    return out.unsqueeze(1).expand(-1, 3, -1, -1)
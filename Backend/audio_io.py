@@ -0,0 +1,222 @@
+"""
+In-memory audio decoding for uploaded bytes (no temp-file round trip).
+
+Decode order:
+1. PCM / IEEE-float WAV fast path: parse the RIFF header ourselves and wrap the
+   sample buffer with ``np.frombuffer`` (zero copy; int formats only pay for the
+   float conversion that torchaudio.load would also do).
+2. ``soundfile`` on a BytesIO (WAV/FLAC/OGG and friends), if installed.
+3. ``torchaudio.load`` on a BytesIO.
+4. Temp file + ``torchaudio.load`` for formats that genuinely need a path (e.g. mp3/m4a via ffmpeg).
+
+All paths return ``(waveform, sr)`` with waveform a float32 tensor shaped
+``[channels, samples]`` in [-1, 1], the same contract as ``torchaudio.load``.
+"""
+import io
+import os
+import struct
+import tempfile
+import threading
+import warnings
+
+import numpy as np
+import torch
+
+try:
+    from .audio_features import check_sample_rate, UnsupportedSampleRate
+except ImportError:
+    try:
+        from Backend.audio_features import check_sample_rate, UnsupportedSampleRate
+    except ImportError:
+        from audio_features import check_sample_rate, UnsupportedSampleRate
+
+try:
+    import soundfile as sf
+except ImportError:  # optional dependency
+    sf = None
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+_stats_lock = threading.Lock()
+_path_counts = {"wav_fast": 0, "soundfile": 0, "torchaudio_buffer": 0, "temp_file": 0}
+
+
+class AudioDecodeError(ValueError):
+    """ไฟล์เสียงเสียหายหรือไม่รองรับ"""
+
+
+def _count(path):
+    with _stats_lock:
+        _path_counts[path] += 1
+
+
+def decode_stats():
+    with _stats_lock:
+        return dict(_path_counts)
+
+
+def _from_numpy(arr):
+    # np.frombuffer บน bytes เป็น read-only; เราไม่เขียนทับบัฟเฟอร์ จึงปิด warning ของ torch
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(arr)
+
+
+def parse_wav_header(data):
+    """
+    อ่าน header ของ RIFF/WAVE คืน dict (format, channels, sr, bits, data_offset, data_size,
+    declared_size) หรือ None หากไม่ใช่ WAV ที่ fast path รองรับ
+    ใช้กับ bytes แค่ส่วนต้นไฟล์ได้ (data_size จะเป็นเท่าที่มีอยู่ใน ``data``)
+    """
+    if len(data) < 12 or data[0:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    pos = 12
+    fmt = None
+    n = len(data)
+    while pos + 8 <= n:
+        chunk_id = data[pos:pos + 4]
+        chunk_size = struct.unpack_from("<I", data, pos + 4)[0]
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            if chunk_size < 16 or body + 16 > n:
+                return None
+            audio_format, channels, sr, _, _, bits = struct.unpack_from("<HHIIHH", data, body)
+            if audio_format == _WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40 and body + 26 <= n:
+                # SubFormat GUID เริ่มด้วยรหัส format จริง 2 ไบต์
+                audio_format = struct.unpack_from("<H", data, body + 24)[0]
+            fmt = (audio_format, channels, sr, bits)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            # บาง encoder เขียน data size เป็น 0/0xFFFFFFFF ตอนสตรีม ให้ใช้ถึงท้ายไฟล์
+            size = chunk_size if chunk_size and body + chunk_size <= n else n - body
+            audio_format, channels, sr, bits = fmt
+            return {
+                "format": audio_format,
+                "channels": channels,
+                "sr": sr,
+                "bits": bits,
+                "data_offset": body,
+                "data_size": size,
+                "declared_size": chunk_size,
+            }
+        pos = body + chunk_size + (chunk_size & 1)  # chunks are word aligned
+    return None
+
+
+def _decode_wav_fast(data):
+    info = parse_wav_header(data)
+    if info is None or info["channels"] < 1 or info["sr"] <= 0:
+        return None
+    fmt, bits, channels = info["format"], info["bits"], info["channels"]
+    frame_bytes = channels * bits // 8
+    if frame_bytes == 0:
+        return None
+    frames = info["data_size"] // frame_bytes
+    offset = info["data_offset"]
+    count = frames * channels
+
+    if fmt == _WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+        dtype = np.float32 if bits == 32 else np.float64
+        samples = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        if dtype is np.float64:
+            samples = samples.astype(np.float32)
+    elif fmt == _WAVE_FORMAT_PCM and bits == 16:
+        raw = np.frombuffer(data, dtype="<i2", count=count, offset=offset)
+        samples = np.multiply(raw, 1.0 / 32768.0, dtype=np.float32)
+    elif fmt == _WAVE_FORMAT_PCM and bits == 32:
+        raw = np.frombuffer(data, dtype="<i4", count=count, offset=offset)
+        samples = np.multiply(raw, 1.0 / 2147483648.0, dtype=np.float32)
+    elif fmt == _WAVE_FORMAT_PCM and bits == 8:
+        raw = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset)
+        samples = np.subtract(raw, 128, dtype=np.float32)
+        samples *= 1.0 / 128.0
+    elif fmt == _WAVE_FORMAT_PCM and bits == 24:
+        raw = np.frombuffer(data, dtype=np.uint8, count=count * 3, offset=offset).reshape(-1, 3)
+        as_int = (
+            raw[:, 0].astype(np.int32)
+            | (raw[:, 1].astype(np.int32) << 8)
+            | (raw[:, 2].astype(np.int8).astype(np.int32) << 16)
+        )
+        samples = np.multiply(as_int, 1.0 / 8388608.0, dtype=np.float32)
+    else:
+        return None
+
+    # interleaved (frames, channels) -> view แบบ [channels, frames] ไม่ต้อง copy
+    waveform = _from_numpy(samples.reshape(frames, channels).T)
+    return waveform, int(info["sr"])
+
+
+def _decode_soundfile(data):
+    arr, sr = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    return torch.from_numpy(arr.T), int(sr)
+
+
+def _decode_torchaudio_buffer(data, suffix):
+    import torchaudio
+    fmt = suffix.lstrip(".").lower() if suffix else None
+    return torchaudio.load(io.BytesIO(data), format=fmt or None)
+
+
+def _decode_temp_file(data, suffix):
+    import torchaudio
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix or ".bin")
+    try:
+        tmp.write(data)
+        tmp.close()
+        return torchaudio.load(tmp.name)
+    finally:
+        try:
+            os.unlink(tmp.name)
+        except Exception:
+            pass
+
+
+def decode_audio_bytes(data, filename=None):
+    """
+    ถอดรหัสไฟล์เสียงจาก bytes ในหน่วยความจำ คืน (waveform[C, N] float32, sample_rate)
+    ใช้ไฟล์ชั่วคราวเฉพาะเมื่อ format นั้นต้องการจริงๆ; sample rate ที่ resample ไม่ได้จะเป็น AudioDecodeError
+    """
+    waveform, sr = _decode_any(data, filename)
+    try:
+        return waveform, check_sample_rate(sr)
+    except UnsupportedSampleRate as e:
+        raise AudioDecodeError(str(e)) from None
+
+
+def _decode_any(data, filename):
+    if not data:
+        raise AudioDecodeError("Empty audio data")
+    suffix = os.path.splitext(filename or "")[1].lower()
+
+    try:
+        result = _decode_wav_fast(data)
+    except (struct.error, ValueError):
+        result = None
+    if result is not None:
+        _count("wav_fast")
+        return result
+
+    errors = []
+    if sf is not None:
+        try:
+            result = _decode_soundfile(data)
+            _count("soundfile")
+            return result
+        except Exception as e:
+            errors.append(f"soundfile: {e}")
+    try:
+        result = _decode_torchaudio_buffer(data, suffix)
+        _count("torchaudio_buffer")
+        return result
+    except Exception as e:
+        errors.append(f"torchaudio(buffer): {e}")
+    try:
+        result = _decode_temp_file(data, suffix or ".wav")
+        _count("temp_file")
+        return result
+    except Exception as e:
+        errors.append(f"torchaudio(file): {e}")
+    raise AudioDecodeError("Could not decode audio: " + "; ".join(errors))
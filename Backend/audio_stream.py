@@ -0,0 +1,235 @@
+"""
+Streaming audio emotion analysis with incremental MFCC.
+
+PCM chunks are consumed as they arrive: they are resampled to 16 kHz with a
+block-aligned streaming resampler (bit-for-bit the same output as resampling
+the whole signal), and only the *new* STFT frames are computed each time; the
+``n_fft - hop`` overlap is carried over instead of recomputing from scratch.
+Mel frames are kept in a ring slightly larger than one window and one emotion
+is emitted per window every ``hop_frames`` frames, so memory stays bounded no
+matter how long the recording is.
+
+Framing is streaming-style (``center=False``): frame ``t`` covers samples
+``[t*hop, t*hop + n_fft)`` instead of being centred on ``t*hop``.
+"""
+import math
+import os
+from collections import deque
+
+import numpy as np
+import torch
+
+try:
+    from .audio_features import (
+        TARGET_SR, N_FFT, HOP_LENGTH, MAX_LEN, mfcc_transform, get_resampler, fit_frames, mel_to_mfcc,
+        check_sample_rate,
+    )
+except ImportError:
+    try:
+        from Backend.audio_features import (
+            TARGET_SR, N_FFT, HOP_LENGTH, MAX_LEN, mfcc_transform, get_resampler, fit_frames, mel_to_mfcc,
+            check_sample_rate,
+        )
+    except ImportError:
+        from audio_features import (
+            TARGET_SR, N_FFT, HOP_LENGTH, MAX_LEN, mfcc_transform, get_resampler, fit_frames, mel_to_mfcc,
+            check_sample_rate,
+        )
+
+# ระยะเลื่อนหน้าต่างเริ่มต้น 0.5 วินาที (50 เฟรม ที่ hop 10ms)
+STREAM_HOP_FRAMES = int(os.environ.get("EMOTION_AUDIO_STREAM_HOP_FRAMES", "50"))
+
+PCM_FORMATS = {"s16le": ("<i2", 1.0 / 32768.0), "s32le": ("<i4", 1.0 / 2147483648.0), "f32le": ("<f4", None)}
+
+# (WAVE format tag, bits) -> PCM format ที่ PcmDecoder อ่านได้แบบสตรีม
+_WAV_STREAM_FORMATS = {(1, 16): "s16le", (1, 32): "s32le", (3, 32): "f32le"}
+
+
+def wav_stream_format(info):
+    """คืนชื่อ PCM format สำหรับ header จาก ``parse_wav_header`` หรือ None ถ้าสตรีมไม่ได้"""
+    if info is None:
+        return None
+    return _WAV_STREAM_FORMATS.get((info["format"], info["bits"]))
+
+
+class PcmDecoder:
+    """แปลง bytes ของ PCM แบบ interleaved เป็น mono float32 (เก็บเศษไบต์ไว้รอ chunk ถัดไป)"""
+
+    def __init__(self, fmt="s16le", channels=1):
+        if fmt not in PCM_FORMATS:
+            raise ValueError(f"Unsupported PCM format '{fmt}', expected one of {sorted(PCM_FORMATS)}")
+        self.dtype, self.scale = PCM_FORMATS[fmt]
+        self.channels = max(1, int(channels))
+        self._frame_bytes = np.dtype(self.dtype).itemsize * self.channels
+        self._rest = b""
+
+    def decode(self, data):
+        if self._rest:
+            data = self._rest + data
+        usable = len(data) - len(data) % self._frame_bytes
+        self._rest = data[usable:]
+        if usable == 0:
+            return torch.zeros(0)
+        raw = np.frombuffer(data, dtype=self.dtype, count=usable // np.dtype(self.dtype).itemsize)
+        if self.scale is None:
+            samples = raw.astype(np.float32)
+        else:
+            samples = np.multiply(raw, self.scale, dtype=np.float32)
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        return torch.from_numpy(samples)
+
+
+class StreamingResampler:
+    """
+    Resample เป็น 16 kHz ทีละ chunk โดยเก็บ context ซ้าย/ขวาเป็นจำนวนเต็มบล็อกของ polyphase
+    ผลลัพธ์ต่อกันแล้วเท่ากับ resample ทั้งสัญญาณในครั้งเดียว
+    """
+
+    def __init__(self, orig_sr):
+        # ตรวจก่อนทุกอย่าง: rate มาจาก client (query string หรือ header ของ WAV)
+        orig_sr = check_sample_rate(orig_sr)
+        self.passthrough = orig_sr == TARGET_SR
+        self._buf = torch.zeros(0)
+        self._left = 0
+        if not self.passthrough:
+            self._resampler = get_resampler(orig_sr)
+            gcd = self._resampler.gcd
+            self._orig = int(orig_sr) // gcd
+            self._new = TARGET_SR // gcd
+            width = getattr(self._resampler, "width", self._orig)
+            self._ctx = self._orig * max(1, math.ceil(width / self._orig))
+
+    def push(self, samples):
+        if self.passthrough:
+            return samples
+        buf = torch.cat([self._buf, samples]) if self._buf.numel() else samples
+        blocks = (buf.numel() - self._left - self._ctx) // self._orig
+        if blocks <= 0:
+            self._buf = buf
+            return torch.zeros(0)
+        emit_src = blocks * self._orig
+        out = self._resampler(buf[: self._left + emit_src + self._ctx])
+        start = self._left // self._orig * self._new
+        out = out[start: start + blocks * self._new]
+        self._buf = buf[self._left + emit_src - self._ctx:]
+        self._left = self._ctx
+        return out
+
+    def flush(self):
+        if self.passthrough:
+            return torch.zeros(0)
+        rest = self._buf.numel() - self._left
+        if rest <= 0:
+            return torch.zeros(0)
+        out = self._resampler(self._buf)
+        start = self._left // self._orig * self._new
+        out = out[start: start + math.ceil(self._new * rest / self._orig)]
+        self._buf = torch.zeros(0)
+        self._left = 0
+        return out
+
+
+class IncrementalMFCC:
+    """คำนวณเฉพาะเฟรม STFT ใหม่ เก็บ mel power ไว้ ``capacity`` เฟรมล่าสุด"""
+
+    def __init__(self, capacity=MAX_LEN):
+        mel_spec = mfcc_transform.MelSpectrogram
+        self._window = mel_spec.spectrogram.window
+        self._mel_scale = mel_spec.mel_scale
+        self._pending = torch.zeros(0)
+        self._frames = deque(maxlen=capacity)
+        self.frames_total = 0
+
+    def push(self, samples):
+        """เพิ่ม sample 16 kHz คืนจำนวนเฟรมใหม่ที่คำนวณได้"""
+        buf = torch.cat([self._pending, samples]) if self._pending.numel() else samples
+        if buf.numel() < N_FFT:
+            self._pending = buf
+            return 0
+        n_new = 1 + (buf.numel() - N_FFT) // HOP_LENGTH
+        segment = buf[: (n_new - 1) * HOP_LENGTH + N_FFT]
+        spec = torch.stft(
+            segment, N_FFT, hop_length=HOP_LENGTH, win_length=N_FFT, window=self._window,
+            center=False, return_complex=True,
+        ).abs().pow(2)
+        mel = self._mel_scale(spec)  # [n_mels, n_new]
+        self._frames.extend(mel.unbind(dim=1))
+        # เก็บส่วนที่ซ้อนกัน (n_fft - hop) ไว้ใช้กับเฟรมถัดไป แทนการคำนวณใหม่
+        self._pending = buf[n_new * HOP_LENGTH:]
+        self.frames_total += n_new
+        return n_new
+
+    def window(self, frames, end_frame=None):
+        """mel ของ ``frames`` เฟรมที่จบที่เฟรม ``end_frame`` (ค่าเริ่มต้น: ล่าสุด) shape [n_mels, frames]"""
+        stored = list(self._frames)
+        skip = 0 if end_frame is None else self.frames_total - end_frame
+        if skip < 0 or skip + frames > len(stored):
+            raise ValueError("Requested frames are no longer buffered")
+        return torch.stack(stored[len(stored) - skip - frames: len(stored) - skip], dim=1)
+
+
+class StreamingEmotionAnalyzer:
+    """
+    รับ chunk เสียง mono (float32 ที่ sample rate ต้นทาง) แล้วคืนผลอารมณ์ต่อหน้าต่าง
+    ``classify_fn(mfcc_batch[B, 3, n_mfcc, window_frames]) -> list ของชื่ออารมณ์``
+    """
+
+    def __init__(self, sample_rate, classify_fn, window_frames=MAX_LEN, hop_frames=STREAM_HOP_FRAMES):
+        self.window_frames = int(window_frames)
+        self.hop_frames = max(1, int(hop_frames))
+        self._classify = classify_fn
+        self._resampler = StreamingResampler(sample_rate)
+        # เผื่อเฟรมเกินหน้าต่างไว้หนึ่ง hop เพราะแต่ละช่วงที่ป้อนอาจเลยจุดปล่อยหน้าต่างไปเล็กน้อย
+        self._mfcc = IncrementalMFCC(self.window_frames + 2 * self.hop_frames + 2)
+        self._next_end = self.window_frames
+        self._last_end = 0
+        self.windows = 0
+
+    def feed(self, samples):
+        return self._run(self._resampler.push(samples))
+
+    def finish(self):
+        """ปิดสตรีม: ประมวลผลส่วนที่เหลือและปล่อยหน้าต่างสุดท้าย (เติมศูนย์ถ้าสั้นกว่าหน้าต่าง)"""
+        return self._run(self._resampler.flush(), final=True)
+
+    def _run(self, samples, final=False):
+        pending = []
+        # ป้อนทีละช่วงไม่เกิน hop เพื่อไม่ให้ข้ามหน้าต่างเมื่อ chunk ใหญ่กว่า ring buffer
+        step = self.hop_frames * HOP_LENGTH
+        for start in range(0, samples.numel(), step):
+            self._mfcc.push(samples[start:start + step])
+            while self._mfcc.frames_total >= self._next_end:
+                pending.append(self._make_window(self._next_end, self.window_frames))
+                self._last_end = self._next_end
+                self._next_end += self.hop_frames
+        total = self._mfcc.frames_total
+        if final and total > self._last_end:
+            frames = min(total, self.window_frames)
+            pending.append(self._make_window(total, frames))
+            self._last_end = total
+        if not pending:
+            return []
+        labels = self._classify(torch.stack([w["features"] for w in pending]))
+        results = []
+        for window, label in zip(pending, labels):
+            results.append({
+                "window": window["index"],
+                "start_s": window["start_s"],
+                "end_s": window["end_s"],
+                "emotion": label,
+            })
+        return results
+
+    def _make_window(self, end_frame, frames):
+        mel = self._mfcc.window(frames, end_frame)
+        mfcc = fit_frames(mel_to_mfcc(mel), self.window_frames)
+        start_frame = end_frame - frames
+        window = {
+            "index": self.windows,
+            "start_s": round(start_frame * HOP_LENGTH / TARGET_SR, 3),
+            "end_s": round(((end_frame - 1) * HOP_LENGTH + N_FFT) / TARGET_SR, 3),
+            "features": mfcc.unsqueeze(0).expand(3, -1, -1),
+        }
+        self.windows += 1
+        return window
@@ -0,0 +1,212 @@
+"""
+Bulk scoring for the /predict/batch and /predict-audio/batch endpoints.
+
+Items (individual uploads or members of a zip archive) are processed in chunks:
+decode + face detection run concurrently on the image pool, then every face in
+the chunk goes through ResNet18 in one forward pass. Results are produced chunk
+by chunk so the endpoint can stream them as NDJSON while later chunks are still
+running. Failures are reported per item and never abort the whole batch.
+"""
+import asyncio
+import io
+import os
+import zipfile
+import zlib
+
+import torch
+
+try:
+    from .executors import get_pool, PoolSaturated
+    from .model_runtime import get_runtime
+    from .utlis import detect_and_crop_face, predict_face_images_batch
+    from .model_image import classes as image_classes
+    from .model_audio import preprocess_audio, predict_mfcc_batch
+    from .audio_io import decode_audio_bytes
+    from .image_io import decode_image, scale_coords
+except ImportError:
+    try:
+        from Backend.executors import get_pool, PoolSaturated
+        from Backend.model_runtime import get_runtime
+        from Backend.utlis import detect_and_crop_face, predict_face_images_batch
+        from Backend.model_image import classes as image_classes
+        from Backend.model_audio import preprocess_audio, predict_mfcc_batch
+        from Backend.audio_io import decode_audio_bytes
+        from Backend.image_io import decode_image, scale_coords
+    except ImportError:
+        from executors import get_pool, PoolSaturated
+        from model_runtime import get_runtime
+        from utlis import detect_and_crop_face, predict_face_images_batch
+        from model_image import classes as image_classes
+        from model_audio import preprocess_audio, predict_mfcc_batch
+        from audio_io import decode_audio_bytes
+        from image_io import decode_image, scale_coords
+
+BATCH_MAX_ITEMS = int(os.environ.get("EMOTION_BATCH_MAX_ITEMS", "1000"))
+BATCH_MAX_ARCHIVE_BYTES = int(os.environ.get("EMOTION_BATCH_MAX_ARCHIVE_BYTES", str(512 * 1024 * 1024)))
+BATCH_CHUNK_SIZE = int(os.environ.get("EMOTION_BATCH_CHUNK_SIZE", "32"))
+BATCH_STREAM_THRESHOLD = int(os.environ.get("EMOTION_BATCH_STREAM_THRESHOLD", "64"))
+
+_SATURATED_RETRIES = 20
+_SATURATED_BACKOFF_S = 0.05
+
+
+class BatchInputError(ValueError):
+    """อินพุตของ batch ไม่ถูกต้อง (เกินจำนวน, zip เสีย ฯลฯ) -> HTTP 400"""
+
+
+def is_zip(filename, data):
+    return (filename or "").lower().endswith(".zip") or data[:4] == b"PK\x03\x04"
+
+
+def expand_upload(filename, data, max_item_bytes=None):
+    """
+    คืน list ของ (name, bytes) จากไฟล์ที่อัพโหลด ถ้าเป็น zip จะแตกเฉพาะไฟล์จริง
+    (ข้ามโฟลเดอร์และ __MACOSX) และจำกัดขนาดรวมหลังแตกไฟล์เพื่อกัน zip bomb
+    ``max_item_bytes`` จำกัดขนาดของแต่ละไฟล์ใน archive ด้วย
+    """
+    if not is_zip(filename, data):
+        return [(filename or "upload", data)]
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise BatchInputError(f"Invalid zip archive '{filename}': {e}")
+    items = []
+    total = 0
+    with archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+                continue
+            if max_item_bytes is not None and info.file_size > max_item_bytes:
+                raise BatchInputError(f"'{name}' in archive '{filename}' exceeds {max_item_bytes} bytes")
+            total += info.file_size
+            if total > BATCH_MAX_ARCHIVE_BYTES:
+                raise BatchInputError(f"Archive '{filename}' expands beyond {BATCH_MAX_ARCHIVE_BYTES} bytes")
+            if len(items) >= BATCH_MAX_ITEMS:
+                raise BatchInputError(f"Too many items, max {BATCH_MAX_ITEMS}")
+            try:
+                items.append((name, archive.read(info)))
+            except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                raise BatchInputError(f"Corrupt member '{name}' in archive '{filename}': {e}")
+    return items
+
+
+def check_item_count(items):
+    if not items:
+        raise BatchInputError("No files provided")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise BatchInputError(f"Too many items ({len(items)}), max {BATCH_MAX_ITEMS}")
+
+
+async def _run_pool(pool, stage, fn, *args, **kwargs):
+    """เหมือน pool.run แต่รอแล้วลองใหม่เมื่อคิวเต็ม (งาน batch ยอมรอได้ ไม่ต้องตอบ 503)"""
+    for attempt in range(_SATURATED_RETRIES):
+        try:
+            return await pool.run(stage, fn, *args, **kwargs)
+        except PoolSaturated:
+            if attempt == _SATURATED_RETRIES - 1:
+                raise
+            await asyncio.sleep(_SATURATED_BACKOFF_S * (attempt + 1))
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield start, items[start:start + size]
+
+
+# ---------------- images ----------------
+def _decode_and_detect(data, preset):
+    img, scale = decode_image(data)
+    if img is None:
+        raise ValueError("Invalid image")
+    face_crop, coords = detect_and_crop_face(img, use_anime_detection=False, preset=preset)
+    return face_crop, (None if face_crop is None else scale_coords(coords, scale))
+
+
+async def iter_image_results(items, preset=None, chunk_size=BATCH_CHUNK_SIZE):
+    """async generator: คืน list ผลลัพธ์ทีละ chunk (เรียงตาม index เดิม)"""
+    pool = get_pool("image")
+    # จำกัดงานค้างของ batch นี้ไม่ให้เบียดคิวของ /predict ปกติจนเต็ม
+    limiter = asyncio.Semaphore(pool.max_workers)
+
+    async def prepare(data):
+        async with limiter:
+            return await _run_pool(pool, "detect", _decode_and_detect, data, preset)
+
+    for start, chunk in _chunks(items, max(1, chunk_size)):
+        detections = await asyncio.gather(
+            *(prepare(data) for _, data in chunk), return_exceptions=True
+        )
+        results = [None] * len(chunk)
+        faces, face_slots = [], []
+        for i, ((name, _), det) in enumerate(zip(chunk, detections)):
+            base = {"index": start + i, "filename": name}
+            if isinstance(det, BaseException):
+                results[i] = {**base, "error": str(det) or type(det).__name__}
+                continue
+            face_crop, coords = det
+            if face_crop is None:
+                results[i] = {**base, "error": "No face detected"}
+                continue
+            results[i] = {
+                **base,
+                "face_coords": {"x": int(coords[0]), "y": int(coords[1]), "w": int(coords[2]), "h": int(coords[3])},
+            }
+            faces.append(face_crop)
+            face_slots.append(i)
+
+        if faces:
+            try:
+                emotions = await _run_pool(
+                    pool, "infer", predict_face_images_batch, faces, get_runtime("image"), image_classes
+                )
+                for slot, emotion in zip(face_slots, emotions):
+                    results[slot]["emotion"] = emotion
+            except Exception as e:
+                for slot in face_slots:
+                    results[slot]["error"] = f"prediction_failed: {e}"
+        yield results
+
+
+# ---------------- audio ----------------
+def _decode_and_extract(data, name):
+    # MFCC ทีละคลิป: คลิปที่เสียหรือสั้นเกินไปล้มเฉพาะรายการของตัวเอง ไม่ลากทั้ง chunk
+    waveform, sr = decode_audio_bytes(data, name)
+    return preprocess_audio(waveform, sr)
+
+
+def _predict_features(features):
+    return predict_mfcc_batch(torch.cat(features))
+
+
+async def iter_audio_results(items, chunk_size=BATCH_CHUNK_SIZE):
+    pool = get_pool("audio")
+    limiter = asyncio.Semaphore(pool.max_workers)
+
+    async def decode(name, data):
+        async with limiter:
+            return await _run_pool(pool, "decode", _decode_and_extract, data, name)
+
+    for start, chunk in _chunks(items, max(1, chunk_size)):
+        decoded = await asyncio.gather(
+            *(decode(name, data) for name, data in chunk), return_exceptions=True
+        )
+        results = [None] * len(chunk)
+        features, clip_slots = [], []
+        for i, ((name, _), dec) in enumerate(zip(chunk, decoded)):
+            results[i] = {"index": start + i, "filename": name}
+            if isinstance(dec, BaseException):
+                results[i]["error"] = str(dec) or type(dec).__name__
+                continue
+            features.append(dec)
+            clip_slots.append(i)
+
+        if features:
+            try:
+                emotions = await _run_pool(pool, "infer", _predict_features, features)
+                for slot, emotion in zip(clip_slots, emotions):
+                    results[slot]["emotion"] = emotion
+            except Exception as e:
+                for slot in clip_slots:
+                    results[slot]["error"] = f"audio_prediction_failed: {e}"
+        yield results
@@ -0,0 +1,245 @@
+"""
+Dynamic micro-batching scheduler for model inference.
+
+Concurrent requests submit single items; a worker thread collects them into one
+batch and flushes when either ``max_batch_size`` items are pending or the oldest
+item has waited ``max_wait_ms``. Each caller gets back its own result.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+try:
+    from .metrics import BATCH_SIZE, METRICS_ENABLED, current_route, observe_queue_wait
+except ImportError:
+    try:
+        from Backend.metrics import BATCH_SIZE, METRICS_ENABLED, current_route, observe_queue_wait
+    except ImportError:
+        from metrics import BATCH_SIZE, METRICS_ENABLED, current_route, observe_queue_wait
+
+MAX_BATCH_SIZE = int(os.environ.get("EMOTION_BATCH_MAX_SIZE", "16"))
+MAX_WAIT_MS = float(os.environ.get("EMOTION_BATCH_MAX_WAIT_MS", "5"))
+
+_STOP = object()
+
+
+class _Pending:
+    __slots__ = ("item", "future", "enqueued")
+
+    def __init__(self, item):
+        self.item = item
+        self.future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    รวม request ที่เข้ามาพร้อมกันให้เป็น batch เดียว แล้วเรียก ``batch_fn(items) -> results``
+
+    ``batch_fn`` ต้องคืน list ที่มีความยาวเท่ากับ ``items`` และเรียงลำดับเดียวกัน
+    """
+
+    def __init__(self, batch_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, name="batcher"):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        self.name = name
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._batch_fn = batch_fn
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._size_hist = {}
+        self._recent_waits = deque(maxlen=1024)
+        self._recent_run = deque(maxlen=1024)
+
+    # ---------- submission ----------
+    def submit(self, item):
+        """ส่งหนึ่งรายการเข้าคิว คืน ``concurrent.futures.Future``"""
+        self._ensure_worker()
+        pending = _Pending(item)
+        self._queue.put(pending)
+        return pending.future
+
+    def submit_many(self, items):
+        self._ensure_worker()
+        futures = []
+        for item in items:
+            pending = _Pending(item)
+            self._queue.put(pending)
+            futures.append(pending.future)
+        return futures
+
+    async def run(self, item):
+        """เวอร์ชัน async สำหรับ endpoint ของ FastAPI"""
+        return await asyncio.wrap_future(self.submit(item))
+
+    async def run_many(self, items):
+        futures = [asyncio.wrap_future(f) for f in self.submit_many(items)]
+        return list(await asyncio.gather(*futures))
+
+    def close(self, timeout=None):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+        self._thread = None
+
+    # ---------- worker ----------
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._worker_loop, name=f"{self.name}-worker", daemon=True
+                )
+                self._thread.start()
+
+    def _worker_loop(self):
+        # batch หนึ่งรวมหลาย route จึงติดป้าย stage ที่วัดใน batch_fn ด้วยชื่อ batcher
+        current_route.set(f"batcher:{self.name}")
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            # เวลารอวัดจากตอนที่รายการแรกเข้าคิว เพื่อให้ latency มีขอบเขต
+            deadline = first.enqueued + self.max_wait
+            stop_after = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining <= 0:
+                        nxt = self._queue.get_nowait()
+                    else:
+                        nxt = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    stop_after = True
+                    break
+                batch.append(nxt)
+            self._run_batch(batch)
+            if stop_after:
+                return
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        live = [p for p in batch if p.future.set_running_or_notify_cancel()]
+        if not live:
+            return
+        waits = [started - p.enqueued for p in live]
+        try:
+            results = self._batch_fn([p.item for p in live])
+            if len(results) != len(live):
+                raise RuntimeError(
+                    f"{self.name}: batch_fn returned {len(results)} results for {len(live)} items"
+                )
+        except Exception as e:
+            for p in live:
+                p.future.set_exception(e)
+            failed = True
+        else:
+            for p, result in zip(live, results):
+                p.future.set_result(result)
+            failed = False
+        elapsed = time.perf_counter() - started
+
+        if METRICS_ENABLED:
+            BATCH_SIZE.observe(len(live), self.name)
+            for wait in waits:
+                observe_queue_wait(f"{self.name}_batcher", wait)
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(live)
+            if failed:
+                self._errors += 1
+            self._size_hist[len(live)] = self._size_hist.get(len(live), 0) + 1
+            self._recent_waits.extend(waits)
+            self._recent_run.append(elapsed)
+
+    # ---------- metrics ----------
+    def stats(self):
+        """สถิติสำหรับจูน throughput/latency (batch size และเวลารอในคิว)"""
+        with self._stats_lock:
+            waits = sorted(self._recent_waits)
+            runs = sorted(self._recent_run)
+            batches = self._batches
+            items = self._items
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "pending": self._queue.qsize(),
+                "batches": batches,
+                "items": items,
+                "errors": self._errors,
+                "avg_batch_size": (items / batches) if batches else 0.0,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._size_hist.items())},
+                "queue_wait_ms": _summary_ms(waits),
+                "batch_run_ms": _summary_ms(runs),
+            }
+
+
+def _summary_ms(sorted_values):
+    if not sorted_values:
+        return {"count": 0, "avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    n = len(sorted_values)
+
+    def pct(q):
+        return sorted_values[min(n - 1, int(q * n))] * 1000.0
+
+    return {
+        "count": n,
+        "avg": sum(sorted_values) / n * 1000.0,
+        "p50": pct(0.50),
+        "p95": pct(0.95),
+        "max": sorted_values[-1] * 1000.0,
+    }
+
+
+# Lazy init for the shared face-emotion batcher (one per process)
+_face_batcher = None
+_face_batcher_lock = threading.Lock()
+
+
+def get_face_batcher():
+    """
+    คืน MicroBatcher ที่ใช้ร่วมกันสำหรับโมเดลภาพใบหน้า (runtime ที่เลือกไว้ของ model_image.model)
+    รับใบหน้า RGB numpy 224x224 คืนความน่าจะเป็น numpy [n_classes] ตามลำดับ model_image.classes
+    (ใช้ ``top_label`` แปลงเป็นชื่ออารมณ์)
+    """
+    global _face_batcher
+    if _face_batcher is None:
+        with _face_batcher_lock:
+            if _face_batcher is None:
+                try:
+                    from .model_runtime import get_runtime
+                    from .utlis import predict_face_images_proba
+                except ImportError:
+                    try:
+                        from Backend.model_runtime import get_runtime
+                        from Backend.utlis import predict_face_images_proba
+                    except ImportError:
+                        from model_runtime import get_runtime
+                        from utlis import predict_face_images_proba
+
+                runtime = get_runtime("image")
+                _face_batcher = MicroBatcher(
+                    lambda faces: list(predict_face_images_proba(faces, runtime)),
+                    name="face",
+                )
+    return _face_batcher
+
+
+def top_label(probs, class_names):
+    """ชื่อคลาสที่ความน่าจะเป็นสูงสุด"""
+    return class_names[int(probs.argmax())]
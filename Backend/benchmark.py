@@ -0,0 +1,318 @@
+"""
+Benchmark and load-test suite for the inference API.
+
+    python -m Backend.benchmark --out bench.json
+    python -m Backend.benchmark --concurrency 1,8,32 --requests 200 --compare old.json
+
+Synthetic inputs are generated on the fly: drawn faces (only seeds the Haar
+detector actually finds are kept) and harmonic/noise audio clips as WAV. Each
+pipeline stage is microbenchmarked on its own (decode, Haar and tiered detection,
+preprocessing, forward pass, MFCC, JPEG/base64 encoding), then the FastAPI app
+is driven in-process through an ASGI client at each requested concurrency.
+
+Results are written as JSON with sorted keys (p50/p95/p99/mean latency in ms
+and ops or requests per second) so two runs can be diffed, or compared with
+``--compare`` which prints the relative change per metric.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+try:
+    from .synthetic import synthetic_face, synthetic_wav
+except ImportError:
+    try:
+        from Backend.synthetic import synthetic_face, synthetic_wav
+    except ImportError:
+        from synthetic import synthetic_face, synthetic_wav
+
+
+# ---------------- synthetic data ----------------
+def synthetic_images(count, size=480, preset=None):
+    """คืน list ของ JPEG bytes ที่ Haar ตรวจเจอใบหน้าแน่นอน (ข้าม seed ที่ไม่เจอ)"""
+    import cv2
+    try:
+        from .face_detector import detect_faces
+    except ImportError:
+        try:
+            from Backend.face_detector import detect_faces
+        except ImportError:
+            from face_detector import detect_faces
+    images = []
+    seed = 0
+    while len(images) < count and seed < count * 20:
+        img = synthetic_face(size, seed)
+        seed += 1
+        if detect_faces(img, preset=preset):
+            ok, buf = cv2.imencode(".jpg", img)
+            if ok:
+                images.append(buf.tobytes())
+    if len(images) < count:
+        raise RuntimeError(f"Only {len(images)}/{count} synthetic faces were detectable")
+    return images
+
+
+# ---------------- statistics ----------------
+def summarize(seconds, ops_per_sample=1):
+    """สรุป latency เป็น ms (p50/p95/p99/mean/min/max) และจำนวน op ต่อวินาที"""
+    if not seconds:
+        return {"count": 0}
+    ms = np.asarray(seconds, dtype=np.float64) * 1000.0
+    return {
+        "count": int(ms.size),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "min_ms": round(float(ms.min()), 3),
+        "max_ms": round(float(ms.max()), 3),
+        "ops_per_s": round(float(ops_per_sample * 1000.0 / ms.mean()), 2),
+    }
+
+
+def _time(fn, inputs, repeat, warmup=2):
+    for i in range(warmup):
+        fn(inputs[i % len(inputs)])
+    samples = []
+    for i in range(repeat):
+        item = inputs[i % len(inputs)]
+        t0 = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+# ---------------- stage microbenchmarks ----------------
+def bench_stages(images, clips, repeat=50, batch_size=8):
+    try:
+        from . import main as api
+        from .face_detector import detect_faces
+        from .face_cascade import detect_faces_tiered
+        from .image_io import decode_image
+        from .utlis import detect_and_crop_face, faces_to_tensor
+        from .model_runtime import get_runtime
+        from .audio_io import decode_audio_bytes
+        from .audio_features import mfcc_features
+    except ImportError:
+        try:
+            from Backend import main as api
+            from Backend.face_detector import detect_faces
+            from Backend.face_cascade import detect_faces_tiered
+            from Backend.image_io import decode_image
+            from Backend.utlis import detect_and_crop_face, faces_to_tensor
+            from Backend.model_runtime import get_runtime
+            from Backend.audio_io import decode_audio_bytes
+            from Backend.audio_features import mfcc_features
+        except ImportError:
+            import main as api
+            from face_detector import detect_faces
+            from face_cascade import detect_faces_tiered
+            from image_io import decode_image
+            from utlis import detect_and_crop_face, faces_to_tensor
+            from model_runtime import get_runtime
+            from audio_io import decode_audio_bytes
+            from audio_features import mfcc_features
+    import torch
+
+    decoded = [decode_image(b)[0] for b in images]
+    faces = [detect_and_crop_face(img)[0] for img in decoded]
+    waves = [decode_audio_bytes(c, "clip.wav") for c in clips]
+    mfccs = [mfcc_features(w, sr) for w, sr in waves]
+    image_rt = get_runtime("image")
+    audio_rt = get_runtime("audio")
+    face_batch = faces_to_tensor(faces[:batch_size] * (batch_size // len(faces[:batch_size]) + 1))[:batch_size].clone()
+
+    def forward(rt, x):
+        with torch.no_grad():
+            rt(x)
+
+    stages = {
+        "image_decode": (_time(decode_image, images, repeat), 1),
+        "haar_detect": (_time(detect_faces, decoded, repeat), 1),
+        "tiered_detect": (_time(detect_faces_tiered, decoded, repeat), 1),
+        "face_crop": (_time(detect_and_crop_face, decoded, repeat), 1),
+        "preprocess": (_time(lambda f: faces_to_tensor([f]), faces, repeat), 1),
+        "image_forward_b1": (_time(lambda f: forward(image_rt, faces_to_tensor([f])), faces, repeat), 1),
+        f"image_forward_b{batch_size}": (_time(lambda _: forward(image_rt, face_batch), [None], max(5, repeat // 4)), batch_size),
+        "crop_encode": (_time(api._encode_face_crop, faces, repeat), 1),
+        "audio_decode": (_time(lambda c: decode_audio_bytes(c, "clip.wav"), clips, repeat), 1),
+        "mfcc": (_time(lambda w: mfcc_features(*w), waves, repeat), 1),
+        "audio_forward": (_time(lambda x: forward(audio_rt, x), mfccs, repeat), 1),
+    }
+    return {name: summarize(samples, ops) for name, (samples, ops) in stages.items()}
+
+
+# ---------------- ASGI load test ----------------
+async def _drive(client, make_request, concurrency, total):
+    latencies = []
+    statuses = {}
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            method, url, kwargs = make_request(i)
+            t0 = time.perf_counter()
+            try:
+                resp = await client.request(method, url, **kwargs)
+                code = str(resp.status_code)
+            except Exception as e:
+                code = type(e).__name__
+            latencies.append(time.perf_counter() - t0)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    result = summarize(latencies)
+    result.pop("ops_per_s", None)
+    result.update({
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_s": round(wall, 3),
+        "requests_per_s": round(total / wall, 2) if wall > 0 else 0.0,
+        "status": dict(sorted(statuses.items())),
+    })
+    return result
+
+
+async def _load_tests(app, images, clips, concurrencies, total, endpoints):
+    import httpx
+    scenarios = {
+        "/predict": lambda i: ("POST", "/predict", {"files": {"file": ("face.jpg", images[i % len(images)], "image/jpeg")}}),
+        "/predict-audio": lambda i: ("POST", "/predict-audio", {"files": {"file": ("clip.wav", clips[i % len(clips)], "audio/wav")}}),
+        "/predict-both": lambda i: ("POST", "/predict-both", {"files": {
+            "image": ("face.jpg", images[i % len(images)], "image/jpeg"),
+            "audio": ("clip.wav", clips[i % len(clips)], "audio/wav"),
+        }}),
+    }
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120.0) as client:
+        for endpoint in endpoints:
+            make_request = scenarios[endpoint]
+            await _drive(client, make_request, 1, min(4, total))  # warm-up
+            results[endpoint] = {
+                f"c{c}": await _drive(client, make_request, c, total) for c in concurrencies
+            }
+    return results
+
+
+def run_load_tests(images, clips, concurrencies=(1, 8), total=100, endpoints=("/predict", "/predict-audio", "/predict-both")):
+    try:
+        from .main import app
+    except ImportError:
+        try:
+            from Backend.main import app
+        except ImportError:
+            from main import app
+    return asyncio.run(_load_tests(app, images, clips, list(concurrencies), total, list(endpoints)))
+
+
+# ---------------- report ----------------
+def environment():
+    import torch
+    try:
+        from .model_runtime import RUNTIME_CONFIG
+    except ImportError:
+        try:
+            from Backend.model_runtime import RUNTIME_CONFIG
+        except ImportError:
+            from model_runtime import RUNTIME_CONFIG
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5,
+        ).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "cpu_count": os.cpu_count(),
+        "backends": dict(RUNTIME_CONFIG),
+        "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith("EMOTION_")},
+    }
+
+
+def compare(old, new):
+    """เทียบผลสองรอบ คืน {path: {"old", "new", "change_pct"}} ของ p50/p95/p99 และ throughput"""
+    keys = ("p50_ms", "p95_ms", "p99_ms", "ops_per_s", "requests_per_s")
+    diff = {}
+
+    def walk(a, b, path):
+        if not isinstance(a, dict) or not isinstance(b, dict):
+            return
+        for k in sorted(set(a) & set(b)):
+            if k in keys and isinstance(a[k], (int, float)) and isinstance(b[k], (int, float)):
+                change = (b[k] - a[k]) / a[k] * 100.0 if a[k] else 0.0
+                diff[f"{path}.{k}"] = {"old": a[k], "new": b[k], "change_pct": round(change, 1)}
+            else:
+                walk(a[k], b[k], f"{path}.{k}" if path else k)
+
+    walk({k: old.get(k) for k in ("stages", "load")}, {k: new.get(k) for k in ("stages", "load")}, "")
+    return diff
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the emotion inference pipeline")
+    parser.add_argument("--out", help="write JSON results here (default: stdout)")
+    parser.add_argument("--images", type=int, default=8, help="number of synthetic face images")
+    parser.add_argument("--image-size", type=int, default=480)
+    parser.add_argument("--clips", type=int, default=4, help="number of synthetic audio clips")
+    parser.add_argument("--clip-seconds", type=float, default=2.0)
+    parser.add_argument("--clip-sr", type=int, default=44100)
+    parser.add_argument("--repeat", type=int, default=50, help="iterations per stage microbenchmark")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--concurrency", default="1,8", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint and concurrency level")
+    parser.add_argument("--endpoints", default="/predict,/predict-audio,/predict-both")
+    parser.add_argument("--skip-stages", action="store_true")
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--cache", action="store_true", help="keep the prediction cache on (off by default)")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    if not args.cache:
+        # ต้องตั้งก่อน import result_cache มิฉะนั้นรอบที่สองจะวัดแค่ cache hit
+        os.environ["EMOTION_CACHE_ENABLED"] = "0"
+
+    images = synthetic_images(args.images, args.image_size)
+    clips = [synthetic_wav(args.clip_seconds, args.clip_sr, seed=i) for i in range(args.clips)]
+    report = {
+        "meta": environment(),
+        "config": {k: v for k, v in sorted(vars(args).items()) if k not in ("out", "compare")},
+    }
+    if not args.skip_stages:
+        report["stages"] = bench_stages(images, clips, args.repeat, args.batch_size)
+    if not args.skip_load:
+        concurrencies = [int(c) for c in args.concurrency.split(",") if c.strip()]
+        endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+        report["load"] = run_load_tests(images, clips, concurrencies, args.requests, endpoints)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            diff = compare(json.load(f), report)
+        for path, d in diff.items():
+            print(f"{path:60s} {d['old']:>10} -> {d['new']:>10}  ({d['change_pct']:+.1f}%)", file=sys.stderr)
+    return report
+
+
+if __name__ == "__main__":
+    main()
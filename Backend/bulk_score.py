@@ -0,0 +1,454 @@
+"""
+Offline bulk scorer for archived images and audio clips.
+
+    python -m Backend.bulk_score /data/archive --out scores.jsonl
+    python -m Backend.bulk_score --manifest files.txt --out scores.parquet --workers 8 --resume
+
+Inputs come from a directory walk (sorted, by extension) or a manifest (one path
+per line, or a CSV with a ``path`` column). Decoding, face detection/cropping
+and MFCC extraction run in a process pool; a feeder thread keeps at most
+``--queue-size`` prepared files in a bounded queue, and the main process drains
+it into batched forward passes (``--batch-size``) on the configured runtime.
+
+Rows are written as they are produced (CSV / JSONL appended and flushed per
+batch, Parquet as numbered part files), so the output itself is the checkpoint:
+``--resume`` reads back the paths already written, drops a torn last record
+left by a crash, and only scores the remaining files. Rows whose error is
+transient (I/O failures, a failed batch) do not count as written: those files
+are scored again and the new rows, appended later, supersede the error row.
+Only ``invalid_image`` and ``no_face`` are final.
+"""
+import argparse
+import csv
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+AUDIO_EXTENSIONS = {".wav", ".flac", ".ogg", ".mp3", ".m4a"}
+
+FIELDS = ["path", "kind", "face", "x", "y", "w", "h", "emotion", "confidence", "model_version", "error"]
+# error ที่ลองใหม่ก็ได้ผลเดิม; error อื่น (OSError, batch ล้ม ฯลฯ) จะถูกลองใหม่ตอน --resume
+FINAL_ERRORS = frozenset({"invalid_image", "no_face"})
+
+_STOP = object()
+
+
+# ---------------- inputs ----------------
+def _kind_of(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return "image"
+    if ext in AUDIO_EXTENSIONS:
+        return "audio"
+    return None
+
+
+def iter_inputs(root=None, manifest=None, kinds=("image", "audio")):
+    """คืน path ของไฟล์ที่ต้องให้คะแนน (เดินไดเรกทอรีแบบเรียงลำดับ หรืออ่านจาก manifest)"""
+    if manifest:
+        with open(manifest, "r", encoding="utf-8", newline="") as f:
+            first = f.readline()
+            f.seek(0)
+            if first.strip().lower().split(",")[0] == "path":
+                paths = (row["path"] for row in csv.DictReader(f))
+            else:
+                paths = (line.strip() for line in f)
+            base = os.path.dirname(os.path.abspath(manifest))
+            for p in paths:
+                if p and _kind_of(p) in kinds:
+                    yield p if os.path.isabs(p) else os.path.join(base, p)
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if _kind_of(name) in kinds:
+                yield os.path.join(dirpath, name)
+
+
+# ---------------- worker process ----------------
+def _init_worker():
+    # แต่ละโปรเซสใช้ thread เดียว มิฉะนั้น N โปรเซส x M threads จะแย่ง CPU กัน
+    import cv2
+    import torch
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+
+
+def prepare_file(path, preset=None, max_faces=1):
+    """
+    (รันใน worker process) อ่านไฟล์แล้วเตรียมอินพุตของโมเดล
+    image -> {"faces": [(face_rgb_224, (x, y, w, h)), ...]}, audio -> {"mfcc": numpy [128, T]}
+    """
+    kind = _kind_of(path)
+    try:
+        if kind == "image":
+            try:
+                from .image_io import decode_image, scale_faces
+                from .utlis import detect_and_crop_face
+            except ImportError:
+                try:
+                    from Backend.image_io import decode_image, scale_faces
+                    from Backend.utlis import detect_and_crop_face
+                except ImportError:
+                    from image_io import decode_image, scale_faces
+                    from utlis import detect_and_crop_face
+            with open(path, "rb") as f:
+                img, scale = decode_image(f.read())
+            if img is None:
+                return path, kind, None, "invalid_image"
+            faces = detect_and_crop_face(img, preset=preset, multi_face=True, max_faces=max_faces)
+            if not faces:
+                return path, kind, None, "no_face"
+            return path, kind, {"faces": scale_faces(faces, scale)}, None
+        try:
+            from .audio_io import decode_audio_bytes
+            from .audio_features import mfcc_features
+        except ImportError:
+            try:
+                from Backend.audio_io import decode_audio_bytes
+                from Backend.audio_features import mfcc_features
+            except ImportError:
+                from audio_io import decode_audio_bytes
+                from audio_features import mfcc_features
+        with open(path, "rb") as f:
+            waveform, sr = decode_audio_bytes(f.read(), os.path.basename(path))
+        # ส่งกลับแค่ช่องเดียว (อีกสองช่องเป็นสำเนากัน) เพื่อลดขนาดที่ต้อง pickle
+        return path, kind, {"mfcc": mfcc_features(waveform, sr)[0, 0].numpy()}, None
+    except Exception as e:
+        return path, kind, None, f"{type(e).__name__}: {e}"
+
+
+# ---------------- writers ----------------
+def _is_final(error):
+    return not error or error in FINAL_ERRORS
+
+
+class _AppendWriter:
+    """CSV/JSONL แบบ append; ``completed()`` อ่าน path ที่เขียนแล้วและตัดบรรทัดที่ขาดท้ายไฟล์ทิ้ง"""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def _repair_tail(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def open(self, resume):
+        if resume:
+            self._repair_tail()
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self._f = open(self.path, "a" if resume else "w", encoding="utf-8", newline="")
+        self._start(exists and resume)
+
+    def _start(self, appending):
+        pass
+
+    def flush(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        if self._f is not None:
+            self.flush()
+            self._f.close()
+            self._f = None
+
+
+class JsonlWriter(_AppendWriter):
+    def completed(self):
+        self._repair_tail()
+        done = set()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue
+                    if row.get("path") and _is_final(row.get("error")):
+                        done.add(row["path"])
+        return done
+
+    def write(self, rows):
+        for row in rows:
+            self._f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+class CsvWriter(_AppendWriter):
+    def completed(self):
+        self._repair_tail()
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, "r", encoding="utf-8", newline="") as f:
+            return {row["path"] for row in csv.DictReader(f) if row.get("path") and _is_final(row.get("error"))}
+
+    def _start(self, appending):
+        self._writer = csv.DictWriter(self._f, fieldnames=FIELDS)
+        if not appending:
+            self._writer.writeheader()
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+
+class ParquetWriter:
+    """เขียนเป็นไดเรกทอรีของ part-NNNNN.parquet (ไฟล์ที่เขียนไม่เสร็จจะถูกลบตอน resume)"""
+
+    def __init__(self, path, rows_per_part=5000):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.rows_per_part = rows_per_part
+        self._rows = []
+        self._part = 0
+
+    def _parts(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(p for p in os.listdir(self.path) if p.startswith("part-") and p.endswith(".parquet"))
+
+    def completed(self):
+        import pyarrow.parquet as pq
+        done = set()
+        for name in self._parts():
+            full = os.path.join(self.path, name)
+            try:
+                table = pq.read_table(full, columns=["path", "error"]).to_pydict()
+                done.update(p for p, e in zip(table["path"], table["error"]) if _is_final(e))
+            except Exception:
+                os.remove(full)
+        return done
+
+    def open(self, resume):
+        os.makedirs(self.path, exist_ok=True)
+        if not resume:
+            for name in self._parts():
+                os.remove(os.path.join(self.path, name))
+        parts = self._parts()
+        self._part = int(parts[-1][5:10]) + 1 if parts else 0
+
+    def write(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(self._rows)
+        final = os.path.join(self.path, f"part-{self._part:05d}.parquet")
+        tmp = final + ".tmp"
+        pq.write_table(table, tmp)
+        os.replace(tmp, final)  # เขียนเสร็จแล้วจึงเปลี่ยนชื่อ: part ที่เห็นต้องสมบูรณ์เสมอ
+        self._part += 1
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+
+def make_writer(path, fmt=None):
+    fmt = fmt or {".csv": "csv", ".parquet": "parquet", ".jsonl": "jsonl", ".json": "jsonl"}.get(
+        os.path.splitext(path)[1].lower(), "jsonl")
+    if fmt == "csv":
+        return CsvWriter(path)
+    if fmt == "parquet":
+        return ParquetWriter(path)
+    return JsonlWriter(path)
+
+
+# ---------------- scoring ----------------
+class BulkScorer:
+    def __init__(self, writer, workers=None, batch_size=32, queue_size=256, preset=None, max_faces=1):
+        self.writer = writer
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.batch_size = max(1, int(batch_size))
+        self.queue_size = max(self.batch_size, int(queue_size))
+        self.preset = preset
+        self.max_faces = max(1, int(max_faces))
+        self.counts = {"files": 0, "rows": 0, "errors": 0, "skipped": 0}
+        self._image = []  # (path, face_index, coords, face_rgb)
+        self._audio = []  # (path, mfcc)
+
+    # -------- feeder: process pool -> bounded queue --------
+    def _feed(self, paths, pool, out):
+        pending = deque()
+        try:
+            for path in paths:
+                pending.append(pool.submit(prepare_file, path, self.preset, self.max_faces))
+                # จำกัดงานที่ค้างใน pool ด้วย ไม่ให้อ่านไฟล์ล่วงหน้าจนหน่วยความจำเต็ม
+                while len(pending) >= self.queue_size:
+                    out.put(pending.popleft().result())
+            while pending:
+                out.put(pending.popleft().result())
+        except BaseException as e:
+            out.put(e)
+        finally:
+            out.put(_STOP)
+
+    def run(self, paths, progress_every=1000):
+        try:
+            from .model_runtime import get_runtime
+            from .model_image import classes as image_classes, model_version as image_version
+            from .model_audio import classes as audio_classes, model_version as audio_version, predict_mfcc_proba
+            from .utlis import predict_face_images_proba
+        except ImportError:
+            try:
+                from Backend.model_runtime import get_runtime
+                from Backend.model_image import classes as image_classes, model_version as image_version
+                from Backend.model_audio import (
+                    classes as audio_classes, model_version as audio_version, predict_mfcc_proba,
+                )
+                from Backend.utlis import predict_face_images_proba
+            except ImportError:
+                from model_runtime import get_runtime
+                from model_image import classes as image_classes, model_version as image_version
+                from model_audio import classes as audio_classes, model_version as audio_version, predict_mfcc_proba
+                from utlis import predict_face_images_proba
+        self._image_ctx = (get_runtime, image_classes, image_version, predict_face_images_proba)
+        self._audio_ctx = (audio_classes, audio_version, predict_mfcc_proba)
+
+        q = queue.Queue(maxsize=self.queue_size)
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as pool:
+            feeder = threading.Thread(target=self._feed, args=(paths, pool, q), daemon=True)
+            feeder.start()
+            while True:
+                item = q.get()
+                if item is _STOP:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                self._accept(*item)
+                if progress_every and self.counts["files"] % progress_every == 0:
+                    rate = self.counts["files"] / max(1e-9, time.perf_counter() - started)
+                    print(f"{self.counts['files']} files, {self.counts['rows']} rows ({rate:.1f} files/s)",
+                          file=sys.stderr)
+            feeder.join()
+        self._flush_image()
+        self._flush_audio()
+        self.writer.flush()
+        return self.counts
+
+    def _accept(self, path, kind, data, error):
+        self.counts["files"] += 1
+        if error is not None:
+            self.counts["errors"] += 1
+            self._write([_row(path, kind, error=error)])
+            return
+        if kind == "image":
+            for i, (face, coords) in enumerate(data["faces"]):
+                self._image.append((path, i, coords, face))
+            if len(self._image) >= self.batch_size:
+                self._flush_image()
+        else:
+            self._audio.append((path, data["mfcc"]))
+            if len(self._audio) >= self.batch_size:
+                self._flush_audio()
+
+    def _flush_image(self):
+        if not self._image:
+            return
+        get_runtime, classes, version, predict_proba = self._image_ctx
+        probs = predict_proba([face for _, _, _, face in self._image], get_runtime("image"))
+        rows = []
+        for (path, i, (x, y, w, h), _), p in zip(self._image, probs):
+            best = int(p.argmax())
+            rows.append(_row(path, "image", face=i, x=x, y=y, w=w, h=h, emotion=classes[best],
+                             confidence=round(float(p[best]), 6), model_version=version))
+        self._image = []
+        self._write(rows)
+
+    def _flush_audio(self):
+        if not self._audio:
+            return
+        import torch
+        classes, version, predict_proba = self._audio_ctx
+        x = torch.from_numpy(np.stack([m for _, m in self._audio]))[:, None].expand(-1, 3, -1, -1)
+        probs = predict_proba(x)
+        rows = []
+        for (path, _), p in zip(self._audio, probs):
+            best = int(p.argmax())
+            rows.append(_row(path, "audio", emotion=classes[best], confidence=round(float(p[best]), 6),
+                             model_version=version))
+        self._audio = []
+        self._write(rows)
+
+    def _write(self, rows):
+        self.writer.write(rows)
+        self.writer.flush()
+        self.counts["rows"] += len(rows)
+
+
+def _row(path, kind, **values):
+    row = dict.fromkeys(FIELDS)
+    row.update(path=path, kind=kind, **values)
+    return row
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score many images/audio clips offline")
+    parser.add_argument("input", nargs="?", help="directory to walk")
+    parser.add_argument("--manifest", help="text file with one path per line, or CSV with a 'path' column")
+    parser.add_argument("--out", required=True, help="output file (.jsonl/.csv) or directory (.parquet)")
+    parser.add_argument("--format", choices=["jsonl", "csv", "parquet"], help="default: from --out extension")
+    parser.add_argument("--kind", choices=["image", "audio", "all"], default="all")
+    parser.add_argument("--workers", type=int, default=None, help="decode/detect processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--queue-size", type=int, default=256, help="max prepared files waiting for inference")
+    parser.add_argument("--preset", help="face detector preset (fast/balanced/accurate)")
+    parser.add_argument("--max-faces", type=int, default=1, help="faces scored per image (one row each)")
+    parser.add_argument("--resume", action="store_true", help="skip files already present in --out")
+    args = parser.parse_args(argv)
+
+    if not args.input and not args.manifest:
+        parser.error("give a directory or --manifest")
+    writer = make_writer(args.out, args.format)
+    if not args.resume and os.path.exists(args.out) and (os.path.isdir(args.out) or os.path.getsize(args.out)):
+        parser.error(f"{args.out} exists; use --resume to continue it")
+
+    done = writer.completed() if args.resume else set()
+    kinds = ("image", "audio") if args.kind == "all" else (args.kind,)
+    skipped = 0
+
+    def remaining():
+        nonlocal skipped
+        for path in iter_inputs(args.input, args.manifest, kinds):
+            if path in done:
+                skipped += 1
+                continue
+            yield path
+
+    writer.open(resume=args.resume)
+    scorer = BulkScorer(writer, args.workers, args.batch_size, args.queue_size, args.preset, args.max_faces)
+    started = time.perf_counter()
+    try:
+        counts = scorer.run(remaining())
+    finally:
+        writer.close()
+    counts["skipped"] = skipped
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    print(json.dumps(counts), file=sys.stderr)
+    return counts
+
+
+if __name__ == "__main__":
+    main()
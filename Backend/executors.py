@@ -0,0 +1,198 @@
+"""
+Bounded executor pools that keep blocking CV / torch work off the asyncio event loop.
+
+Each pool has a fixed number of worker threads plus a bounded queue. When both are
+full ``run`` raises ``PoolSaturated`` immediately (the API turns it into a 503)
+instead of letting requests pile up without limit. Every call is timed per stage
+(decode / detect / infer / encode) so queue wait and run time can be tuned.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    from .metrics import current_route, observe_stage, observe_queue_wait, profiler
+except ImportError:
+    try:
+        from Backend.metrics import current_route, observe_stage, observe_queue_wait, profiler
+    except ImportError:
+        from metrics import current_route, observe_stage, observe_queue_wait, profiler
+
+_CPU = os.cpu_count() or 1
+
+POOL_CONFIG = {
+    "image": {
+        "max_workers": int(os.environ.get("EMOTION_IMAGE_POOL_WORKERS", str(min(4, _CPU)))),
+        "max_queue": int(os.environ.get("EMOTION_IMAGE_POOL_QUEUE", "32")),
+    },
+    "audio": {
+        "max_workers": int(os.environ.get("EMOTION_AUDIO_POOL_WORKERS", str(min(2, _CPU)))),
+        "max_queue": int(os.environ.get("EMOTION_AUDIO_POOL_QUEUE", "16")),
+    },
+}
+
+
+class PoolSaturated(Exception):
+    """คิวของ pool เต็ม ให้ client ลองใหม่ภายหลัง (HTTP 503)"""
+
+    def __init__(self, pool_name):
+        super().__init__(f"{pool_name} pool is saturated, retry later")
+        self.pool_name = pool_name
+
+
+class StagePool:
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self._capacity = self.max_workers + self.max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix=f"{name}-pool"
+        )
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._rejected = 0
+        self._stages = {}
+
+    def _try_acquire(self):
+        with self._lock:
+            if self._in_flight >= self._capacity:
+                self._rejected += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _record(self, stage, queue_wait, run_time):
+        with self._lock:
+            s = self._stages.get(stage)
+            if s is None:
+                s = self._stages[stage] = {
+                    "calls": 0,
+                    "waits": deque(maxlen=1024),
+                    "runs": deque(maxlen=1024),
+                }
+            s["calls"] += 1
+            s["waits"].append(queue_wait)
+            s["runs"].append(run_time)
+
+    async def run(self, stage, fn, *args, **kwargs):
+        """รัน ``fn(*args, **kwargs)`` บน worker thread ของ pool แล้ว await ผลลัพธ์"""
+        if not self._try_acquire():
+            raise PoolSaturated(self.name)
+        submitted = time.perf_counter()
+        route = current_route.get()
+
+        def call():
+            started = time.perf_counter()
+            queue_wait = started - submitted
+            observe_queue_wait(f"{self.name}_pool", queue_wait)
+            try:
+                return profiler.call(fn, *args, **kwargs)
+            finally:
+                run_time = time.perf_counter() - started
+                self._record(stage, queue_wait, run_time)
+                observe_stage(stage, run_time, route)
+
+        # ส่ง context (เช่น route ของ request) ต่อไปยัง worker thread
+        ctx = contextvars.copy_context()
+        try:
+            future = self._executor.submit(ctx.run, call)
+        except BaseException:
+            self._release()
+            raise
+        # คืน slot เมื่องานบน thread จบจริง (หรือถูกยกเลิกก่อนเริ่ม) ไม่ใช่ตอน coroutine ถูก cancel
+        # เช่น client ตัดการเชื่อมต่อ ไม่งั้น in_flight จะนับต่ำกว่าความจริงและ pool รับงานเกิน
+        future.add_done_callback(lambda _: self._release())
+        return await asyncio.wrap_future(future)
+
+    @contextmanager
+    def timed(self, stage):
+        """จับเวลา stage ที่ไม่ได้รันใน pool นี้โดยตรง (เช่น inference ผ่าน micro-batcher)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._record(stage, 0.0, elapsed)
+            observe_stage(stage, elapsed)
+
+    def stats(self):
+        with self._lock:
+            stages = {
+                stage: {
+                    "calls": s["calls"],
+                    "queue_wait_ms": _avg_ms(s["waits"]),
+                    "run_ms": _avg_ms(s["runs"]),
+                    "run_ms_max": max(s["runs"]) * 1000.0 if s["runs"] else 0.0,
+                }
+                for stage, s in self._stages.items()
+            }
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "rejected": self._rejected,
+                "stages": stages,
+            }
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait)
+
+
+def _avg_ms(values):
+    return (sum(values) / len(values) * 1000.0) if values else 0.0
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    """คืน StagePool ตามชื่อ ("image" หรือ "audio") สร้างครั้งแรกเมื่อถูกเรียก"""
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                cfg = POOL_CONFIG[name]
+                pool = _pools[name] = StagePool(name, cfg["max_workers"], cfg["max_queue"])
+    return pool
+
+
+def configure_pools(**max_workers):
+    """
+    ตั้งจำนวน worker ของ pool ก่อนถูกสร้าง (thread_tuning เรียกตอน startup)
+    pool ที่สร้างไปแล้วหรือตั้งผ่าน EMOTION_*_POOL_WORKERS จะไม่ถูกเปลี่ยน คืนจำนวน worker ที่ใช้จริงทุก pool
+    """
+    with _pools_lock:
+        for name, workers in max_workers.items():
+            if name in _pools or f"EMOTION_{name.upper()}_POOL_WORKERS" in os.environ:
+                continue
+            POOL_CONFIG[name]["max_workers"] = max(1, int(workers))
+        return {
+            name: _pools[name].max_workers if name in _pools else cfg["max_workers"]
+            for name, cfg in POOL_CONFIG.items()
+        }
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+def shutdown_pools(wait=False):
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=wait)
@@ -0,0 +1,265 @@
+"""
+Tiered face detection: Haar on every image, MTCNN only where Haar falls short.
+
+Haar (``face_detector``) costs a few milliseconds per image but misses turned,
+tilted and blurred faces; MTCNN finds them but is an order of magnitude slower.
+``detect_faces_tiered`` runs Haar first and escalates to MTCNN only when Haar
+finds nothing. Setting ``EMOTION_CASCADE_HAAR_MIN_SCORE`` also escalates faces
+whose final-stage weight from ``detectMultiScale3`` falls below it; the scale
+of that weight depends on the Haar preset, so it is off unless calibrated on
+real images for the preset in use. If MTCNN finds nothing at or above
+``EMOTION_MTCNN_MIN_CONFIDENCE`` the Haar boxes are kept, so recall never
+drops below Haar alone.
+
+MTCNN itself is:
+
+- registered in the model registry as ``"mtcnn"`` and warmed at startup, so
+  the TensorFlow import and graph build happen before the first request;
+- run on a copy downscaled to ``EMOTION_MTCNN_MAX_SIDE`` (boxes are mapped back);
+- called through a ``MicroBatcher``: escalations from concurrent detect workers
+  are padded to one shape and passed to ``detect_faces`` as a single batch
+  (mtcnn >= 1.0; older releases get one call per image).
+
+``EMOTION_FACE_DETECTOR=haar`` turns the cascade off. Without the ``mtcnn``
+package installed, ``cascade`` behaves like ``haar``.
+"""
+import importlib.util
+import logging
+import os
+import threading
+import time
+from importlib import metadata
+
+import cv2
+import numpy as np
+
+try:
+    from .batching import MicroBatcher
+    from .face_detector import detect_faces_scored
+    from .metrics import observe_stage
+    from .model_registry import registry
+except ImportError:
+    try:
+        from Backend.batching import MicroBatcher
+        from Backend.face_detector import detect_faces_scored
+        from Backend.metrics import observe_stage
+        from Backend.model_registry import registry
+    except ImportError:
+        from batching import MicroBatcher
+        from face_detector import detect_faces_scored
+        from metrics import observe_stage
+        from model_registry import registry
+
+logger = logging.getLogger(__name__)
+
+# "cascade" = Haar แล้วค่อย MTCNN เมื่อจำเป็น, "haar" = Haar อย่างเดียว
+FACE_DETECTOR = os.environ.get("EMOTION_FACE_DETECTOR", "cascade")
+# ว่าง = ส่งต่อ MTCNN เฉพาะเมื่อ Haar ไม่เจอ; ค่า weight ขึ้นกับ preset ต้อง calibrate ก่อนตั้ง
+_haar_min_score = os.environ.get("EMOTION_CASCADE_HAAR_MIN_SCORE", "").strip()
+HAAR_MIN_SCORE = float(_haar_min_score) if _haar_min_score else None
+MTCNN_MAX_SIDE = int(os.environ.get("EMOTION_MTCNN_MAX_SIDE", "640"))
+MTCNN_MIN_CONFIDENCE = float(os.environ.get("EMOTION_MTCNN_MIN_CONFIDENCE", "0.9"))
+MTCNN_BATCH = int(os.environ.get("EMOTION_MTCNN_BATCH", "8"))
+MTCNN_MAX_WAIT_MS = float(os.environ.get("EMOTION_MTCNN_MAX_WAIT_MS", "5"))
+
+_available = None
+_batch_calls = None
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_tiers = {tier: {"calls": 0, "found": 0, "seconds": 0.0} for tier in ("haar", "mtcnn")}
+_counts = {"images": 0, "result_haar": 0, "result_mtcnn": 0, "no_face": 0,
+           "escalated_miss": 0, "escalated_low_score": 0, "mtcnn_errors": 0}
+
+
+def mtcnn_available():
+    global _available
+    if _available is None:
+        try:
+            _available = importlib.util.find_spec("mtcnn") is not None
+        except ValueError:  # อยู่ใน sys.modules แล้วแต่ไม่มี __spec__
+            _available = True
+        if not _available and FACE_DETECTOR == "cascade":
+            logger.info("mtcnn is not installed: face detection uses the Haar tier only")
+    return _available
+
+
+def cascade_enabled():
+    return FACE_DETECTOR == "cascade" and mtcnn_available()
+
+
+def load_mtcnn():
+    """
+    สร้าง MTCNN แล้วรันภาพใบหน้าสังเคราะห์หนึ่งครั้ง ให้ TensorFlow build graph ของทั้งสามเครือข่าย
+    (P/R/O-Net) ตอน warm-up ไม่ใช่ใน request แรก (ภาพเปล่าจะไปไม่ถึง R/O-Net)
+    """
+    try:
+        from .synthetic import synthetic_face
+    except ImportError:
+        try:
+            from Backend.synthetic import synthetic_face
+        except ImportError:
+            from synthetic import synthetic_face
+    # import ตอนใช้งานจริง: mtcnn ดึง TensorFlow มาด้วยซึ่งช้ามาก
+    from mtcnn import MTCNN
+    detector = MTCNN()
+    side = MTCNN_MAX_SIDE if MTCNN_MAX_SIDE > 0 else 640
+    detector.detect_faces(cv2.cvtColor(synthetic_face(side), cv2.COLOR_BGR2RGB))
+    return detector
+
+
+def get_mtcnn():
+    # ลงทะเบียนเมื่อใช้จริง: โหมด haar จะไม่มี "mtcnn" ค้างสถานะ pending ใน /stats และ /metrics
+    registry.register("mtcnn", load_mtcnn)
+    return registry.get("mtcnn")
+
+
+def warm_up_mtcnn():
+    """โหลด MTCNN ใน background thread ตอน startup (เฉพาะเมื่อเปิดใช้ cascade)"""
+    if cascade_enabled():
+        registry.register("mtcnn", load_mtcnn)
+        registry.warm_up(["mtcnn"])
+
+
+def _supports_batch_calls():
+    # mtcnn >= 1.0 รับ list ของภาพใน detect_faces ได้ รุ่นเก่ารับทีละภาพ
+    global _batch_calls
+    if _batch_calls is None:
+        try:
+            _batch_calls = int(metadata.version("mtcnn").split(".")[0]) >= 1
+        except (metadata.PackageNotFoundError, ValueError):
+            _batch_calls = False
+    return _batch_calls
+
+
+def _detect_batch(images):
+    detector = get_mtcnn()
+    if len(images) == 1 or not _supports_batch_calls():
+        return [detector.detect_faces(img) for img in images]
+    # เติมขอบขวา/ล่างให้ทุกภาพขนาดเท่ากัน: พิกัดของแต่ละภาพจึงไม่เลื่อน
+    H = max(img.shape[0] for img in images)
+    W = max(img.shape[1] for img in images)
+    stacked = []
+    for img in images:
+        if img.shape[:2] != (H, W):
+            padded = np.zeros((H, W, 3), np.uint8)
+            padded[:img.shape[0], :img.shape[1]] = img
+            img = padded
+        stacked.append(img)
+    return list(detector.detect_faces(stacked))
+
+
+def get_mtcnn_batcher():
+    """MicroBatcher ที่ใช้ร่วมกันสำหรับ MTCNN รับภาพ RGB คืนผลดิบของ ``detect_faces``"""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(
+                    _detect_batch, max_batch_size=MTCNN_BATCH, max_wait_ms=MTCNN_MAX_WAIT_MS, name="mtcnn"
+                )
+    return _batcher
+
+
+def mtcnn_boxes(img, min_confidence=MTCNN_MIN_CONFIDENCE, max_side=MTCNN_MAX_SIDE):
+    """
+    ตรวจจับด้วย MTCNN บนภาพ BGR ที่ย่อให้ด้านยาวไม่เกิน ``max_side``
+    คืน list ของ ((x, y, w, h), confidence) ในพิกัดภาพเต็ม เรียงตามความมั่นใจแล้วขนาด
+    """
+    H, W = img.shape[:2]
+    scale = 1.0
+    if max_side and max(H, W) > max_side:
+        scale = max_side / float(max(H, W))
+        img = cv2.resize(img, (max(1, int(W * scale)), max(1, int(H * scale))), interpolation=cv2.INTER_AREA)
+    rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    faces = get_mtcnn_batcher().submit(rgb).result()
+
+    inv = 1.0 / scale
+    scored = []
+    for face in faces:
+        confidence = float(face.get("confidence", 0.0))
+        if confidence < min_confidence:
+            continue
+        x, y, w, h = face["box"]
+        x = min(max(0, int(round(x * inv))), max(0, W - 1))
+        y = min(max(0, int(round(y * inv))), max(0, H - 1))
+        w = max(1, min(int(round(w * inv)), W - x))
+        h = max(1, min(int(round(h * inv)), H - y))
+        scored.append(((x, y, w, h), confidence))
+    scored.sort(key=lambda f: (f[1], f[0][2] * f[0][3]), reverse=True)
+    return scored
+
+
+def _record(tier, seconds, found):
+    observe_stage(f"detect_{tier}", seconds)
+    with _stats_lock:
+        entry = _tiers[tier]
+        entry["calls"] += 1
+        entry["found"] += int(found)
+        entry["seconds"] += seconds
+
+
+def _count(key):
+    with _stats_lock:
+        _counts[key] += 1
+
+
+def detect_faces_tiered(img, preset=None, min_score=HAAR_MIN_SCORE):
+    """
+    ตรวจจับใบหน้าแบบหลายชั้น คืน (list ของ (x, y, w, h) โดยใบหน้าหลักอยู่ก่อน, tier ที่ให้ผล)
+    tier = "haar" / "mtcnn" หรือ None เมื่อไม่พบใบหน้า; preset ใช้กับชั้น Haar
+    """
+    _count("images")
+    started = time.perf_counter()
+    haar = detect_faces_scored(img, preset=preset)
+    _record("haar", time.perf_counter() - started, bool(haar))
+
+    if haar and (min_score is None or haar[0][1] >= min_score):
+        _count("result_haar")
+        return [box for box, _ in haar], "haar"
+    if cascade_enabled():
+        _count("escalated_low_score" if haar else "escalated_miss")
+        started = time.perf_counter()
+        try:
+            found = mtcnn_boxes(img)
+        except Exception as e:
+            _count("mtcnn_errors")
+            logger.warning("MTCNN error, keeping Haar result: %s", e)
+        else:
+            _record("mtcnn", time.perf_counter() - started, bool(found))
+            if found:
+                _count("result_mtcnn")
+                return [box for box, _ in found], "mtcnn"
+    if haar:
+        _count("result_haar")
+        return [box for box, _ in haar], "haar"
+    _count("no_face")
+    return [], None
+
+
+def detector_stats():
+    """อัตราการพบใบหน้าและเวลาเฉลี่ยของแต่ละชั้น และจำนวนภาพที่ต้องส่งต่อให้ MTCNN"""
+    with _stats_lock:
+        tiers = {name: dict(t) for name, t in _tiers.items()}
+        counts = dict(_counts)
+    images = counts["images"]
+    total_seconds = sum(t["seconds"] for t in tiers.values())
+    return {
+        "mode": "cascade" if cascade_enabled() else "haar",
+        "mtcnn_available": mtcnn_available(),
+        "haar_min_score": HAAR_MIN_SCORE,
+        **counts,
+        "escalation_rate": (counts["escalated_miss"] + counts["escalated_low_score"]) / images if images else 0.0,
+        "avg_ms": total_seconds / images * 1000.0 if images else 0.0,
+        "tiers": {
+            name: {
+                "calls": t["calls"],
+                "hit_rate": t["found"] / t["calls"] if t["calls"] else 0.0,
+                "avg_ms": t["seconds"] / t["calls"] * 1000.0 if t["calls"] else 0.0,
+            }
+            for name, t in tiers.items()
+        },
+        "mtcnn_batcher": _batcher.stats() if _batcher is not None else None,
+    }
@@ -0,0 +1,156 @@
+"""
+Haar-cascade face detection with a cached classifier and a downscale-then-refine path.
+
+``cv2.CascadeClassifier`` is not safe to share between threads, so each worker
+thread lazily gets its own instance (the cascade path is resolved once per
+process). Large photos are detected on a reduced copy and the boxes are mapped
+back to full resolution, optionally refined on a small full-resolution ROI.
+``detect_faces_scored`` also returns the cascade's final-stage weight for each
+box; ``face_cascade`` uses it to decide when to escalate to MTCNN.
+"""
+import os
+import threading
+
+import cv2
+
+CASCADE_FILE = os.environ.get(
+    "EMOTION_HAAR_CASCADE",
+    os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"),
+)
+
+# scale_factor / min_neighbors / min_size เป็นพารามิเตอร์ของ detectMultiScale (min_size ในพิกัดภาพเต็ม)
+# max_side: ย่อภาพให้ด้านยาวไม่เกินค่านี้ก่อน detect (None = ใช้ภาพเต็ม)
+# refine: ตรวจซ้ำบน ROI ความละเอียดเต็มรอบกล่องที่ได้ เพื่อให้กรอบแม่นขึ้น
+PRESETS = {
+    "fast": {"scale_factor": 1.2, "min_neighbors": 4, "min_size": 40, "max_side": 640, "refine": False},
+    "balanced": {"scale_factor": 1.1, "min_neighbors": 5, "min_size": 40, "max_side": 960, "refine": True},
+    "accurate": {"scale_factor": 1.1, "min_neighbors": 5, "min_size": 40, "max_side": None, "refine": False},
+}
+DEFAULT_PRESET = os.environ.get("EMOTION_FACE_PRESET", "balanced")
+
+# Haar window ของ frontalface_default คือ 24x24 จึงไม่ควรใช้ minSize เล็กกว่านี้
+_MIN_WINDOW = 24
+
+_local = threading.local()
+_load_lock = threading.Lock()
+_loads = 0
+
+
+def get_cascade():
+    """คืน CascadeClassifier ของเธรดปัจจุบัน (โหลด XML ครั้งเดียวต่อเธรด)"""
+    global _loads
+    cascade = getattr(_local, "cascade", None)
+    if cascade is None:
+        cascade = cv2.CascadeClassifier(CASCADE_FILE)
+        if cascade.empty():
+            raise RuntimeError(f"Failed to load Haar cascade from {CASCADE_FILE}")
+        _local.cascade = cascade
+        with _load_lock:
+            _loads += 1
+    return cascade
+
+
+def cascade_loads():
+    """จำนวนครั้งที่โหลด XML ทั้งโปรเซส (ควรเท่ากับจำนวนเธรดที่เคย detect)"""
+    return _loads
+
+
+def resolve_preset(preset=None):
+    if isinstance(preset, dict):
+        return {**PRESETS[DEFAULT_PRESET], **preset}
+    name = preset or DEFAULT_PRESET
+    if name not in PRESETS:
+        raise ValueError(f"Unknown face detection preset '{name}', expected one of {sorted(PRESETS)}")
+    return PRESETS[name]
+
+
+def to_gray(img):
+    if img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def detect_faces(img, preset=None, gray=None):
+    """
+    ตรวจจับใบหน้าทั้งหมดในภาพ BGR (หรือ grayscale) คืน list ของ (x, y, w, h)
+    ในพิกัดภาพเต็ม เรียงจากใหญ่ไปเล็ก
+    """
+    return [box for box, _ in detect_faces_scored(img, preset=preset, gray=gray)]
+
+
+def detect_faces_scored(img, preset=None, gray=None):
+    """
+    เหมือน detect_faces แต่คืน list ของ ((x, y, w, h), score)
+    score = น้ำหนักของ stage สุดท้ายใน cascade (ใบหน้าชัดๆ ราว 5-7, ใบหน้าเอียง/เบลอหรือ false positive ต่ำกว่า 3)
+    """
+    params = resolve_preset(preset)
+    if gray is None:
+        gray = to_gray(img)
+    H, W = gray.shape[:2]
+
+    scale = 1.0
+    max_side = params.get("max_side")
+    if max_side and max(H, W) > max_side:
+        scale = max_side / float(max(H, W))
+
+    if scale < 1.0:
+        small = cv2.resize(gray, (max(1, int(W * scale)), max(1, int(H * scale))), interpolation=cv2.INTER_AREA)
+    else:
+        small = gray
+    min_side = max(_MIN_WINDOW, int(round(params["min_size"] * scale)))
+
+    # detectMultiScale3 ให้กล่องชุดเดียวกับ detectMultiScale (ต้นทุนเท่ากัน) พร้อมคะแนนของแต่ละกล่อง
+    faces, _, weights = get_cascade().detectMultiScale3(
+        small,
+        scaleFactor=params["scale_factor"],
+        minNeighbors=params["min_neighbors"],
+        minSize=(min_side, min_side),
+        outputRejectLevels=True,
+    )
+    if len(faces) == 0:
+        return []
+
+    scored = []
+    inv = 1.0 / scale
+    for (x, y, w, h), weight in zip(faces, weights):
+        box = (int(round(x * inv)), int(round(y * inv)), int(round(w * inv)), int(round(h * inv)))
+        if scale < 1.0 and params.get("refine"):
+            box = _refine_box(gray, box, params)
+        scored.append((_clamp_box(box, W, H), float(weight)))
+    scored.sort(key=lambda b: b[0][2] * b[0][3], reverse=True)
+    return scored
+
+
+def _refine_box(gray, box, params):
+    """ตรวจซ้ำบน ROI ความละเอียดเต็ม โดยจำกัดช่วงขนาดให้ใกล้กับกล่องเดิม (เร็วเพราะ ROI เล็ก)"""
+    x, y, w, h = box
+    H, W = gray.shape[:2]
+    margin = int(round(0.25 * max(w, h)))
+    x1, y1 = max(0, x - margin), max(0, y - margin)
+    x2, y2 = min(W, x + w + margin), min(H, y + h + margin)
+    roi = gray[y1:y2, x1:x2]
+    if roi.size == 0:
+        return box
+    side = max(w, h)
+    min_side = max(_MIN_WINDOW, int(side * 0.75))
+    max_side = max(min_side + 1, int(side * 1.3))
+    found = get_cascade().detectMultiScale(
+        roi,
+        scaleFactor=1.05,
+        minNeighbors=max(1, params["min_neighbors"] - 2),
+        minSize=(min_side, min_side),
+        maxSize=(max_side, max_side),
+    )
+    if len(found) == 0:
+        return box
+    rx, ry, rw, rh = max(found, key=lambda b: b[2] * b[3])
+    return (int(x1 + rx), int(y1 + ry), int(rw), int(rh))
+
+
+def _clamp_box(box, W, H):
+    x, y, w, h = box
+    x = min(max(0, x), max(0, W - 1))
+    y = min(max(0, y), max(0, H - 1))
+    w = max(1, min(w, W - x))
+    h = max(1, min(h, H - y))
+    return (x, y, w, h)
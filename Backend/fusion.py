@@ -0,0 +1,202 @@
+"""
+Late fusion of the image and audio emotion models.
+
+The two ResNet18 heads list the same seven emotions in different orders, so
+each model's softmax output is first reordered onto ``SHARED_LABELS``. Fusion
+then happens on those aligned probability vectors:
+
+- ``weighted`` (default): temperature-calibrated weighted average,
+  ``p = w_img * p_img^(1/T_img) + w_aud * p_aud^(1/T_aud)`` (each term
+  renormalised). Weights/temperatures come from ``EMOTION_FUSION_*``.
+- ``learned``: a multinomial logistic-regression layer over the concatenated
+  log-probabilities, loaded from the JSON file in ``EMOTION_FUSION_WEIGHTS``
+  and trained with ``fit_learned_fusion`` (``python -m Backend.fusion``).
+
+The reported confidence is the fused probability of the winning label.
+"""
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SHARED_LABELS = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
+
+FUSION_MODE = os.environ.get("EMOTION_FUSION_MODE", "weighted")
+FUSION_WEIGHTS_PATH = os.environ.get("EMOTION_FUSION_WEIGHTS", "")
+IMAGE_WEIGHT = float(os.environ.get("EMOTION_FUSION_IMAGE_WEIGHT", "0.6"))
+AUDIO_WEIGHT = float(os.environ.get("EMOTION_FUSION_AUDIO_WEIGHT", "0.4"))
+# T > 1 ทำให้การกระจายแบนลง (ลดความมั่นใจเกินจริง), T < 1 ทำให้คมขึ้น
+IMAGE_TEMPERATURE = float(os.environ.get("EMOTION_FUSION_IMAGE_TEMP", "1.0"))
+AUDIO_TEMPERATURE = float(os.environ.get("EMOTION_FUSION_AUDIO_TEMP", "1.0"))
+
+_EPS = 1e-7
+
+
+def to_shared(probs, class_names, labels=SHARED_LABELS):
+    """
+    เรียงความน่าจะเป็นจากลำดับคลาสของโมเดล (``class_names``) ให้ตรงกับ ``labels``
+    คลาสที่โมเดลไม่มีได้ค่า 0 แล้ว normalise ใหม่
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    index = {name: i for i, name in enumerate(class_names)}
+    out = np.array([probs[..., index[l]] if l in index else np.zeros(probs.shape[:-1]) for l in labels])
+    out = np.moveaxis(out, 0, -1)
+    total = out.sum(axis=-1, keepdims=True)
+    return out / np.maximum(total, _EPS)
+
+
+def calibrate(probs, temperature):
+    """temperature scaling บนความน่าจะเป็น (เท่ากับ softmax(logits / T))"""
+    if temperature == 1.0:
+        return probs
+    scaled = np.power(np.maximum(probs, _EPS), 1.0 / temperature)
+    return scaled / scaled.sum(axis=-1, keepdims=True)
+
+
+class WeightedFusion:
+    mode = "weighted"
+
+    def __init__(self, image_weight=IMAGE_WEIGHT, audio_weight=AUDIO_WEIGHT,
+                 image_temperature=IMAGE_TEMPERATURE, audio_temperature=AUDIO_TEMPERATURE):
+        total = image_weight + audio_weight
+        if total <= 0:
+            raise ValueError("fusion weights must sum to a positive value")
+        self.image_weight = image_weight / total
+        self.audio_weight = audio_weight / total
+        self.image_temperature = image_temperature
+        self.audio_temperature = audio_temperature
+
+    def __call__(self, image_probs, audio_probs):
+        return (self.image_weight * calibrate(image_probs, self.image_temperature)
+                + self.audio_weight * calibrate(audio_probs, self.audio_temperature))
+
+    def config(self):
+        return {
+            "mode": self.mode,
+            "image_weight": self.image_weight,
+            "audio_weight": self.audio_weight,
+            "image_temperature": self.image_temperature,
+            "audio_temperature": self.audio_temperature,
+        }
+
+
+class LearnedFusion:
+    """logistic regression: softmax(W @ [log p_img, log p_aud] + b)"""
+    mode = "learned"
+
+    def __init__(self, weight, bias, labels=SHARED_LABELS):
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.bias = np.asarray(bias, dtype=np.float64)
+        if sorted(labels) != sorted(SHARED_LABELS):
+            raise ValueError(f"learned fusion labels {list(labels)} are not a permutation of {SHARED_LABELS}")
+        n = len(labels)
+        if self.weight.shape != (n, 2 * n) or self.bias.shape != (n,):
+            raise ValueError(f"learned fusion expects W[{n}, {2 * n}] and b[{n}]")
+        self.labels = list(labels)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["weight"], data["bias"], data.get("labels", SHARED_LABELS))
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"labels": self.labels, "weight": self.weight.tolist(), "bias": self.bias.tolist()}, f)
+
+    def __call__(self, image_probs, audio_probs):
+        if self.labels == SHARED_LABELS:
+            x = _features(image_probs, audio_probs)
+            return _softmax(x @ self.weight.T + self.bias)
+        # น้ำหนักถูกเทรนด้วยลำดับ label อื่น: จัดอินพุตเข้าลำดับนั้นแล้วจัดผลกลับเป็น SHARED_LABELS
+        x = _features(to_shared(image_probs, SHARED_LABELS, self.labels),
+                      to_shared(audio_probs, SHARED_LABELS, self.labels))
+        return to_shared(_softmax(x @ self.weight.T + self.bias), self.labels)
+
+    def config(self):
+        return {"mode": self.mode, "weights": FUSION_WEIGHTS_PATH or None}
+
+
+def _features(image_probs, audio_probs):
+    return np.concatenate([np.log(np.maximum(image_probs, _EPS)), np.log(np.maximum(audio_probs, _EPS))], axis=-1)
+
+
+def _softmax(z):
+    z = z - z.max(axis=-1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def fit_learned_fusion(image_probs, audio_probs, labels, l2=1e-3, lr=0.5, epochs=500):
+    """
+    เรียนรู้ LearnedFusion จากผลของทั้งสองโมเดลบนชุด validation
+    ``image_probs``/``audio_probs`` [N, C] เรียงตาม SHARED_LABELS แล้ว, ``labels`` [N] เป็น index
+    """
+    x = _features(np.asarray(image_probs, dtype=np.float64), np.asarray(audio_probs, dtype=np.float64))
+    y = np.asarray(labels, dtype=np.int64)
+    n, c = x.shape[0], len(SHARED_LABELS)
+    onehot = np.eye(c)[y]
+    # เริ่มจากค่าเฉลี่ยของ log-prob ทั้งสองโมเดล (เท่ากับ product-of-experts)
+    weight = np.hstack([np.eye(c), np.eye(c)]) * 0.5
+    bias = np.zeros(c)
+    for _ in range(epochs):
+        grad = (_softmax(x @ weight.T + bias) - onehot) / n
+        weight -= lr * (grad.T @ x + l2 * weight)
+        bias -= lr * grad.sum(axis=0)
+    return LearnedFusion(weight, bias)
+
+
+_fusion = None
+
+
+def get_fusion():
+    """fusion ที่ตั้งค่าไว้ (learned ถ้ามีไฟล์น้ำหนักที่ใช้ได้ ไม่เช่นนั้น weighted)"""
+    global _fusion
+    if _fusion is None:
+        fusion = None
+        if FUSION_MODE == "learned":
+            try:
+                fusion = LearnedFusion.load(FUSION_WEIGHTS_PATH)
+            except Exception as e:
+                logger.warning("learned fusion unavailable (%s), using weighted", e)
+        _fusion = fusion or WeightedFusion()
+    return _fusion
+
+
+def fuse(image_probs, image_classes, audio_probs, audio_classes, fusion=None):
+    """
+    รวมผลสองโมเดล คืน dict: emotion, confidence, probabilities (ต่อ label) และ
+    image_/audio_emotion พร้อม confidence ของแต่ละโมเดลหลังจัดลำดับคลาสแล้ว
+    """
+    fusion = fusion or get_fusion()
+    p_img = to_shared(image_probs, image_classes)
+    p_aud = to_shared(audio_probs, audio_classes)
+    fused = fusion(p_img, p_aud)
+    best = int(np.argmax(fused))
+    return {
+        "emotion": SHARED_LABELS[best],
+        "confidence": float(fused[best]),
+        "image_emotion": SHARED_LABELS[int(np.argmax(p_img))],
+        "image_confidence": float(p_img.max()),
+        "audio_emotion": SHARED_LABELS[int(np.argmax(p_aud))],
+        "audio_confidence": float(p_aud.max()),
+        "probabilities": {label: float(p) for label, p in zip(SHARED_LABELS, fused)},
+        "fusion": fusion.mode,
+    }
+
+
+if __name__ == "__main__":
+    # python -m Backend.fusion val.npz fusion.json
+    # val.npz: image_probs [N, 7], audio_probs [N, 7] (ลำดับ SHARED_LABELS), labels [N]
+    if len(sys.argv) != 3:
+        print("usage: python -m Backend.fusion <validation.npz> <out.json>")
+        sys.exit(2)
+    data = np.load(sys.argv[1])
+    model = fit_learned_fusion(data["image_probs"], data["audio_probs"], data["labels"])
+    pred = model(data["image_probs"], data["audio_probs"]).argmax(axis=1)
+    print(f"train accuracy: {(pred == data['labels']).mean():.3f}")
+    model.save(sys.argv[2])
@@ -0,0 +1,155 @@
+"""
+Image decoding with a bounded working resolution.
+
+The models only ever see a 224x224 face crop, so decoding a 12 MP phone photo
+at full size wastes both time and memory. ``decode_image`` first sniffs the
+pixel size from the file header (JPEG SOF, PNG IHDR, GIF, BMP, WebP) without
+decoding, then:
+
+- picks the largest ``IMREAD_REDUCED_COLOR_{2,4,8}`` factor that still keeps
+  the long side at or above ``EMOTION_IMAGE_MAX_SIDE``. For JPEG, libjpeg does
+  this scaling in the DCT domain, so the full-size bitmap is never allocated;
+- area-resizes the remainder down to ``EMOTION_IMAGE_MAX_SIDE``;
+- rejects images over ``EMOTION_IMAGE_MAX_PIXELS`` before decoding (decompression bombs).
+
+It returns ``(img, scale)`` where ``scale`` maps coordinates in the decoded
+image back to the original (``original = decoded * scale``), so face
+coordinates reported to clients stay in the uploaded image's pixel space.
+"""
+import os
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+MAX_DECODE_SIDE = int(os.environ.get("EMOTION_IMAGE_MAX_SIDE", "1280"))
+MAX_IMAGE_PIXELS = int(os.environ.get("EMOTION_IMAGE_MAX_PIXELS", str(100_000_000)))
+
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+# SOF0..SOF15 ยกเว้น DHT (C4), JPG (C8), DAC (CC)
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_stats_lock = threading.Lock()
+_path_counts = {"full": 0, "reduced_2": 0, "reduced_4": 0, "reduced_8": 0, "resized": 0}
+
+
+class ImageDecodeError(ValueError):
+    """ไฟล์ภาพเสียหาย ไม่รองรับ หรือใหญ่เกินกำหนด"""
+
+
+def _count(path):
+    with _stats_lock:
+        _path_counts[path] += 1
+
+
+def decode_stats():
+    with _stats_lock:
+        return dict(_path_counts)
+
+
+def _jpeg_size(data):
+    i, n = 2, len(data)
+    while i + 9 < n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in _JPEG_SOF:
+            h, w = struct.unpack(">HH", data[i + 5:i + 9])
+            return w, h
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # marker ที่ไม่มี length
+            i += 2
+            continue
+        i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+def _webp_size(data):
+    chunk = data[12:16]
+    if chunk == b"VP8X" and len(data) >= 30:
+        return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+    if chunk == b"VP8 " and len(data) >= 30:
+        w, h = struct.unpack("<HH", data[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    return None
+
+
+def image_size(data):
+    """อ่าน (width, height) จาก header โดยไม่ถอดรหัสภาพ คืน None ถ้าไม่รู้จัก format"""
+    try:
+        if data[:2] == b"\xff\xd8":
+            return _jpeg_size(data)
+        if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+            return struct.unpack(">II", data[16:24])
+        if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+            return struct.unpack("<HH", data[6:10])
+        if data[:2] == b"BM" and len(data) >= 26:
+            w, h = struct.unpack("<ii", data[18:26])
+            return abs(w), abs(h)
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return _webp_size(data)
+    except struct.error:
+        return None
+    return None
+
+
+def reduction_factor(width, height, max_side=MAX_DECODE_SIDE):
+    """ตัวหารที่ใหญ่สุดใน 8/4/2 ที่ยังทำให้ด้านยาวไม่ต่ำกว่า ``max_side`` (1 = ถอดรหัสเต็มขนาด)"""
+    if max_side <= 0:
+        return 1
+    long_side = max(width, height)
+    for factor, _ in _REDUCED_FLAGS:
+        if long_side // factor >= max_side:
+            return factor
+    return 1
+
+
+def decode_image(data, max_side=MAX_DECODE_SIDE):
+    """
+    ถอดรหัสภาพ (BGR) โดยด้านยาวไม่เกิน ``max_side`` คืน (img, scale)
+    ``scale`` = ขนาดจริง / ขนาดที่ถอดรหัส ใช้แปลงพิกัดกลับ; คืน (None, 1.0) ถ้าถอดรหัสไม่ได้
+    """
+    buf = np.frombuffer(data, np.uint8)
+    size = image_size(data)
+    factor = 1
+    if size is not None:
+        width, height = size
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ImageDecodeError(f"image is {width}x{height}, over {MAX_IMAGE_PIXELS} pixels")
+        factor = reduction_factor(width, height, max_side)
+
+    flag = dict(_REDUCED_FLAGS).get(factor, cv2.IMREAD_COLOR)
+    img = cv2.imdecode(buf, flag)
+    if img is None:
+        return None, 1.0
+    _count(f"reduced_{factor}" if factor > 1 else "full")
+
+    decoded_long = max(img.shape[:2])
+    if max_side > 0 and decoded_long > max_side:
+        ratio = max_side / decoded_long
+        img = cv2.resize(
+            img, (max(1, round(img.shape[1] * ratio)), max(1, round(img.shape[0] * ratio))),
+            interpolation=cv2.INTER_AREA,
+        )
+        _count("resized")
+    # ใช้ขนาดจาก header เมื่อมี (แม่นกว่า เพราะ reduced decode ปัดเศษขึ้น); EXIF อาจสลับด้าน จึงเทียบด้านยาว
+    original_long = max(size) if size is not None else decoded_long
+    return img, original_long / max(img.shape[:2])
+
+
+def scale_coords(coords, scale):
+    """แปลง (x, y, w, h) จากภาพที่ถอดรหัสกลับเป็นพิกัดของภาพต้นฉบับ"""
+    if scale == 1.0:
+        return coords
+    return tuple(int(round(v * scale)) for v in coords)
+
+
+def scale_faces(faces, scale):
+    """ใช้ scale_coords กับ list ของ (face_rgb, coords)"""
+    return [(face, scale_coords(coords, scale)) for face, coords in faces]
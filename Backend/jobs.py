@@ -0,0 +1,652 @@
+"""
+Asynchronous job API for long audio and bulk workloads.
+
+``POST /jobs/<endpoint>`` stores the uploads under ``EMOTION_JOBS_DIR`` and
+returns ``202`` with a job id right away. The id can then be polled
+(``GET /jobs/{id}``), its result fetched (``GET /jobs/{id}/result``) or the job
+cancelled (``DELETE /jobs/{id}``). State lives in a SQLite file (WAL mode), so
+jobs survive restarts and every uvicorn worker on the host serves the same queue.
+
+Background worker threads (``EMOTION_JOB_WORKERS`` per process) claim the
+highest-priority queued job atomically, under a lease that is renewed at every
+chunk boundary and requeued if the process dies. A worker whose lease has lapsed
+cannot overwrite the outcome of the attempt that replaced it. Results are kept for ``ttl_s`` seconds and then purged along with
+their row. Cancellation is immediate for queued jobs; running jobs stop at the
+next chunk boundary.
+
+Jobs never use the interactive executor pools. Their threads run at a lower OS
+priority (``EMOTION_JOB_NICE``) and pause between chunks while those pools are
+full, so ``/predict`` latency is unaffected by a large backlog. Submissions are
+rate-limited per client with a token bucket (``EMOTION_JOB_RATE_PER_MIN``,
+``EMOTION_JOB_RATE_BURST``) and capped at ``EMOTION_JOB_MAX_QUEUED_PER_CLIENT``
+open jobs.
+"""
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+try:
+    from .audio_io import decode_audio_bytes
+    from .audio_stream import StreamingEmotionAnalyzer
+    from .batch_predict import expand_upload, check_item_count, BATCH_CHUNK_SIZE
+    from .executors import pool_stats
+    from .fusion import fuse
+    from .image_io import decode_image, scale_coords
+    from .metrics import current_route, observe_stage
+    from .model_audio import (
+        preprocess_audio, predict_mfcc_proba, predict_mfcc_batch, predict_audio_batch, classes as audio_classes,
+    )
+    from .model_image import classes as image_classes
+    from .model_runtime import get_runtime
+    from .uploads import spool_upload
+    from .utlis import detect_and_crop_face, predict_face_images_proba
+except ImportError:
+    try:
+        from Backend.audio_io import decode_audio_bytes
+        from Backend.audio_stream import StreamingEmotionAnalyzer
+        from Backend.batch_predict import expand_upload, check_item_count, BATCH_CHUNK_SIZE
+        from Backend.executors import pool_stats
+        from Backend.fusion import fuse
+        from Backend.image_io import decode_image, scale_coords
+        from Backend.metrics import current_route, observe_stage
+        from Backend.model_audio import (
+            preprocess_audio, predict_mfcc_proba, predict_mfcc_batch, predict_audio_batch,
+            classes as audio_classes,
+        )
+        from Backend.model_image import classes as image_classes
+        from Backend.model_runtime import get_runtime
+        from Backend.uploads import spool_upload
+        from Backend.utlis import detect_and_crop_face, predict_face_images_proba
+    except ImportError:
+        from audio_io import decode_audio_bytes
+        from audio_stream import StreamingEmotionAnalyzer
+        from batch_predict import expand_upload, check_item_count, BATCH_CHUNK_SIZE
+        from executors import pool_stats
+        from fusion import fuse
+        from image_io import decode_image, scale_coords
+        from metrics import current_route, observe_stage
+        from model_audio import (
+            preprocess_audio, predict_mfcc_proba, predict_mfcc_batch, predict_audio_batch, classes as audio_classes,
+        )
+        from model_image import classes as image_classes
+        from model_runtime import get_runtime
+        from uploads import spool_upload
+        from utlis import detect_and_crop_face, predict_face_images_proba
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = Path(os.environ.get("EMOTION_JOBS_DIR", str(Path(__file__).resolve().parent / ".jobs")))
+JOBS_DB = os.environ.get("EMOTION_JOBS_DB", str(JOBS_DIR / "jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("EMOTION_JOB_WORKERS", "1"))
+JOB_RESULT_TTL_S = float(os.environ.get("EMOTION_JOB_RESULT_TTL_S", "3600"))
+JOB_MAX_TTL_S = float(os.environ.get("EMOTION_JOB_MAX_TTL_S", str(7 * 24 * 3600)))
+# job ที่ไม่ต่อ lease เกินเวลานี้ (โปรเซสตาย) จะถูกนำกลับเข้าคิว; worker ต่อ lease ทุก chunk
+JOB_LEASE_S = float(os.environ.get("EMOTION_JOB_LEASE_S", "1800"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("EMOTION_JOB_MAX_ATTEMPTS", "2"))
+JOB_RATE_PER_MIN = float(os.environ.get("EMOTION_JOB_RATE_PER_MIN", "30"))
+JOB_RATE_BURST = int(os.environ.get("EMOTION_JOB_RATE_BURST", "10"))
+JOB_MAX_QUEUED_PER_CLIENT = int(os.environ.get("EMOTION_JOB_MAX_QUEUED_PER_CLIENT", "50"))
+JOB_NICE = int(os.environ.get("EMOTION_JOB_NICE", "10"))
+# หยุดรอระหว่าง chunk ได้นานสุดเท่านี้เมื่อ pool ของ request ปกติเต็ม
+JOB_YIELD_MAX_S = float(os.environ.get("EMOTION_JOB_YIELD_MAX_S", "2"))
+JOB_POLL_S = 0.5
+JOB_PRIORITY_RANGE = (-10, 10)
+
+STATES = ("queued", "running", "done", "failed", "cancelled")
+FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """job ถูกยกเลิกระหว่างรัน"""
+
+
+class JobLeaseLost(Exception):
+    """lease หมดอายุและ job ถูกนำกลับเข้าคิว/ปิดไปแล้ว: worker นี้ต้องทิ้งงานโดยไม่บันทึกผล"""
+
+
+class JobInputError(ValueError):
+    """อินพุตของ job ไม่ถูกต้อง (รายงานเป็น failed โดยไม่ลองใหม่)"""
+
+
+# ---------------- store ----------------
+class JobStore:
+    """คิวงานบน SQLite ใช้ร่วมกันหลายโปรเซส (WAL mode, หนึ่ง connection ต่อเธรด)"""
+
+    def __init__(self, path=JOBS_DB, payload_root=JOBS_DIR / "payloads"):
+        self.path = str(path)
+        self.payload_root = Path(payload_root)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.payload_root.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, state TEXT NOT NULL,"
+            " priority INTEGER NOT NULL DEFAULT 0, params TEXT NOT NULL, inputs TEXT NOT NULL,"
+            " client TEXT, result TEXT, error TEXT, progress TEXT,"
+            " cancel INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL, started REAL, finished REAL, lease_until REAL,"
+            " ttl_s REAL NOT NULL, expires REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs(state, priority DESC, created)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_expires ON jobs(expires)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def payload_dir(self, job_id):
+        path = self.payload_root / job_id
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _drop_payload(self, job_id):
+        shutil.rmtree(self.payload_root / job_id, ignore_errors=True)
+
+    def submit(self, job_id, kind, inputs, params, priority=0, client=None, ttl_s=JOB_RESULT_TTL_S):
+        self._conn().execute(
+            "INSERT INTO jobs (id, kind, state, priority, params, inputs, client, created, ttl_s)"
+            " VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, int(priority), json.dumps(params), json.dumps(inputs), client, time.time(), float(ttl_s)),
+        )
+
+    def claim(self, now=None):
+        """หยิบ job ที่ priority สูงสุด (มาก่อนได้ก่อน) แบบ atomic ระหว่างโปรเซส คืน dict หรือ None"""
+        now = time.time() if now is None else now
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # lease หมดอายุ = worker ที่ถืออยู่ตายไปแล้ว: ลองใหม่หรือปิดเป็น failed
+            conn.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END,"
+                " error = CASE WHEN attempts < ? THEN error ELSE 'worker lost' END,"
+                " finished = CASE WHEN attempts < ? THEN NULL ELSE ? END,"
+                " expires = CASE WHEN attempts < ? THEN NULL ELSE ? + ttl_s END"
+                " WHERE state = 'running' AND lease_until < ?",
+                (JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, JOB_MAX_ATTEMPTS, now, JOB_MAX_ATTEMPTS, now, now),
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' ORDER BY priority DESC, created LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', started = ?, lease_until = ?, attempts = attempts + 1"
+                    " WHERE id = ?",
+                    (now, now + JOB_LEASE_S, row["id"]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job = dict(row)
+        job["attempts"] += 1  # row ถูกอ่านก่อน UPDATE
+        job["params"] = json.loads(job["params"])
+        job["inputs"] = json.loads(job["inputs"])
+        return job
+
+    def renew_lease(self, job_id, attempt, now=None):
+        """ต่อ lease ของ attempt ที่ถืออยู่ คืน False ถ้า lease หลุดไปแล้ว (job ถูกนำกลับเข้าคิวหรือปิดแล้ว)"""
+        now = time.time() if now is None else now
+        cur = self._conn().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND state = 'running' AND attempts = ?",
+            (now + JOB_LEASE_S, job_id, attempt),
+        )
+        return cur.rowcount > 0
+
+    def _close(self, job_id, attempt, state, result=None, error=None):
+        # ปิดได้เฉพาะ attempt ที่ยังถือ lease: worker ที่ช้าจนถูกแทนที่จะไม่เขียนทับผลของ attempt ใหม่
+        now = time.time()
+        cur = self._conn().execute(
+            "UPDATE jobs SET state = ?, result = ?, error = ?, finished = ?, lease_until = NULL,"
+            " expires = ? + ttl_s WHERE id = ? AND state = 'running' AND attempts = ?",
+            (state, None if result is None else json.dumps(result), error, now, now, job_id, attempt),
+        )
+        if not cur.rowcount:
+            logger.warning("job %s attempt %d lost its lease, %s result discarded", job_id, attempt, state)
+            return False
+        self._drop_payload(job_id)
+        return True
+
+    def finish(self, job_id, attempt, result):
+        if not self._close(job_id, attempt, "done", result=result):
+            return False
+        # งานเสร็จแล้ว: progress = 100%
+        self._conn().execute(
+            "UPDATE jobs SET progress = json_set(progress, '$.done', json_extract(progress, '$.total'))"
+            " WHERE id = ? AND progress IS NOT NULL",
+            (job_id,),
+        )
+        return True
+
+    def fail(self, job_id, attempt, error):
+        return self._close(job_id, attempt, "failed", error=error)
+
+    def mark_cancelled(self, job_id, attempt):
+        return self._close(job_id, attempt, "cancelled")
+
+    def set_progress(self, job_id, done, total):
+        self._conn().execute(
+            "UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps({"done": done, "total": total}), job_id)
+        )
+
+    def cancel_requested(self, job_id):
+        row = self._conn().execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is None or bool(row["cancel"])
+
+    def cancel(self, job_id):
+        """ยกเลิก job: ที่ยังรอคิวยกเลิกทันที ที่กำลังรันจะหยุดที่ chunk ถัดไป คืน state ใหม่หรือ None"""
+        conn = self._conn()
+        cur = conn.execute(
+            "UPDATE jobs SET state = 'cancelled', cancel = 1, finished = ?, expires = ? + ttl_s"
+            " WHERE id = ? AND state = 'queued'",
+            (time.time(), time.time(), job_id),
+        )
+        if cur.rowcount:
+            self._drop_payload(job_id)
+            return "cancelled"
+        conn.execute("UPDATE jobs SET cancel = 1 WHERE id = ? AND state = 'running'", (job_id,))
+        row = conn.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else row["state"]
+
+    def get(self, job_id, now=None):
+        now = time.time() if now is None else now
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (row["expires"] is not None and row["expires"] <= now):
+            return None
+        job = dict(row)
+        if job["state"] == "queued":
+            job["position"] = self._conn().execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND"
+                " (priority > ? OR (priority = ? AND created < ?))",
+                (job["priority"], job["priority"], job["created"]),
+            ).fetchone()[0]
+        return job
+
+    def open_jobs_for(self, client):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE client = ? AND state IN ('queued', 'running')", (client,)
+        ).fetchone()[0]
+
+    def purge_expired(self, now=None):
+        now = time.time() if now is None else now
+        conn = self._conn()
+        ids = [r["id"] for r in conn.execute("SELECT id FROM jobs WHERE expires <= ?", (now,))]
+        if ids:
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(i,) for i in ids])
+            for job_id in ids:
+                self._drop_payload(job_id)
+        return len(ids)
+
+    def counts(self):
+        rows = self._conn().execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update({r["state"]: r["n"] for r in rows})
+        return counts
+
+
+def public_view(job):
+    """ข้อมูล job สำหรับตอบ client (ไม่รวม path ของไฟล์และผลลัพธ์)"""
+    view = {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "state": job["state"],
+        "priority": job["priority"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+        "expires": job["expires"],
+        "attempts": job["attempts"],
+        "progress": json.loads(job["progress"]) if job.get("progress") else None,
+    }
+    if job.get("error"):
+        view["error"] = job["error"]
+    if "position" in job:
+        view["queue_position"] = job["position"]
+    if job["state"] == "running" and job["cancel"]:
+        view["cancel_requested"] = True
+    return view
+
+
+async def save_uploads(store, job_id, uploads, limit):
+    """คัดลอก ``[(field, UploadFile)]`` ลงโฟลเดอร์ของ job ทีละ chunk คืนรายการ inputs"""
+    directory = store.payload_dir(job_id)
+    inputs = []
+    try:
+        for field, upload in uploads:
+            suffix = os.path.splitext(upload.filename or "")[1].lower()
+            path = await spool_upload(upload, limit, suffix=suffix, dir=directory)
+            inputs.append({"field": field, "filename": upload.filename or field, "path": path})
+    except BaseException:
+        store._drop_payload(job_id)
+        raise
+    return inputs
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+# ---------------- rate limiting ----------------
+class RateLimiter:
+    """token bucket ต่อ client: ``rate_per_min`` ครั้งต่อนาที ยืมล่วงหน้าได้ ``burst`` ครั้ง"""
+
+    def __init__(self, rate_per_min=JOB_RATE_PER_MIN, burst=JOB_RATE_BURST, max_clients=10000):
+        self.rate = max(1e-9, rate_per_min / 60.0)
+        self.burst = max(1, int(burst))
+        self.max_clients = max_clients
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, client, now=None):
+        """คืน 0 ถ้าผ่าน ไม่เช่นนั้นคืนจำนวนวินาทีที่ต้องรอ"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.get(client, (float(self.burst), now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1.0:
+                self._buckets[client] = (tokens - 1.0, now)
+                if len(self._buckets) > self.max_clients:
+                    self._prune(now)
+                return 0.0
+            self._buckets[client] = (tokens, now)
+            return (1.0 - tokens) / self.rate
+
+    def _prune(self, now):
+        # bucket ที่เต็มแล้วไม่ต่างจากไม่มี bucket
+        full = [c for c, (t, last) in self._buckets.items() if t + (now - last) * self.rate >= self.burst]
+        for client in full:
+            del self._buckets[client]
+
+
+# ---------------- handlers ----------------
+class JobContext:
+    def __init__(self, store, job):
+        self.store = store
+        self.job = job
+
+    def check(self, done=None, total=None):
+        """เรียกระหว่าง chunk: ต่อ lease, บันทึกความคืบหน้า, หยุดถ้าถูกยกเลิก, หลีกทางให้ request ปกติ"""
+        if not self.store.renew_lease(self.job["id"], self.job["attempts"]):
+            raise JobLeaseLost()
+        if done is not None:
+            self.store.set_progress(self.job["id"], done, total)
+        if self.store.cancel_requested(self.job["id"]):
+            raise JobCancelled()
+        _yield_to_interactive()
+
+    def read(self, item):
+        with open(item["path"], "rb") as f:
+            return f.read()
+
+
+def _yield_to_interactive(max_wait=JOB_YIELD_MAX_S):
+    deadline = time.monotonic() + max_wait
+    while time.monotonic() < deadline:
+        if not any(p["in_flight"] >= p["max_workers"] for p in pool_stats().values()):
+            return
+        time.sleep(0.02)
+
+
+def _input(job, field):
+    for item in job["inputs"]:
+        if item["field"] == field:
+            return item
+    raise JobInputError(f"missing input '{field}'")
+
+
+def _items(job, ctx):
+    items = []
+    for item in job["inputs"]:
+        items.extend(expand_upload(item["filename"], ctx.read(item)))
+    check_item_count(items)
+    return items
+
+
+def _summary(results):
+    succeeded = sum(1 for r in results if "error" not in r)
+    return {"count": len(results), "succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
+
+def run_audio_job(job, ctx):
+    """ไฟล์เสียงยาว: ผลแบบ /predict-audio + อารมณ์ต่อหน้าต่างตลอดทั้งไฟล์"""
+    item = _input(job, "file")
+    waveform, sr = decode_audio_bytes(ctx.read(item), item["filename"])
+    emotion = audio_classes[int(np.argmax(predict_mfcc_proba(preprocess_audio(waveform, sr))[0]))]
+    analyzer = StreamingEmotionAnalyzer(sr, predict_mfcc_batch)
+    mono = waveform.mean(dim=0)
+    windows = []
+    step = sr * 10  # ครั้งละ 10 วินาที
+    for start in range(0, mono.numel(), step):
+        ctx.check(start, mono.numel())
+        windows.extend(analyzer.feed(mono[start:start + step]))
+    windows.extend(analyzer.finish())
+    votes = Counter(w["emotion"] for w in windows)
+    return {
+        "emotion": emotion,
+        "duration_s": round(mono.numel() / sr, 3),
+        "dominant_emotion": votes.most_common(1)[0][0] if votes else emotion,
+        "windows": windows,
+    }
+
+
+def run_both_job(job, ctx):
+    """ผลแบบ /predict-both (ไม่รวมภาพใบหน้าที่ครอป)"""
+    image, audio = _input(job, "image"), _input(job, "audio")
+    img, scale = decode_image(ctx.read(image))
+    if img is None:
+        raise JobInputError("Invalid image")
+    face, coords = detect_and_crop_face(img, use_anime_detection=False)
+    if face is None:
+        raise JobInputError("No face detected")
+    image_probs = predict_face_images_proba([face], get_runtime("image"))[0]
+    ctx.check()
+    waveform, sr = decode_audio_bytes(ctx.read(audio), audio["filename"])
+    audio_probs = predict_mfcc_proba(preprocess_audio(waveform, sr))[0]
+    result = fuse(image_probs, image_classes, audio_probs, audio_classes)
+    x, y, w, h = scale_coords(coords, scale)
+    result["face_coords"] = {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}
+    return result
+
+
+def run_image_batch_job(job, ctx):
+    """ผลแบบ /predict/batch (ตอบเป็น JSON เดียว)"""
+    items = _items(job, ctx)
+    preset = job["params"].get("preset")
+    results = []
+    for start in range(0, len(items), BATCH_CHUNK_SIZE):
+        ctx.check(start, len(items))
+        faces, slots = [], []
+        for i, (name, data) in enumerate(items[start:start + BATCH_CHUNK_SIZE]):
+            entry = {"index": start + i, "filename": name}
+            results.append(entry)
+            try:
+                img, scale = decode_image(data)
+                if img is None:
+                    raise ValueError("Invalid image")
+                face, coords = detect_and_crop_face(img, use_anime_detection=False, preset=preset)
+            except Exception as e:
+                entry["error"] = str(e) or type(e).__name__
+                continue
+            if face is None:
+                entry["error"] = "No face detected"
+                continue
+            x, y, w, h = scale_coords(coords, scale)
+            entry["face_coords"] = {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}
+            faces.append(face)
+            slots.append(entry)
+        if faces:
+            probs = predict_face_images_proba(faces, get_runtime("image"))
+            for entry, p in zip(slots, probs):
+                entry["emotion"] = image_classes[int(np.argmax(p))]
+    return _summary(results)
+
+
+def run_audio_batch_job(job, ctx):
+    """ผลแบบ /predict-audio/batch (ตอบเป็น JSON เดียว)"""
+    items = _items(job, ctx)
+    results = []
+    for start in range(0, len(items), BATCH_CHUNK_SIZE):
+        ctx.check(start, len(items))
+        clips, slots = [], []
+        for i, (name, data) in enumerate(items[start:start + BATCH_CHUNK_SIZE]):
+            entry = {"index": start + i, "filename": name}
+            results.append(entry)
+            try:
+                clips.append(decode_audio_bytes(data, name))
+            except Exception as e:
+                entry["error"] = f"invalid_audio: {e}"
+                continue
+            slots.append(entry)
+        for entry, emotion in zip(slots, predict_audio_batch(clips)):
+            entry["emotion"] = emotion
+    return _summary(results)
+
+
+JOB_HANDLERS = {
+    "predict-audio": run_audio_job,
+    "predict-both": run_both_job,
+    "predict-batch": run_image_batch_job,
+    "predict-audio-batch": run_audio_batch_job,
+}
+
+
+# ---------------- workers ----------------
+class JobWorkerPool:
+    def __init__(self, store, workers=JOB_WORKERS, handlers=JOB_HANDLERS, nice=JOB_NICE):
+        self.store = store
+        self.workers = max(0, int(workers))
+        self.handlers = handlers
+        self.nice = nice
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.completed = Counter()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _lower_priority(self):
+        # Linux: nice ต่อเธรดได้ (ใช้ native thread id แทน pid)
+        if self.nice <= 0 or not hasattr(os, "setpriority"):
+            return
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except OSError:
+            pass
+
+    def _loop(self):
+        self._lower_priority()
+        while not self._stop.is_set():
+            try:
+                self._maybe_purge()
+                job = self.store.claim()
+            except sqlite3.Error:
+                logger.exception("job queue error")
+                job = None
+            if job is None:
+                self._stop.wait(JOB_POLL_S)
+                continue
+            self.run_one(job)
+
+    def _maybe_purge(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_purge < 60.0:
+                return
+            self._last_purge = now
+        purged = self.store.purge_expired(now)
+        if purged:
+            logger.info("purged %d expired jobs", purged)
+
+    def run_one(self, job):
+        handler = self.handlers.get(job["kind"])
+        current_route.set(f"job:{job['kind']}")
+        started = time.perf_counter()
+        state = "failed"
+        try:
+            if handler is None:
+                raise JobInputError(f"unknown job kind '{job['kind']}'")
+            result = handler(job, JobContext(self.store, job))
+            state = "done" if self.store.finish(job["id"], job["attempts"], result) else "lost"
+        except JobCancelled:
+            state = "cancelled" if self.store.mark_cancelled(job["id"], job["attempts"]) else "lost"
+        except JobLeaseLost:
+            logger.warning("job %s (%s) lost its lease, abandoning attempt %d", job["id"], job["kind"], job["attempts"])
+            state = "lost"
+        except Exception as e:
+            if not isinstance(e, (JobInputError, ValueError)):
+                logger.exception("job %s (%s) failed", job["id"], job["kind"])
+            if not self.store.fail(job["id"], job["attempts"], str(e) or type(e).__name__):
+                state = "lost"
+        observe_stage("job", time.perf_counter() - started, route=f"job:{job['kind']}")
+        with self._lock:
+            self.completed[state] += 1
+
+    def stats(self):
+        with self._lock:
+            completed = dict(self.completed)
+        return {"workers": self.workers, "completed": completed, "queue": self.store.counts()}
+
+
+_store = None
+_pool = None
+_init_lock = threading.RLock()
+rate_limiter = RateLimiter()
+
+
+def get_job_store():
+    global _store
+    if _store is None:
+        with _init_lock:
+            if _store is None:
+                _store = JobStore()
+    return _store
+
+
+def start_job_workers(workers=JOB_WORKERS):
+    global _pool
+    with _init_lock:
+        if _pool is None and workers > 0:
+            _pool = JobWorkerPool(get_job_store(), workers)
+            _pool.start()
+    return _pool
+
+
+def stop_job_workers():
+    global _pool
+    with _init_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.stop(timeout=5)
+
+
+def job_stats():
+    if _pool is not None:
+        return _pool.stats()
+    return {"workers": 0, "completed": {}, "queue": get_job_store().counts()}
@@ -1,36 +1,155 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, Request, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import traceback
+import logging
 import base64
+import math
+import os
+import json
+import asyncio
+import time
 import numpy as np
 import cv2
-import os
-import tempfile
-from typing import Optional
-import librosa
+from typing import List, Optional
 # Support running as a package (Backend.main) or from inside Backend directory
 try:
-    from .model_image import model, classes as class_names
-    from .utlis import detect_and_crop_face, predict_face_image
-    from .model_audio import predict_audio as predict_audio_emotion
-except Exception:
+    from .model_image import classes as class_names, model_version as image_model_version
+    from .utlis import detect_and_crop_face, MAX_FACES
+    from .model_audio import (
+        preprocess_audio, predict_mfcc_proba, predict_mfcc_batch,
+        classes as audio_class_names, model_version as audio_model_version,
+    )
+    from .batching import get_face_batcher, top_label
+    from .fusion import fuse, get_fusion
+    from .metrics import (
+        MetricsMiddleware, add_collector, configure_logging, profiler, render as render_metrics, set_error_kind,
+    )
+    from .model_runtime import get_runtime, runtime_ready, runtime_stats
+    from .model_registry import registry as model_registry, PRELOAD_MODELS
+    from .model_server import MODEL_SERVER_SOCKETS, model_server_ready
+    from .executors import get_pool, pool_stats, shutdown_pools, PoolSaturated
+    from .face_detector import PRESETS as FACE_PRESETS
+    from .audio_io import (
+        decode_audio_bytes, decode_stats as audio_decode_stats, parse_wav_header, AudioDecodeError,
+    )
+    from .image_io import (
+        decode_image, decode_stats as image_decode_stats, scale_coords, scale_faces, ImageDecodeError, MAX_DECODE_SIDE,
+    )
+    from .uploads import (
+        RequestSizeLimitMiddleware, UploadTooLarge, read_upload, spool_upload, too_large_body,
+        MAX_IMAGE_UPLOAD_BYTES, MAX_AUDIO_UPLOAD_BYTES, MAX_VIDEO_UPLOAD_BYTES, MAX_BATCH_REQUEST_BYTES,
+    )
+    from .video_file import video_timeline, VideoDecodeError, VIDEO_SAMPLE_FPS, VIDEO_MAX_SAMPLES
+    from .face_cascade import warm_up_mtcnn, detector_stats as face_detector_stats
+    from .thread_tuning import tune as tune_threads, tuning_status
+    from .jobs import (
+        get_job_store, start_job_workers, stop_job_workers, job_stats, save_uploads, new_job_id, public_view,
+        rate_limiter as job_rate_limiter, JOB_RESULT_TTL_S, JOB_MAX_TTL_S, JOB_PRIORITY_RANGE,
+        JOB_MAX_QUEUED_PER_CLIENT,
+    )
+    from .result_cache import get_prediction_cache, content_key
+    from .video_stream import FaceStreamSession, STREAM_DETECT_EVERY, STREAM_SMOOTH_WINDOW
+    from .audio_stream import (
+        StreamingEmotionAnalyzer, PcmDecoder, wav_stream_format, STREAM_HOP_FRAMES,
+    )
+    from .batch_predict import (
+        iter_image_results, iter_audio_results, expand_upload, check_item_count,
+        BatchInputError, BATCH_STREAM_THRESHOLD, BATCH_MAX_ARCHIVE_BYTES, is_zip,
+    )
+except ImportError:
     try:
-        from Backend.model_image import model, classes as class_names
-        from Backend.utlis import detect_and_crop_face, predict_face_image
-        from Backend.model_audio import predict_audio as predict_audio_emotion
-    except Exception:
-        from model_image import model, classes as class_names
-        from utlis import detect_and_crop_face, predict_face_image
-        from model_audio import predict_audio as predict_audio_emotion
+        from Backend.model_image import classes as class_names, model_version as image_model_version
+        from Backend.utlis import detect_and_crop_face, MAX_FACES
+        from Backend.model_audio import (
+            preprocess_audio, predict_mfcc_proba, predict_mfcc_batch,
+            classes as audio_class_names, model_version as audio_model_version,
+        )
+        from Backend.batching import get_face_batcher, top_label
+        from Backend.fusion import fuse, get_fusion
+        from Backend.metrics import (
+            MetricsMiddleware, add_collector, configure_logging, profiler, render as render_metrics, set_error_kind,
+        )
+        from Backend.model_runtime import get_runtime, runtime_ready, runtime_stats
+        from Backend.model_registry import registry as model_registry, PRELOAD_MODELS
+        from Backend.model_server import MODEL_SERVER_SOCKETS, model_server_ready
+        from Backend.executors import get_pool, pool_stats, shutdown_pools, PoolSaturated
+        from Backend.face_detector import PRESETS as FACE_PRESETS
+        from Backend.audio_io import (
+            decode_audio_bytes, decode_stats as audio_decode_stats, parse_wav_header, AudioDecodeError,
+        )
+        from Backend.image_io import (
+            decode_image, decode_stats as image_decode_stats, scale_coords, scale_faces, ImageDecodeError, MAX_DECODE_SIDE,
+        )
+        from Backend.uploads import (
+            RequestSizeLimitMiddleware, UploadTooLarge, read_upload, spool_upload, too_large_body,
+            MAX_IMAGE_UPLOAD_BYTES, MAX_AUDIO_UPLOAD_BYTES, MAX_VIDEO_UPLOAD_BYTES, MAX_BATCH_REQUEST_BYTES,
+        )
+        from Backend.video_file import video_timeline, VideoDecodeError, VIDEO_SAMPLE_FPS, VIDEO_MAX_SAMPLES
+        from Backend.face_cascade import warm_up_mtcnn, detector_stats as face_detector_stats
+        from Backend.thread_tuning import tune as tune_threads, tuning_status
+        from Backend.jobs import (
+            get_job_store, start_job_workers, stop_job_workers, job_stats, save_uploads, new_job_id, public_view,
+            rate_limiter as job_rate_limiter, JOB_RESULT_TTL_S, JOB_MAX_TTL_S, JOB_PRIORITY_RANGE,
+            JOB_MAX_QUEUED_PER_CLIENT,
+        )
+        from Backend.result_cache import get_prediction_cache, content_key
+        from Backend.video_stream import FaceStreamSession, STREAM_DETECT_EVERY, STREAM_SMOOTH_WINDOW
+        from Backend.audio_stream import (
+            StreamingEmotionAnalyzer, PcmDecoder, wav_stream_format, STREAM_HOP_FRAMES,
+        )
+        from Backend.batch_predict import (
+            iter_image_results, iter_audio_results, expand_upload, check_item_count,
+            BatchInputError, BATCH_STREAM_THRESHOLD, BATCH_MAX_ARCHIVE_BYTES, is_zip,
+        )
+    except ImportError:
+        from model_image import classes as class_names, model_version as image_model_version
+        from utlis import detect_and_crop_face, MAX_FACES
+        from model_audio import (
+            preprocess_audio, predict_mfcc_proba, predict_mfcc_batch,
+            classes as audio_class_names, model_version as audio_model_version,
+        )
+        from batching import get_face_batcher, top_label
+        from fusion import fuse, get_fusion
+        from metrics import (
+            MetricsMiddleware, add_collector, configure_logging, profiler, render as render_metrics, set_error_kind,
+        )
+        from model_runtime import get_runtime, runtime_ready, runtime_stats
+        from model_registry import registry as model_registry, PRELOAD_MODELS
+        from model_server import MODEL_SERVER_SOCKETS, model_server_ready
+        from executors import get_pool, pool_stats, shutdown_pools, PoolSaturated
+        from face_detector import PRESETS as FACE_PRESETS
+        from audio_io import (
+            decode_audio_bytes, decode_stats as audio_decode_stats, parse_wav_header, AudioDecodeError,
+        )
+        from image_io import (
+            decode_image, decode_stats as image_decode_stats, scale_coords, scale_faces, ImageDecodeError, MAX_DECODE_SIDE,
+        )
+        from uploads import (
+            RequestSizeLimitMiddleware, UploadTooLarge, read_upload, spool_upload, too_large_body,
+            MAX_IMAGE_UPLOAD_BYTES, MAX_AUDIO_UPLOAD_BYTES, MAX_VIDEO_UPLOAD_BYTES, MAX_BATCH_REQUEST_BYTES,
+        )
+        from video_file import video_timeline, VideoDecodeError, VIDEO_SAMPLE_FPS, VIDEO_MAX_SAMPLES
+        from face_cascade import warm_up_mtcnn, detector_stats as face_detector_stats
+        from thread_tuning import tune as tune_threads, tuning_status
+        from jobs import (
+            get_job_store, start_job_workers, stop_job_workers, job_stats, save_uploads, new_job_id, public_view,
+            rate_limiter as job_rate_limiter, JOB_RESULT_TTL_S, JOB_MAX_TTL_S, JOB_PRIORITY_RANGE,
+            JOB_MAX_QUEUED_PER_CLIENT,
+        )
+        from result_cache import get_prediction_cache, content_key
+        from video_stream import FaceStreamSession, STREAM_DETECT_EVERY, STREAM_SMOOTH_WINDOW
+        from audio_stream import (
+            StreamingEmotionAnalyzer, PcmDecoder, wav_stream_format, STREAM_HOP_FRAMES,
+        )
+        from batch_predict import (
+            iter_image_results, iter_audio_results, expand_upload, check_item_count,
+            BatchInputError, BATCH_STREAM_THRESHOLD, BATCH_MAX_ARCHIVE_BYTES, is_zip,
+        )
 
-app = FastAPI(title="Emotion Detection API")
-def run_audio_model(waveform, sr):
-    """
-    Run the audio emotion prediction model.
-    """
-    return predict_audio_emotion(waveform, sr) 
+configure_logging()
+logger = logging.getLogger(__name__)
 
+app = FastAPI(title="Emotion Detection API")
 
 app.add_middleware(
     CORSMiddleware,
@@ -40,234 +159,868 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ตัด body ที่ใหญ่เกินขณะกำลังรับ (อยู่ใน MetricsMiddleware จึงยังนับ 413 ใน metrics)
+app.add_middleware(RequestSizeLimitMiddleware)
+
+# เพิ่มหลังสุดจึงอยู่นอกสุดของ middleware stack: จับเวลาทั้ง request รวม CORS
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request: Request, exc: PoolSaturated):
+    return _busy_response(exc)
+
+
+@app.on_event("startup")
+def _tune_threads():
+    # ต้องมาก่อน warm-up: จำนวน thread ของ torch/OpenCV และขนาด pool ถูกกำหนดก่อนใช้งานครั้งแรก
+    tune_threads()
+
+
+@app.on_event("startup")
+def _warm_up_models():
+    if MODEL_SERVER_SOCKETS:
+        # โมเดลอยู่ใน model server (python -m Backend.model_server): worker นี้ไม่โหลดน้ำหนักเอง
+        return
+    # โหลดโมเดลพร้อมกันใน background thread ให้เซิร์ฟเวอร์รับ /health ได้ทันที (ดู /ready)
+    model_registry.warm_up(PRELOAD_MODELS, prepare=get_runtime)
+
+
+@app.on_event("startup")
+def _warm_up_face_detector():
+    # MTCNN (ชั้นที่สองของ face_cascade) รันใน worker นี้เสมอ แม้โมเดลอารมณ์จะอยู่ใน model server
+    warm_up_mtcnn()
+
+
+@app.on_event("startup")
+def _start_job_workers():
+    start_job_workers()
+
+
+@app.on_event("shutdown")
+def _shutdown_pools():
+    stop_job_workers()
+    shutdown_pools(wait=False)
+
+
+def _busy_response(exc):
+    set_error_kind("busy")
+    return JSONResponse(
+        content={"error": "server_busy", "pool": exc.pool_name},
+        status_code=503,
+        headers={"Retry-After": "1"},
+    )
+
+
+def _too_large_response(exc):
+    return JSONResponse(content=too_large_body(exc.limit), status_code=413)
+
+
+def _encode_face_crop(face_crop):
+    """เข้ารหัสใบหน้าที่ครอป (RGB) เป็น data URL แบบ JPEG base64 หรือ None หากล้มเหลว"""
+    try:
+        face_bgr = cv2.cvtColor(face_crop, cv2.COLOR_RGB2BGR)
+        ok, buf = cv2.imencode('.jpg', face_bgr)
+        crop_b64 = base64.b64encode(buf.tobytes()).decode('utf-8') if ok else None
+    except Exception:
+        crop_b64 = None
+    return f"data:image/jpeg;base64,{crop_b64}" if crop_b64 else None
+
+
+def _encode_face_crops(face_crops):
+    return [_encode_face_crop(face) for face in face_crops]
+
+
+async def _cache_lookup(pool, contents, namespace, version, **params):
+    """คืน (cache, key, cached_result) — cache เป็น None เมื่อปิดการแคช"""
+    cache = get_prediction_cache()
+    if cache is None:
+        return None, None, None
+    key = await pool.run("hash", content_key, contents, namespace, version, **params)
+    return cache, key, cache.get(key)
+
+
+def _cached_response(result):
+    return JSONResponse(content=result, headers={"X-Cache": "HIT"})
+
+
+def _face_coords_dict(face_coords):
+    return {
+        "x": int(face_coords[0]),
+        "y": int(face_coords[1]),
+        "w": int(face_coords[2]),
+        "h": int(face_coords[3]),
+    }
+
+
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
+async def predict(
+    file: UploadFile = File(...),
+    preset: Optional[str] = None,
+    include_crop: bool = True,
+    multi_face: bool = False,
+    max_faces: Optional[int] = None,
+):
+    image_pool = get_pool("image")
+    if preset is not None and preset not in FACE_PRESETS:
+        return JSONResponse(
+            content={"error": f"Unknown preset '{preset}'", "presets": sorted(FACE_PRESETS)},
+            status_code=400,
+        )
+    if max_faces is not None and max_faces < 1:
+        return JSONResponse(content={"error": "max_faces must be >= 1"}, status_code=400)
+    # จำกัดจำนวนใบหน้าต่อภาพไม่เกิน EMOTION_MAX_FACES แม้ client จะขอมากกว่า
+    face_limit = min(max_faces or MAX_FACES, MAX_FACES) if multi_face else 1
     try:
-        # อ่านไฟล์ที่อัพโหลด
-        contents = await file.read()
+        # อ่านไฟล์ที่อัพโหลด (ไม่เกิน EMOTION_MAX_IMAGE_BYTES)
+        contents = await read_upload(file, MAX_IMAGE_UPLOAD_BYTES)
         if not contents:
             return JSONResponse(content={"error": "Empty file"}, status_code=400)
 
-        npimg = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+        cache, cache_key, cached = await _cache_lookup(
+            image_pool, contents, "image", image_model_version,
+            preset=preset, include_crop=include_crop, multi_face=multi_face, max_faces=face_limit,
+            max_side=MAX_DECODE_SIDE,
+        )
+        if cached is not None:
+            return _cached_response(cached)
+
+        # ภาพใหญ่ถูกย่อตั้งแต่ตอนถอดรหัส; scale ใช้แปลงพิกัดใบหน้ากลับเป็นของภาพต้นฉบับ
+        try:
+            img, scale = await image_pool.run("decode", decode_image, contents)
+        except ImageDecodeError as dec_e:
+            return JSONResponse(content={"error": f"Invalid image: {dec_e}"}, status_code=400)
 
         if img is None:
             return JSONResponse(content={"error": "Invalid image"}, status_code=400)
 
-        # Detect & crop face
+        # Detect & crop face(s)
         try:
-            face_crop, face_coords = detect_and_crop_face(img, use_anime_detection=False)
+            if multi_face:
+                faces = await image_pool.run(
+                    "detect", detect_and_crop_face, img, use_anime_detection=False, preset=preset,
+                    multi_face=True, max_faces=face_limit,
+                )
+            else:
+                face_crop, face_coords = await image_pool.run(
+                    "detect", detect_and_crop_face, img, use_anime_detection=False, preset=preset
+                )
+                faces = [] if face_crop is None else [(face_crop, face_coords)]
+        except PoolSaturated:
+            raise
         except Exception as det_e:
-            print("face detection error:\n" + traceback.format_exc())
+            logger.exception("face detection error")
+            set_error_kind("face_detection_failed")
             return JSONResponse(content={"error": f"face_detection_failed: {det_e}"}, status_code=500)
-        if face_crop is None:
+        if not faces:
             return JSONResponse(content={"error": "No face detected"}, status_code=404)
+        faces = scale_faces(faces, scale)
 
-        # Predict emotion
+        # Predict emotion: ทุกใบหน้าส่งเข้า batcher พร้อมกันจึงรวมเป็น forward pass เดียว
+        # (และรวมกับ request อื่นที่เข้ามาพร้อมกันด้วย)
         try:
-            emotion = predict_face_image(face_crop, model, class_names)
+            with image_pool.timed("infer"):
+                probs = await get_face_batcher().run_many([face for face, _ in faces])
+            emotions = [top_label(p, class_names) for p in probs]
         except Exception as pred_e:
-            print("prediction error:\n" + traceback.format_exc())
+            logger.exception("prediction error")
+            set_error_kind("prediction_failed")
             return JSONResponse(content={"error": f"prediction_failed: {pred_e}"}, status_code=500)
 
-        # Encode cropped face (RGB -> BGR for OpenCV encode)
-        try:
-            face_bgr = cv2.cvtColor(face_crop, cv2.COLOR_RGB2BGR)
-            ok, buf = cv2.imencode('.jpg', face_bgr)
-            crop_b64 = base64.b64encode(buf.tobytes()).decode('utf-8') if ok else None
-        except Exception:
-            crop_b64 = None
-
-        return {
-            "emotion": emotion,
-            "face_coords": {
-                "x": int(face_coords[0]),
-                "y": int(face_coords[1]),
-                "w": int(face_coords[2]),
-                "h": int(face_coords[3]),
-            },
-            "face_crop_image": f"data:image/jpeg;base64,{crop_b64}" if crop_b64 else None
-        }
+        entries = [
+            {"emotion": emotion, "face_coords": _face_coords_dict(coords)}
+            for (_, coords), emotion in zip(faces, emotions)
+        ]
+        if include_crop:
+            # Encode cropped faces (RGB -> BGR for OpenCV encode); ข้ามได้ด้วย ?include_crop=false
+            crops = await image_pool.run("encode", _encode_face_crops, [face for face, _ in faces])
+            for entry, crop_url in zip(entries, crops):
+                entry["face_crop_image"] = crop_url
+
+        if multi_face:
+            # ใบหน้าแรก (ใหญ่สุด) อยู่ที่ระดับบนสุดด้วย เพื่อให้ client เดิมอ่านได้เหมือนเดิม
+            result = {
+                "emotion": entries[0]["emotion"],
+                "face_coords": entries[0]["face_coords"],
+                "face_count": len(entries),
+                "faces": entries,
+            }
+        else:
+            result = entries[0]
+        if cache is not None:
+            cache.set(cache_key, result)
+        return result
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except PoolSaturated as e:
+        return _busy_response(e)
     except Exception as e:
-        print("/predict error:\n" + traceback.format_exc())
+        logger.exception("/predict error")
+        set_error_kind(type(e).__name__)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-<<<<<<< HEAD
-=======
-
-def _save_temp_file(contents: bytes, filename: Optional[str]) -> str:
-    suffix = None
-    if filename and "." in filename:
-        suffix = filename[filename.rfind("."):]
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix or ".bin")
-    try:
-        tmp.write(contents)
-        return tmp.name
-    finally:
-        tmp.close()
-        
-# =========================
-# Audio model inference
-# =========================
-def run_audio_model(y, sr):
-    """
-    Run the audio emotion prediction model with mel-spectrogram.
-    """
-    # ✅ Mel-spectrogram
-    mel_spec = librosa.feature.melspectrogram(
-        y=y, sr=sr, n_fft=2048, hop_length=512, n_mels=128
-    )
-    mel_spec_db = librosa.power_to_db(mel_spec, ref=np.max)
-
-    # Reshape → (1, n_mels, time, 1)
-    spectrogram = mel_spec_db[np.newaxis, ..., np.newaxis]
-
-    # TODO: เรียกโมเดลจริง (ตอนนี้ใช้ dummy)
-    prediction = float(np.mean(spectrogram))
-
-    return prediction
 
 # =========================
 # FastAPI endpoints
 # =========================
->>>>>>> bright
 @app.post("/predict-audio")
 async def predict_audio(file: UploadFile = File(...)):
+    audio_pool = get_pool("audio")
     try:
-        contents = await file.read()
+        contents = await read_upload(file, MAX_AUDIO_UPLOAD_BYTES)
         if not contents:
-<<<<<<< HEAD
             return JSONResponse(content={"error": "Empty file"}, status_code=400)
 
-        # Write to a temp file for torchaudio to load reliably across platforms
-        import tempfile, os
-        import torchaudio
-        suffix = os.path.splitext(file.filename or "")[1] or ".wav"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            tmp.write(contents)
-            tmp_path = tmp.name
+        cache, cache_key, cached = await _cache_lookup(audio_pool, contents, "audio", audio_model_version)
+        if cached is not None:
+            return _cached_response(cached)
 
         try:
-            waveform, sr = torchaudio.load(tmp_path)
-        finally:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
+            waveform, sr = await audio_pool.run("decode", decode_audio_bytes, contents, file.filename)
+        except AudioDecodeError as dec_e:
+            return JSONResponse(content={"error": f"invalid_audio: {dec_e}"}, status_code=400)
 
         try:
-            emotion = predict_audio_emotion(waveform, sr)
+            x = await audio_pool.run("preprocess", preprocess_audio, waveform, sr)
+            emotion = top_label((await audio_pool.run("infer", predict_mfcc_proba, x))[0], audio_class_names)
+        except PoolSaturated:
+            raise
         except Exception as pred_e:
-            print("audio prediction error:\n" + traceback.format_exc())
+            logger.exception("audio prediction error")
+            set_error_kind("audio_prediction_failed")
             return JSONResponse(content={"error": f"audio_prediction_failed: {pred_e}"}, status_code=500)
 
-        return {"emotion": emotion}
+        result = {"emotion": emotion}
+        if cache is not None:
+            cache.set(cache_key, result)
+        return result
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except PoolSaturated as e:
+        return _busy_response(e)
     except Exception as e:
-        print("/predict-audio error:\n" + traceback.format_exc())
+        logger.exception("/predict-audio error")
+        set_error_kind(type(e).__name__)
         return JSONResponse(content={"error": str(e)}, status_code=500)
-=======
-            return JSONResponse(content={"error": "Empty audio file"}, status_code=400)
 
-        # Save to temp
-        tmp_path = _save_temp_file(contents, file.filename)
+@app.post("/predict-both")
+async def predict_both(
+    image: UploadFile = File(None), audio: UploadFile = File(None), include_crop: bool = True
+):
+    image_pool = get_pool("image")
+    audio_pool = get_pool("audio")
+    if image is None or audio is None:
+        return JSONResponse(
+            content={"error": "Both 'image' and 'audio' files are required"},
+            status_code=400,
+        )
 
+    # แต่ละ branch คืน (error_response, result) เพื่อให้รันพร้อมกันได้ด้วย asyncio.gather
+    async def image_branch():
+        image_bytes = await read_upload(image, MAX_IMAGE_UPLOAD_BYTES)
         try:
-            # Load audio
-            import torchaudio
-            waveform, sr = torchaudio.load(tmp_path)
+            img, scale = await image_pool.run("decode", decode_image, image_bytes)
+        except ImageDecodeError as dec_e:
+            return JSONResponse(content={"error": f"Invalid image: {dec_e}"}, status_code=400), None
+        if img is None:
+            return JSONResponse(content={"error": "Invalid image"}, status_code=400), None
+        face_crop, face_coords = await image_pool.run(
+            "detect", detect_and_crop_face, img, use_anime_detection=False
+        )
+        if face_crop is None:
+            return JSONResponse(content={"error": "No face detected"}, status_code=404), None
+        with image_pool.timed("infer"):
+            probs = await get_face_batcher().run(face_crop)
+        ((face_crop, face_coords),) = scale_faces([(face_crop, face_coords)], scale)
+        return None, (face_crop, face_coords, probs)
 
-            # ✅ ใช้โมเดลจริงจาก model_audio.py
-            prediction = predict_audio_emotion(waveform, sr)
+    async def audio_branch():
+        audio_bytes = await read_upload(audio, MAX_AUDIO_UPLOAD_BYTES)
+        try:
+            waveform, sr = await audio_pool.run("decode", decode_audio_bytes, audio_bytes, audio.filename)
+        except AudioDecodeError as dec_e:
+            return JSONResponse(content={"error": f"invalid_audio: {dec_e}"}, status_code=400), None
+        x = await audio_pool.run("preprocess", preprocess_audio, waveform, sr)
+        return None, (await audio_pool.run("infer", predict_mfcc_proba, x))[0]
 
-            return {
-                "filename": file.filename,
-                "prediction": prediction,   # จะได้เป็น "sad" / "happy" ฯลฯ
-            }
-        finally:
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
+    try:
+        # latency = branch ที่ช้ากว่า แทนที่จะเป็นผลรวมของทั้งสอง
+        outcomes = await asyncio.gather(image_branch(), audio_branch(), return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        (image_error, image_result), (audio_error, audio_probs) = outcomes
+        if image_error is not None:
+            return image_error
+        if audio_error is not None:
+            return audio_error
+        face_crop, face_coords, image_probs = image_result
+
+        # ================== Fusion ==================
+        result = fuse(image_probs, class_names, audio_probs, audio_class_names)
+        result["face_coords"] = _face_coords_dict(face_coords)
+        if include_crop:
+            # Encode cropped face
+            result["face_crop_image"] = await image_pool.run("encode", _encode_face_crop, face_crop)
+        return result
+
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except PoolSaturated as e:
+        return _busy_response(e)
     except Exception as e:
-        print("/predict-audio error:\n" + traceback.format_exc())
+        logger.exception("/predict-both error")
+        set_error_kind(type(e).__name__)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/predict-both")
-async def predict_both(image: UploadFile = File(None), audio: UploadFile = File(None)):
+
+# =========================
+# Batch endpoints
+# =========================
+async def _collect_batch_items(files, max_item_bytes):
+    """
+    อ่านไฟล์ทั้งหมดใน request (แตก zip ถ้ามี) คืน list ของ (name, bytes)
+    ไฟล์เดี่ยวและไฟล์ใน zip จำกัดที่ ``max_item_bytes``; ตัว zip จำกัดที่ BATCH_MAX_ARCHIVE_BYTES
+    """
+    items = []
+    for upload in files:
+        data = await upload.read(max_item_bytes + 1)
+        if not data:
+            continue
+        if is_zip(upload.filename, data):
+            data += await read_upload(upload, BATCH_MAX_ARCHIVE_BYTES, already_read=len(data))
+        elif len(data) > max_item_bytes:
+            raise UploadTooLarge(max_item_bytes, f"file '{upload.filename}'")
+        items.extend(await get_pool("image").run(
+            "unpack", expand_upload, upload.filename, data, max_item_bytes
+        ))
+    check_item_count(items)
+    return items
+
+
+async def _batch_response(chunks, count, stream):
+    """รวมผลเป็น JSON เดียว หรือสตรีมเป็น NDJSON ทีละ chunk เมื่อ batch ใหญ่"""
+    if stream is None:
+        stream = count > BATCH_STREAM_THRESHOLD
+    if stream:
+        async def ndjson():
+            async for results in chunks:
+                for item in results:
+                    yield json.dumps(item, ensure_ascii=False) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    results = []
+    async for chunk in chunks:
+        results.extend(chunk)
+    succeeded = sum(1 for r in results if "error" not in r)
+    return {"count": count, "succeeded": succeeded, "failed": count - succeeded, "results": results}
+
+
+@app.post("/predict/batch")
+async def predict_batch(
+    files: List[UploadFile] = File(...),
+    preset: Optional[str] = None,
+    stream: Optional[bool] = None,
+):
+    if preset is not None and preset not in FACE_PRESETS:
+        return JSONResponse(
+            content={"error": f"Unknown preset '{preset}'", "presets": sorted(FACE_PRESETS)},
+            status_code=400,
+        )
     try:
-        if image is None or audio is None:
-            return JSONResponse(
-                content={"error": "Both 'image' and 'audio' files are required"},
-                status_code=400,
-            )
-
-        # ================== Process image ==================
-        image_bytes = await image.read()
-        npimg = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
-        if img is None:
-            return JSONResponse(content={"error": "Invalid image"}, status_code=400)
+        items = await _collect_batch_items(files, MAX_IMAGE_UPLOAD_BYTES)
+        return await _batch_response(iter_image_results(items, preset=preset), len(items), stream)
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except BatchInputError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except PoolSaturated as e:
+        return _busy_response(e)
+    except Exception as e:
+        logger.exception("/predict/batch error")
+        set_error_kind(type(e).__name__)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@app.post("/predict-audio/batch")
+async def predict_audio_batch(files: List[UploadFile] = File(...), stream: Optional[bool] = None):
+    try:
+        items = await _collect_batch_items(files, MAX_AUDIO_UPLOAD_BYTES)
+        return await _batch_response(iter_audio_results(items), len(items), stream)
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except BatchInputError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except PoolSaturated as e:
+        return _busy_response(e)
+    except Exception as e:
+        logger.exception("/predict-audio/batch error")
+        set_error_kind(type(e).__name__)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+# =========================
+# Background jobs
+# =========================
+async def _submit_job(request, kind, uploads, priority, ttl_s, params=None):
+    """เก็บไฟล์ของ job ลงดิสก์แล้วเข้าคิว ตอบ 202 พร้อม job_id ทันที"""
+    client = request.client.host if request.client else "unknown"
+    wait = job_rate_limiter.acquire(client)
+    if wait:
+        return JSONResponse(
+            content={"error": "rate_limited", "retry_after_s": round(wait, 1)},
+            status_code=429,
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+    store = get_job_store()
+    if store.open_jobs_for(client) >= JOB_MAX_QUEUED_PER_CLIENT:
+        return JSONResponse(
+            content={"error": "too_many_open_jobs", "limit": JOB_MAX_QUEUED_PER_CLIENT},
+            status_code=429,
+            headers={"Retry-After": "10"},
+        )
+    if not 0 < ttl_s <= JOB_MAX_TTL_S:
+        return JSONResponse(content={"error": f"ttl_s must be in (0, {JOB_MAX_TTL_S:g}]"}, status_code=400)
+    low, high = JOB_PRIORITY_RANGE
+    job_id = new_job_id()
+    try:
+        inputs = await save_uploads(store, job_id, uploads, MAX_BATCH_REQUEST_BYTES)
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    store.submit(job_id, kind, inputs, params or {}, min(max(priority, low), high), client, ttl_s)
+    return JSONResponse(
+        content={
+            "job_id": job_id,
+            "state": "queued",
+            "status_url": f"/jobs/{job_id}",
+            "result_url": f"/jobs/{job_id}/result",
+        },
+        status_code=202,
+        headers={"Location": f"/jobs/{job_id}"},
+    )
+
+
+@app.post("/jobs/predict-audio")
+async def submit_audio_job(
+    request: Request, file: UploadFile = File(...), priority: int = 0, ttl_s: float = JOB_RESULT_TTL_S
+):
+    """เหมือน /predict-audio แต่รันเบื้องหลัง และได้อารมณ์ต่อหน้าต่างตลอดทั้งไฟล์"""
+    return await _submit_job(request, "predict-audio", [("file", file)], priority, ttl_s)
+
+
+@app.post("/jobs/predict-both")
+async def submit_both_job(
+    request: Request,
+    image: UploadFile = File(...),
+    audio: UploadFile = File(...),
+    priority: int = 0,
+    ttl_s: float = JOB_RESULT_TTL_S,
+):
+    return await _submit_job(request, "predict-both", [("image", image), ("audio", audio)], priority, ttl_s)
+
+
+@app.post("/jobs/predict/batch")
+async def submit_image_batch_job(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    preset: Optional[str] = None,
+    priority: int = 0,
+    ttl_s: float = JOB_RESULT_TTL_S,
+):
+    if preset is not None and preset not in FACE_PRESETS:
+        return JSONResponse(
+            content={"error": f"Unknown preset '{preset}'", "presets": sorted(FACE_PRESETS)},
+            status_code=400,
+        )
+    uploads = [("files", f) for f in files]
+    return await _submit_job(request, "predict-batch", uploads, priority, ttl_s, {"preset": preset})
+
+
+@app.post("/jobs/predict-audio/batch")
+async def submit_audio_batch_job(
+    request: Request, files: List[UploadFile] = File(...), priority: int = 0, ttl_s: float = JOB_RESULT_TTL_S
+):
+    uploads = [("files", f) for f in files]
+    return await _submit_job(request, "predict-audio-batch", uploads, priority, ttl_s)
 
-        face_crop, face_coords = detect_and_crop_face(img, use_anime_detection=False)
-        if face_crop is None:
-            return JSONResponse(content={"error": "No face detected"}, status_code=404)
 
-        image_emotion = predict_face_image(face_crop, model, class_names)
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job_store().get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown or expired job"}, status_code=404)
+    return public_view(job)
 
-        # ================== Process audio ==================
-        audio_bytes = await audio.read()
-        tmp_path = _save_temp_file(audio_bytes, audio.filename)
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = get_job_store().get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown or expired job"}, status_code=404)
+    if job["state"] == "done":
+        return JSONResponse(content=json.loads(job["result"]))
+    if job["state"] in ("queued", "running"):
+        return JSONResponse(content=public_view(job), status_code=202, headers={"Retry-After": "1"})
+    if job["state"] == "cancelled":
+        return JSONResponse(content=public_view(job), status_code=409)
+    return JSONResponse(content=public_view(job), status_code=422)
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    state = get_job_store().cancel(job_id)
+    if state is None:
+        return JSONResponse(content={"error": "Unknown or expired job"}, status_code=404)
+    return {"job_id": job_id, "state": state, "cancel_requested": state == "running"}
+
+
+# =========================
+# Video files
+# =========================
+@app.post("/predict-video")
+async def predict_video(
+    file: UploadFile = File(...),
+    sample_fps: float = VIDEO_SAMPLE_FPS,
+    max_samples: int = VIDEO_MAX_SAMPLES,
+    preset: Optional[str] = None,
+):
+    """
+    timeline อารมณ์ของไฟล์วิดีโอ: สุ่มเฟรมตาม sample_fps ข้ามเฟรม/ใบหน้าที่แทบไม่เปลี่ยน
+    แล้วส่งเฉพาะใบหน้าใหม่เข้าโมเดลเป็น batch
+    """
+    if sample_fps <= 0 or max_samples < 1:
+        return JSONResponse(content={"error": "sample_fps must be > 0 and max_samples >= 1"}, status_code=400)
+    if preset is not None and preset not in FACE_PRESETS:
+        return JSONResponse(
+            content={"error": f"Unknown preset '{preset}'", "presets": sorted(FACE_PRESETS)},
+            status_code=400,
+        )
+    path = None
+    try:
+        suffix = os.path.splitext(file.filename or "")[1].lower()
+        path = await spool_upload(file, MAX_VIDEO_UPLOAD_BYTES, suffix=suffix)
+        if os.path.getsize(path) == 0:
+            return JSONResponse(content={"error": "Empty file"}, status_code=400)
+        kwargs = {"preset": preset} if preset is not None else {}
+        # เพดานของเซิร์ฟเวอร์: client ขอได้น้อยกว่า แต่ไม่เกิน VIDEO_MAX_SAMPLES
+        max_samples = min(max_samples, VIDEO_MAX_SAMPLES)
+        return await video_timeline(path, sample_fps=sample_fps, max_samples=max_samples, **kwargs)
+    except VideoDecodeError as e:
+        return JSONResponse(content={"error": f"invalid_video: {e}"}, status_code=400)
+    except UploadTooLarge as e:
+        return _too_large_response(e)
+    except PoolSaturated as e:
+        return _busy_response(e)
+    except Exception as e:
+        logger.exception("/predict-video error")
+        set_error_kind(type(e).__name__)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+
+# =========================
+# Real-time webcam stream
+# =========================
+@app.websocket("/ws/video")
+async def ws_video(
+    websocket: WebSocket,
+    detect_every: int = STREAM_DETECT_EVERY,
+    window: int = STREAM_SMOOTH_WINDOW,
+):
+    """
+    รับเฟรม JPEG (binary message) ต่อเนื่อง ตอบกลับ JSON ต่อเฟรมที่ประมวลผล
+    ถ้าประมวลผลไม่ทันจะข้ามไปใช้เฟรมล่าสุดเสมอ (latency ไม่สะสม)
+    """
+    await websocket.accept()
+    session = FaceStreamSession(detect_every=detect_every, window=window)
+    image_pool = get_pool("image")
+    latest = {"frame": None, "index": 0, "received_at": 0.0}
+    counters = {"dropped": 0}
+    frame_ready = asyncio.Event()
+    closed = asyncio.Event()
+
+    async def receive_frames():
         try:
-            y, sr = librosa.load(tmp_path, sr=22050)
-            audio_emotion = run_audio_model(y, sr)
+            while True:
+                data = await websocket.receive_bytes()
+                if latest["frame"] is not None:
+                    counters["dropped"] += 1  # เฟรมเก่าที่ยังไม่ได้ประมวลผลถูกแทนที่
+                latest["frame"] = data
+                latest["index"] += 1
+                latest["received_at"] = time.perf_counter()
+                frame_ready.set()
+        except (WebSocketDisconnect, RuntimeError, KeyError):
+            pass
         finally:
+            closed.set()
+            frame_ready.set()
+
+    receiver = asyncio.create_task(receive_frames())
+    try:
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            data, index, received_at = latest["frame"], latest["index"], latest["received_at"]
+            latest["frame"] = None
+            if data is None:
+                if closed.is_set():
+                    break
+                continue
+
             try:
-                os.remove(tmp_path)
-            except:
-                pass
+                try:
+                    img, scale = await image_pool.run("decode", decode_image, data)
+                except ImageDecodeError:
+                    img = None
+                if img is None:
+                    await websocket.send_json({"frame": index, "error": "Invalid image"})
+                    continue
+                face, box, tracked = await image_pool.run("detect", session.locate, img)
+                if face is None:
+                    session.clear_history()
+                    await websocket.send_json({"frame": index, "face_coords": None, "dropped": counters["dropped"]})
+                    continue
+                with image_pool.timed("infer"):
+                    emotion = top_label(await get_face_batcher().run(face), class_names)
+            except PoolSaturated:
+                counters["dropped"] += 1
+                continue
 
-        # ================== Fusion ==================
-        if image_emotion == audio_emotion:
-            final_emotion = image_emotion
-            confidence = 0.9
-        else:
-            final_emotion = image_emotion
-            confidence = 0.6
+            smoothed, confidence = session.observe(emotion)
+            await websocket.send_json({
+                "frame": index,
+                "emotion": emotion,
+                "smoothed_emotion": smoothed,
+                "confidence": confidence,
+                "face_coords": _face_coords_dict(scale_coords(box, scale)),
+                "tracked": tracked,
+                "dropped": counters["dropped"],
+                "latency_ms": (time.perf_counter() - received_at) * 1000.0,
+            })
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.exception("/ws/video error")
+    finally:
+        receiver.cancel()
+        logger.info("/ws/video closed: %s dropped=%d", session.stats(), counters["dropped"])
 
-        # Encode cropped face
+
+# =========================
+# Streaming audio
+# =========================
+AUDIO_STREAM_READ_CHUNK = 64 * 1024
+
+
+@app.websocket("/ws/audio")
+async def ws_audio(
+    websocket: WebSocket,
+    sample_rate: int = 16000,
+    format: str = "s16le",
+    channels: int = 1,
+    hop_frames: int = STREAM_HOP_FRAMES,
+):
+    """
+    รับ PCM แบบ raw (binary message) ต่อเนื่อง ตอบ JSON หนึ่งข้อความต่อหน้าต่างที่วิเคราะห์ได้
+    ส่งข้อความ text "end" เพื่อวิเคราะห์ส่วนที่เหลือและปิดการเชื่อมต่อ
+    """
+    await websocket.accept()
+    try:
+        decoder = PcmDecoder(format, channels)
+        analyzer = StreamingEmotionAnalyzer(sample_rate, predict_mfcc_batch, hop_frames=hop_frames)
+    except (ValueError, KeyError) as e:
+        await websocket.send_json({"error": str(e)})
+        await websocket.close(code=1003)
+        return
+
+    audio_pool = get_pool("audio")
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                samples = decoder.decode(message["bytes"])
+                results = await audio_pool.run("stream", analyzer.feed, samples)
+            elif message.get("text") == "end":
+                results = await audio_pool.run("stream", analyzer.finish)
+                for r in results:
+                    await websocket.send_json(r)
+                await websocket.send_json({"done": True, "windows": analyzer.windows})
+                await websocket.close()
+                return
+            else:
+                continue
+            for r in results:
+                await websocket.send_json(r)
+    except WebSocketDisconnect:
+        pass
+    except PoolSaturated as e:
+        await websocket.send_json({"error": "server_busy", "pool": e.pool_name})
+        await websocket.close(code=1013)
+    except Exception:
+        logger.exception("/ws/audio error")
+
+
+@app.post("/predict-audio/stream")
+async def predict_audio_stream(file: UploadFile = File(...), hop_frames: int = STREAM_HOP_FRAMES):
+    """
+    วิเคราะห์ไฟล์เสียงยาวทีละหน้าต่าง ตอบเป็น NDJSON (หนึ่งบรรทัดต่อหน้าต่าง)
+    WAV แบบ PCM จะอ่านทีละ chunk ไม่โหลดทั้งไฟล์; format อื่นจะถอดรหัสทั้งไฟล์ก่อน
+    """
+    audio_pool = get_pool("audio")
+    head = await file.read(AUDIO_STREAM_READ_CHUNK)
+    if not head:
+        return JSONResponse(content={"error": "Empty file"}, status_code=400)
+
+    info = parse_wav_header(head)
+    fmt = wav_stream_format(info)
+    if fmt is not None:
+        decoder = PcmDecoder(fmt, info["channels"])
+        sample_rate = info["sr"]
+        declared = info["declared_size"]
+        remaining = declared if 0 < declared < 0xFFFFFFFF else None
+        first = head[info["data_offset"]:]
+        waveform = None
+    else:
         try:
-            face_bgr = cv2.cvtColor(face_crop, cv2.COLOR_RGB2BGR)
-            ok, buf = cv2.imencode(".jpg", face_bgr)
-            crop_b64 = base64.b64encode(buf.tobytes()).decode("utf-8") if ok else None
-        except Exception:
-            crop_b64 = None
-
-        return {
-            "emotion": final_emotion,
-            "image_emotion": image_emotion,
-            "audio_emotion": audio_emotion,
-            "confidence": confidence,
-            "face_coords": {
-                "x": int(face_coords[0]),
-                "y": int(face_coords[1]),
-                "w": int(face_coords[2]),
-                "h": int(face_coords[3]),
-            },
-            "face_crop_image": f"data:image/jpeg;base64,{crop_b64}"
-            if crop_b64
-            else None,
-        }
+            contents = head + await read_upload(file, MAX_AUDIO_UPLOAD_BYTES, already_read=len(head))
+            waveform, sample_rate = await audio_pool.run("decode", decode_audio_bytes, contents, file.filename)
+        except UploadTooLarge as e:
+            return _too_large_response(e)
+        except AudioDecodeError as dec_e:
+            return JSONResponse(content={"error": f"invalid_audio: {dec_e}"}, status_code=400)
+        except PoolSaturated as e:
+            return _busy_response(e)
+        waveform = waveform.mean(dim=0)
 
-    except Exception as e:
-        print("/predict-both error:\n" + traceback.format_exc())
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+    try:
+        analyzer = StreamingEmotionAnalyzer(sample_rate, predict_mfcc_batch, hop_frames=hop_frames)
+    except ValueError as e:
+        return JSONResponse(content={"error": f"invalid_audio: {e}"}, status_code=400)
+
+    async def pcm_chunks():
+        nonlocal remaining
+        data = first
+        while data:
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+            yield decoder.decode(data)
+            if remaining == 0:
+                return
+            data = await file.read(AUDIO_STREAM_READ_CHUNK)
+
+    async def decoded_chunks():
+        step = sample_rate  # ครั้งละ 1 วินาที
+        for start in range(0, waveform.numel(), step):
+            yield waveform[start:start + step]
+
+    async def ndjson():
+        try:
+            async for samples in (pcm_chunks() if waveform is None else decoded_chunks()):
+                for r in await audio_pool.run("stream", analyzer.feed, samples):
+                    yield json.dumps(r) + "\n"
+            for r in await audio_pool.run("stream", analyzer.finish):
+                yield json.dumps(r) + "\n"
+        except Exception as e:
+            logger.exception("/predict-audio/stream error")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+def _collect_gauges():
+    pools = pool_stats()
+    yield ("emotion_pool_in_flight", "gauge", "Calls running or queued per executor pool",
+           [({"pool": name}, p["in_flight"]) for name, p in pools.items()])
+    yield ("emotion_pool_rejected_total", "counter", "Calls rejected because the pool was saturated",
+           [({"pool": name}, p["rejected"]) for name, p in pools.items()])
+    yield ("emotion_batcher_pending", "gauge", "Items waiting in the face micro-batcher",
+           [({"batcher": "face"}, get_face_batcher().stats()["pending"])])
+    cache = get_prediction_cache()
+    if cache is not None:
+        c = cache.stats()
+        yield ("emotion_cache_hits_total", "counter", "Prediction cache hits", [({}, c["hits"])])
+        yield ("emotion_cache_misses_total", "counter", "Prediction cache misses", [({}, c["misses"])])
+        yield ("emotion_cache_entries", "gauge", "Entries in the in-process prediction cache", [({}, c["entries"])])
+    yield ("emotion_model_ready", "gauge", "1 when the model finished loading and warm-up",
+           [({"model": name}, int(m["warm"])) for name, m in model_registry.status().items()])
+    detector = face_detector_stats()
+    yield ("emotion_face_detect_images_total", "counter", "Images by the detection tier that produced the result",
+           [({"result": r}, detector[f"result_{r}"]) for r in ("haar", "mtcnn")]
+           + [({"result": "none"}, detector["no_face"])])
+    yield ("emotion_face_detect_escalations_total", "counter", "Images escalated from Haar to MTCNN",
+           [({"reason": r}, detector[f"escalated_{r}"]) for r in ("miss", "low_score")])
+    yield ("emotion_jobs", "gauge", "Background jobs per state",
+           [({"state": state}, n) for state, n in get_job_store().counts().items()])
+
+
+add_collector(_collect_gauges)
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition format"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/metrics/profile")
+def metrics_profile(limit: int = 30, sort: str = "cumulative"):
+    """ผลรวมจาก profiler แบบสุ่มตัวอย่าง (เปิดด้วย POST /metrics/profiler?sample_rate=...)"""
+    return PlainTextResponse(profiler.report(limit=limit, sort=sort))
+
+
+@app.post("/metrics/profiler")
+def configure_profiler(sample_rate: Optional[float] = None, reset: bool = False):
+    if sample_rate is not None and not 0.0 <= sample_rate <= 1.0:
+        return JSONResponse(content={"error": "sample_rate must be within [0, 1]"}, status_code=400)
+    profiler.configure(sample_rate=sample_rate, reset=reset)
+    return profiler.status()
 
 
 @app.get("/health")
 def health():
+    # liveness: โปรเซสยังตอบได้ (ไม่ขึ้นกับการโหลดโมเดล)
     return {"status": "ok"}
 
 
+@app.get("/ready")
+def ready():
+    """readiness: พร้อมเมื่อโมเดลที่โหลดล่วงหน้า (EMOTION_PRELOAD_MODELS) และ runtime พร้อมครบ"""
+    if MODEL_SERVER_SOCKETS:
+        # server เปิด socket หลังโหลดโมเดลครบแล้ว: ต่อได้ = พร้อม
+        is_ready = model_server_ready()
+        models = {name: get_runtime(name).info() for name in PRELOAD_MODELS} if is_ready else {}
+    else:
+        models = model_registry.status()
+        is_ready = model_registry.ready(PRELOAD_MODELS) and all(runtime_ready(n) for n in PRELOAD_MODELS)
+    return JSONResponse(
+        content={"status": "ready" if is_ready else "loading", "models": models},
+        status_code=200 if is_ready else 503,
+    )
+
+
+@app.get("/stats")
+def stats():
+    cache = get_prediction_cache()
+    return {
+        "face_batcher": get_face_batcher().stats(),
+        "pools": pool_stats(),
+        "threads": tuning_status(),
+        "audio_decode": audio_decode_stats(),
+        "image_decode": image_decode_stats(),
+        "face_detector": face_detector_stats(),
+        "prediction_cache": cache.stats() if cache is not None else None,
+        "runtimes": runtime_stats(),
+        "fusion": get_fusion().config(),
+        "profiler": profiler.status(),
+        "models": model_registry.status(),
+        "jobs": job_stats(),
+    }
+
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
->>>>>>> bright
@@ -0,0 +1,359 @@
+"""
+Hot-path instrumentation: Prometheus text metrics, a sampled profiler and logging setup.
+
+- ``MetricsMiddleware`` (pure ASGI) counts requests by route/status, times them
+  and records errors by type (probe routes such as ``/ready`` are not counted as
+  errors: a 503 there only means "still loading"). The matched route is kept in a context variable so
+  ``StagePool`` and the micro-batcher can label per-stage histograms with it.
+- ``render()`` produces the Prometheus text exposition format for ``/metrics``;
+  collectors registered with ``add_collector`` add gauges computed at scrape time.
+- ``profiler`` wraps a sampled fraction of pool stage calls in ``cProfile`` and
+  aggregates the stats; it can be switched on/off and resampled at runtime.
+- ``configure_logging`` sets up level-gated (``EMOTION_LOG_LEVEL``) text or JSON
+  (``EMOTION_LOG_FORMAT=json``) logging for the ``Backend`` loggers.
+"""
+import bisect
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get("EMOTION_METRICS_ENABLED", "1") not in ("0", "false", "False")
+LOG_LEVEL = os.environ.get("EMOTION_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("EMOTION_LOG_FORMAT", "text")
+PROFILE_SAMPLE_RATE = float(os.environ.get("EMOTION_PROFILE_SAMPLE_RATE", "0"))
+
+# ms-scale stages ถึงหลายวินาที (หน่วยวินาทีตามธรรมเนียม Prometheus)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+current_route = contextvars.ContextVar("emotion_route", default="background")
+# dict ต่อ request (mutable) เพื่อให้ handler ที่รันใน task/thread อื่นตั้งค่ากลับมาได้
+_request_info = contextvars.ContextVar("emotion_request_info", default=None)
+
+
+# ---------------- metric types ----------------
+def _label_str(names, values):
+    if not names:
+        return ""
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{n}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _fmt(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _label_str(self.labelnames, k), v) for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        out = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                out.append((self.name + "_bucket", _label_str(self.labelnames + ("le",), labels + (_fmt(bound),)), cumulative))
+            # ค่าที่เกิน bucket สุดท้ายนับรวมใน +Inf (= count)
+            out.append((self.name + "_bucket", _label_str(self.labelnames + ("le",), labels + ("+Inf",)), series[-1]))
+            out.append((self.name + "_sum", _label_str(self.labelnames, labels), series[-2]))
+            out.append((self.name + "_count", _label_str(self.labelnames, labels), series[-1]))
+        return out
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, fn):
+        """``fn() -> iterable ของ (name, type, help, [(labels_dict, value), ...])`` เรียกตอน scrape"""
+        with self._lock:
+            self._collectors.append(fn)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in m.samples():
+                lines.append(f"{name}{labels} {_fmt(value)}")
+        for collect in collectors:
+            try:
+                families = list(collect())
+            except Exception:
+                logging.getLogger(__name__).exception("metrics collector failed")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels)
+                    lines.append(f"{name}{_label_str(names, [labels[n] for n in names])} {_fmt(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUESTS = registry.register(Counter(
+    "emotion_requests_total", "HTTP requests by route and status code", ("route", "status")))
+ERRORS = registry.register(Counter(
+    "emotion_errors_total", "Failed requests by route and error type", ("route", "type")))
+REQUEST_SECONDS = registry.register(Histogram(
+    "emotion_request_duration_seconds", "End-to-end request latency", ("route",)))
+STAGE_SECONDS = registry.register(Histogram(
+    "emotion_stage_duration_seconds", "Pipeline stage run time", ("route", "stage")))
+QUEUE_WAIT_SECONDS = registry.register(Histogram(
+    "emotion_queue_wait_seconds", "Time spent waiting for a worker or batch slot", ("queue",)))
+BATCH_SIZE = registry.register(Histogram(
+    "emotion_batch_size", "Items per micro-batch", ("batcher",), buckets=(1, 2, 4, 8, 16, 32, 64)))
+
+
+def observe_stage(stage, seconds, route=None):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, route or current_route.get(), stage)
+
+
+def observe_queue_wait(queue, seconds):
+    if METRICS_ENABLED:
+        QUEUE_WAIT_SECONDS.observe(seconds, queue)
+
+
+def set_error_kind(kind):
+    """ระบุชนิดข้อผิดพลาดของ request ปัจจุบัน (ไม่เช่นนั้นจะเดาจาก status code)"""
+    info = _request_info.get()
+    if info is not None:
+        info["error"] = kind
+
+
+def render():
+    return registry.render()
+
+
+def add_collector(fn):
+    registry.add_collector(fn)
+
+
+# ---------------- ASGI middleware ----------------
+# 503 นับเป็น "busy" เฉพาะเมื่อ handler ระบุเอง (pool เต็ม) ผ่าน set_error_kind
+_STATUS_KINDS = {400: "invalid_input", 404: "not_found", 413: "too_large", 429: "rate_limited", 503: "unavailable"}
+# health/readiness probe และ scrape ไม่นับใน emotion_errors_total (/ready ตอบ 503 ระหว่างโหลดโมเดลโดยตั้งใจ)
+PROBE_ROUTES = frozenset({"/health", "/ready", "/metrics"})
+
+
+class MetricsMiddleware:
+    """นับ/จับเวลา request HTTP โดยไม่ห่อ response body (รองรับ StreamingResponse)"""
+
+    def __init__(self, app, routes=None):
+        self.app = app
+        self._routes = routes
+
+    def _route_label(self, scope):
+        path = scope.get("path", "")
+        if self._routes is None:
+            app = scope.get("app")
+            routes = getattr(app, "routes", None)
+            if routes is None:
+                return path
+            self._routes = {getattr(r, "path", None) for r in routes}
+        return path if path in self._routes else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+        route = self._route_label(scope)
+        route_token = current_route.set(route)
+        info = {"error": None}
+        info_token = _request_info.set(info)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            info["error"] = type(e).__name__
+            raise
+        finally:
+            code = status["code"]
+            REQUESTS.inc(route, str(code))
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+            if code >= 400 and route not in PROBE_ROUTES:
+                kind = info["error"] or _STATUS_KINDS.get(code, "internal" if code >= 500 else "client_error")
+                ERRORS.inc(route, kind)
+            _request_info.reset(info_token)
+            current_route.reset(route_token)
+
+
+# ---------------- sampled profiler ----------------
+class SampledProfiler:
+    """
+    รัน cProfile กับ stage call เพียงบางส่วน (``sample_rate``) แล้วสะสมสถิติไว้
+    เปิด/ปิดและเปลี่ยนอัตราได้ระหว่างรัน (เช่นผ่าน POST /metrics/profiler)
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE):
+        self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+        self._lock = threading.Lock()
+        self._stats = None
+        self.samples = 0
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0.0
+
+    def configure(self, sample_rate=None, reset=False):
+        with self._lock:
+            if sample_rate is not None:
+                self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+            if reset:
+                self._stats = None
+                self.samples = 0
+
+    def call(self, fn, *args, **kwargs):
+        """เรียก ``fn`` ตรงๆ หรือภายใต้ cProfile ตามอัตราการสุ่ม"""
+        if self.sample_rate <= 0.0 or random.random() >= self.sample_rate:
+            return fn(*args, **kwargs)
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:  # มี profiler อื่นทำงานอยู่ใน thread นี้
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            prof.disable()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(prof)
+                else:
+                    self._stats.add(prof)
+                self.samples += 1
+
+    def report(self, limit=30, sort="cumulative"):
+        with self._lock:
+            if self._stats is None:
+                return f"no samples (sample_rate={self.sample_rate})\n"
+            buf = io.StringIO()
+            self._stats.stream = buf
+            self._stats.sort_stats(sort).print_stats(limit)
+        return f"samples={self.samples} sample_rate={self.sample_rate}\n" + buf.getvalue()
+
+    def status(self):
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "samples": self.samples}
+
+
+profiler = SampledProfiler()
+
+
+# ---------------- logging ----------------
+class JsonFormatter(logging.Formatter):
+    _RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._RESERVED and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+
+_logging_configured = False
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    ตั้งค่า logger ของแพ็กเกจ (``Backend``) ครั้งเดียว; ถ้ารันแบบไม่มีแพ็กเกจ (cd Backend)
+    จะตั้งที่ root logger แทน ไม่แตะ logger ของ uvicorn
+    """
+    global _logging_configured
+    if _logging_configured:
+        return
+    package = __name__.rpartition(".")[0]
+    logger = logging.getLogger(package) if package else logging.getLogger()
+    handler = logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.setLevel(level)
+    if not logger.handlers:
+        logger.addHandler(handler)
+    if package:
+        logger.propagate = False
+    _logging_configured = True
@@ -1,17 +1,25 @@
 import os
 import torch
 import torch.nn as nn
-import torchaudio
-import torchaudio.transforms as T
 from torchvision import models
 
+try:
+    from .audio_features import mfcc_transform, mfcc_features, batch_mfcc
+    from .model_runtime import get_runtime
+    from .model_registry import registry, load_checkpoint, assign_state_dict
+except ImportError:
+    try:
+        from Backend.audio_features import mfcc_transform, mfcc_features, batch_mfcc
+        from Backend.model_runtime import get_runtime
+        from Backend.model_registry import registry, load_checkpoint, assign_state_dict
+    except ImportError:
+        from audio_features import mfcc_transform, mfcc_features, batch_mfcc
+        from model_runtime import get_runtime
+        from model_registry import registry, load_checkpoint, assign_state_dict
+
 # Emotion classes จาก TESS หรือ dataset ของคุณ
 classes = ["happy", "sad", "angry", "neutral", "surprise", "fear", "disgust"]
 
-model = models.resnet18(weights=None)
-num_ftrs = model.fc.in_features
-model.fc = nn.Linear(num_ftrs, len(classes))
-
 # Robust checkpoint loading even if fc layer size differs (e.g., 14 vs 7 classes)
 _possible_paths = [
     "resnet18_mfcc128_tess_local.pth",
@@ -20,10 +28,20 @@ _possible_paths = [
 ]
 _ckpt_path = next((p for p in _possible_paths if os.path.exists(p)), None)
 if _ckpt_path is None:
-    # Proceed without loading if file not found; model will be randomly initialized
-    pass
+    # น้ำหนักสุ่มต่างกันในแต่ละโปรเซส จึงห้ามแชร์ cache ข้ามโปรเซส
+    model_version = f"resnet18-random-{os.getpid()}"
 else:
-    ckpt = torch.load(_ckpt_path, map_location="cpu")
+    _st = os.stat(_ckpt_path)
+    model_version = f"resnet18-{_st.st_size:x}-{int(_st.st_mtime):x}"
+
+def load_model():
+    """สร้าง ResNet18 สำหรับ MFCC และโหลด backbone จาก checkpoint (mmap) ถ้ามี"""
+    net = models.resnet18(weights=None)
+    net.fc = nn.Linear(net.fc.in_features, len(classes))
+    if _ckpt_path is None:
+        # Proceed without loading if file not found; model will be randomly initialized
+        return net.eval()
+    ckpt = load_checkpoint(_ckpt_path)
     # Support various checkpoint formats
     if isinstance(ckpt, dict) and "state_dict" in ckpt:
         state = ckpt["state_dict"]
@@ -44,34 +62,47 @@ else:
         cleaned_state[key] = v
 
     # Load backbone weights; head remains our defined 7-class layer
-    model.load_state_dict(cleaned_state, strict=False)
-model.eval()
+    assign_state_dict(net, cleaned_state, strict=False)
+    return net.eval()
 
-mfcc_transform = T.MFCC(
-    sample_rate=16000,
-    n_mfcc=128,
-    melkwargs={"n_fft": 400, "hop_length": 160, "n_mels": 128}
-)
+registry.register("audio", load_model)
 
-def preprocess_audio(waveform, sr, max_len=200):
-    if sr != 16000:
-        waveform = torchaudio.functional.resample(waveform, sr, 16000)
+def get_model():
+    return registry.get("audio")
 
-    mfcc = mfcc_transform(waveform)
-    mfcc = mfcc.mean(dim=0, keepdim=True)  # mono
-    mfcc = mfcc.expand(3, -1, -1)
+def __getattr__(name):
+    # ``from model_audio import model`` ยังใช้ได้ แต่โหลดโมเดลเมื่อถูกเข้าถึงครั้งแรกเท่านั้น
+    if name == "model":
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    if mfcc.shape[2] < max_len:
-        pad_amount = max_len - mfcc.shape[2]
-        mfcc = nn.functional.pad(mfcc, (0, pad_amount))
-    else:
-        mfcc = mfcc[:, :, :max_len]
+def preprocess_audio(waveform, sr, max_len=200):
+    """MFCC [1, 3, 128, max_len] (resampler แคชไว้, downmix ก่อน และตัดความยาวก่อนคำนวณ)"""
+    return mfcc_features(waveform, sr, max_len)
+
+def predict_mfcc_proba(x):
+    """ความน่าจะเป็น (softmax) numpy [B, n_classes] ตามลำดับ ``classes`` จาก MFCC [B, 3, 128, T]"""
+    with torch.no_grad():
+        outputs = get_runtime("audio")(x)
+        probs = torch.softmax(outputs.float(), dim=1)
+    return probs.numpy()
 
-    return mfcc.unsqueeze(0)
+def predict_audio_proba(waveform, sr):
+    """ความน่าจะเป็นของคลิปเดียว numpy [n_classes] (ใช้กับ fusion)"""
+    return predict_mfcc_proba(preprocess_audio(waveform, sr))[0]
 
 def predict_audio(waveform, sr):
-    x = preprocess_audio(waveform, sr)
+    return classes[int(predict_audio_proba(waveform, sr).argmax())]
+
+def predict_audio_batch(clips, max_len=200):
+    """ทำนายหลายคลิปพร้อมกัน ``clips`` เป็น list ของ (waveform, sr) คืน list ของชื่ออารมณ์"""
+    if len(clips) == 0:
+        return []
+    return predict_mfcc_batch(batch_mfcc(clips, max_len))
+
+def predict_mfcc_batch(x):
+    """ทำนายจาก MFCC ที่เตรียมไว้แล้ว shape [B, 3, 128, T] (ใช้กับ streaming)"""
     with torch.no_grad():
-        outputs = model(x)
-        _, pred = torch.max(outputs, 1)
-    return classes[pred.item()]
+        outputs = get_runtime("audio")(x)
+        _, preds = torch.max(outputs, 1)
+    return [classes[i] for i in preds.tolist()]
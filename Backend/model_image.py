@@ -7,21 +7,46 @@ from pathlib import Path
 # Order aligned with provided reference implementation
 classes = ['angry', 'disgust', 'fear', 'happy', 'neutral', 'sad', 'surprise']
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+try:
+    from .model_registry import registry, load_checkpoint, assign_state_dict
+except ImportError:
+    try:
+        from Backend.model_registry import registry, load_checkpoint, assign_state_dict
+    except ImportError:
+        from model_registry import registry, load_checkpoint, assign_state_dict
 
-model = models.resnet18(weights=None)
-num_ftrs = model.fc.in_features
-model.fc = nn.Linear(num_ftrs, len(classes))
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # Resolve model file relative to this file, so it works from any CWD
 _this_dir = Path(__file__).resolve().parent
 _weights_path = _this_dir / "emotion_resnet18.pth"
-if not _weights_path.exists():
-    raise FileNotFoundError(f"Model weights not found at {_weights_path}. Place 'emotion_resnet18.pth' in the 'Backend' folder.")
+# ใช้เป็นส่วนหนึ่งของ cache key: เปลี่ยนไฟล์น้ำหนักแล้วผลลัพธ์เก่าจะไม่ถูกใช้ซ้ำ
+# (อ่านแค่ stat ไม่ต้องโหลดโมเดล)
+if _weights_path.exists():
+    _weights_stat = _weights_path.stat()
+    model_version = f"resnet18-{_weights_stat.st_size:x}-{int(_weights_stat.st_mtime):x}"
+else:
+    model_version = "resnet18-missing"
+
+def load_model():
+    """สร้าง ResNet18 และโหลดน้ำหนัก (mmap) — เรียกผ่าน registry เท่านั้น"""
+    if not _weights_path.exists():
+        raise FileNotFoundError(f"Model weights not found at {_weights_path}. Place 'emotion_resnet18.pth' in the 'Backend' folder.")
+    net = models.resnet18(weights=None)
+    net.fc = nn.Linear(net.fc.in_features, len(classes))
+    assign_state_dict(net, load_checkpoint(_weights_path))
+    return net.to(device).eval()
+
+registry.register("image", load_model)
+
+def get_model():
+    return registry.get("image")
 
-model.load_state_dict(torch.load(str(_weights_path), map_location=device))
-model = model.to(device)
-model.eval()
+def __getattr__(name):
+    # ``from model_image import model`` ยังใช้ได้ แต่โหลดโมเดลเมื่อถูกเข้าถึงครั้งแรกเท่านั้น
+    if name == "model":
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 transform = transforms.Compose([
     transforms.Resize((224, 224)),
@@ -31,6 +56,6 @@ transform = transforms.Compose([
 def predict_image(img):
     x = transform(img).unsqueeze(0)
     with torch.no_grad():
-        outputs = model(x)
+        outputs = get_model()(x)
         _, pred = torch.max(outputs, 1)
     return classes[pred.item()]
\ No newline at end of file
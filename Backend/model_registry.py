@@ -0,0 +1,169 @@
+"""
+Lazy, thread-safe registry for the emotion models.
+
+Model modules register a loader instead of building the network at import
+time, so ``import Backend.main`` no longer pays for checkpoint loading. A model
+is loaded on first use (``get``) or ahead of time by ``warm_up``, which loads
+several models in parallel background threads at server startup; ``/ready``
+reports whether that warm-up has finished.
+
+Checkpoints are read with ``torch.load(mmap=True)`` and assigned into the
+module without copying, so parameters stay backed by the file's page cache:
+every uvicorn/gunicorn worker that loads the same checkpoint shares one
+physical copy of the weights instead of holding its own.
+"""
+import logging
+import os
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# ชื่อโมเดลที่โหลดล่วงหน้าตอน startup (คั่นด้วย comma, ค่าว่าง = โหลดเมื่อถูกใช้ครั้งแรก)
+PRELOAD_MODELS = [
+    n.strip() for n in os.environ.get("EMOTION_PRELOAD_MODELS", "image,audio").split(",") if n.strip()
+]
+MMAP_WEIGHTS = os.environ.get("EMOTION_MMAP_WEIGHTS", "1") in ("1", "true", "True")
+
+
+def load_checkpoint(path, mmap=MMAP_WEIGHTS):
+    """
+    โหลด checkpoint ลง CPU แบบ memory-mapped (น้ำหนักไม่ถูกอ่านเข้าหน่วยความจำจนกว่าจะใช้)
+    ไฟล์รูปแบบเก่า (ไม่ใช่ zip) หรือ torch รุ่นเก่าจะถอยกลับไปโหลดแบบปกติ
+    """
+    if mmap:
+        try:
+            return torch.load(str(path), map_location="cpu", mmap=True, weights_only=True)
+        except (TypeError, RuntimeError, ValueError):
+            pass
+    return torch.load(str(path), map_location="cpu")
+
+
+def assign_state_dict(model, state, strict=True):
+    """load_state_dict แบบไม่คัดลอก (assign=True) เพื่อให้พารามิเตอร์ยังชี้ไปที่ไฟล์ที่ mmap ไว้"""
+    try:
+        return model.load_state_dict(state, strict=strict, assign=True)
+    except TypeError:  # torch < 2.1
+        return model.load_state_dict(state, strict=strict)
+
+
+class _Entry:
+    __slots__ = ("loader", "value", "state", "error", "load_ms", "warm", "lock", "done")
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.value = None
+        self.state = "pending"
+        self.error = None
+        self.load_ms = None
+        self.warm = False
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def register(self, name, loader):
+        """ลงทะเบียน ``loader() -> model`` ถ้ามีชื่อนี้อยู่แล้วจะคงของเดิมไว้"""
+        with self._lock:
+            if name not in self._entries:
+                self._entries[name] = _Entry(loader)
+
+    def _entry(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(f"Unknown model '{name}', registered: {sorted(self._entries)}")
+        return entry
+
+    def get(self, name):
+        """คืนโมเดล โหลดครั้งแรกเมื่อถูกเรียก (ถ้ากำลังโหลดอยู่ใน thread อื่นจะรอจนเสร็จ)"""
+        entry = self._entry(name)
+        if entry.state == "ready":
+            return entry.value
+        with entry.lock:
+            if entry.state != "ready":
+                entry.state = "loading"
+                started = time.perf_counter()
+                try:
+                    entry.value = entry.loader()
+                except Exception as e:
+                    entry.state = "failed"
+                    entry.error = f"{type(e).__name__}: {e}"
+                    raise
+                entry.load_ms = (time.perf_counter() - started) * 1000.0
+                entry.error = None
+                entry.state = "ready"
+        return entry.value
+
+    def loaded(self, name):
+        entry = self._entries.get(name)
+        return entry is not None and entry.state == "ready"
+
+    def warm_up(self, names=None, prepare=None):
+        """
+        โหลดโมเดลหลายตัวพร้อมกันใน background thread (ไม่บล็อก startup)
+        ``prepare(name)`` ถ้ามี จะถูกเรียกหลังโหลดเสร็จ เช่นสร้าง inference runtime ล่วงหน้า
+        """
+        names = list(self._entries) if names is None else list(names)
+        started = []
+        for name in names:
+            entry = self._entry(name)
+            if entry.done.is_set() or any(t.name == f"warmup-{name}" and t.is_alive() for t in self._threads):
+                continue
+            thread = threading.Thread(
+                target=self._warm_one, args=(name, prepare), name=f"warmup-{name}", daemon=True
+            )
+            thread.start()
+            started.append(thread)
+        self._threads.extend(started)
+        return started
+
+    def _warm_one(self, name, prepare):
+        entry = self._entries[name]
+        try:
+            self.get(name)
+            if prepare is not None:
+                prepare(name)
+            entry.warm = True
+            logger.info("model '%s' ready (%.0f ms)", name, entry.load_ms)
+        except Exception as e:
+            entry.state = "failed"
+            entry.error = entry.error or f"{type(e).__name__}: {e}"
+            logger.error("model '%s' failed to load: %s", name, entry.error)
+        finally:
+            entry.done.set()
+
+    def wait(self, names=None, timeout=None):
+        """รอให้ warm-up ของ ``names`` จบ คืน True ถ้าจบทั้งหมดภายใน timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for name in (list(self._entries) if names is None else names):
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not self._entry(name).done.wait(remaining):
+                return False
+        return True
+
+    def ready(self, names=PRELOAD_MODELS):
+        """พร้อมรับงานเมื่อโมเดลที่กำหนดให้โหลดล่วงหน้า warm-up สำเร็จครบทุกตัว"""
+        return all(self._entry(name).warm for name in names if name in self._entries)
+
+    def status(self):
+        with self._lock:
+            entries = dict(self._entries)
+        return {
+            name: {
+                "state": e.state,
+                "warm": e.warm,
+                "load_ms": e.load_ms,
+                "error": e.error,
+            }
+            for name, e in entries.items()
+        }
+
+
+registry = ModelRegistry()
@@ -0,0 +1,381 @@
+"""
+Selectable CPU inference backends for the image and audio ResNet18 models.
+
+Backends (``EMOTION_IMAGE_BACKEND`` / ``EMOTION_AUDIO_BACKEND``):
+- ``eager``        the plain torch module (default)
+- ``torchscript``  traced, frozen and ``optimize_for_inference``-fused graph
+- ``onnx``         ONNX Runtime session (needs ``onnxruntime``)
+- ``int8_dynamic`` dynamic int8 quantization of ``nn.Linear`` layers only; in
+  ResNet18 that is just the fc head, so the convolutions (nearly all of the
+  compute) stay fp32 and the speed-up is small. Prefer ``int8_static``.
+- ``int8_static``  FX-graph static int8 quantization calibrated on sample inputs
+
+``EMOTION_CHANNELS_LAST=1`` runs eager/torchscript in channels_last memory format.
+Exported graphs are cached on disk per model version (written to a temp file
+and renamed, so workers starting together never load a half-written file);
+process-local versions such as randomly initialised weights are not cached. Any non-eager backend is
+checked against the eager model on a calibration set; if top-1 agreement drops
+below ``EMOTION_RUNTIME_MIN_AGREEMENT`` the eager model is used instead. The
+calibration set comes from ``EMOTION_CALIBRATION_DIR``; without it, seeded
+random inputs are used and a warning is logged, since int8_static ranges and
+the agreement check are then not representative of real faces or speech.
+
+With ``EMOTION_MODEL_SERVER`` set, ``get_runtime`` returns a client for the
+shared model-server process instead (see ``model_server.py``).
+"""
+import copy
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "torchscript", "onnx", "int8_dynamic", "int8_static")
+
+RUNTIME_CONFIG = {
+    "image": os.environ.get("EMOTION_IMAGE_BACKEND", "eager"),
+    "audio": os.environ.get("EMOTION_AUDIO_BACKEND", "eager"),
+}
+CHANNELS_LAST = os.environ.get("EMOTION_CHANNELS_LAST", "0") in ("1", "true", "True")
+MIN_AGREEMENT = float(os.environ.get("EMOTION_RUNTIME_MIN_AGREEMENT", "0.98"))
+CALIBRATION_DIR = os.environ.get("EMOTION_CALIBRATION_DIR", "")
+CALIBRATION_SIZE = int(os.environ.get("EMOTION_CALIBRATION_SIZE", "64"))
+# ตั้งค่าแล้ว worker จะส่งงาน inference ไปที่ model server แทนการโหลดโมเดลเอง (ดู model_server.py)
+MODEL_SERVER = os.environ.get("EMOTION_MODEL_SERVER", "").strip()
+RUNTIME_CACHE_DIR = Path(os.environ.get(
+    "EMOTION_RUNTIME_CACHE_DIR", str(Path(__file__).resolve().parent / ".runtime_cache")
+))
+
+# รูปทรงอินพุตของแต่ละโมเดล (ไม่รวมมิติ batch)
+INPUT_SHAPES = {"image": (3, 224, 224), "audio": (3, 128, 200)}
+
+
+class InferenceRuntime:
+    """ห่อ backend ใดๆ ให้เรียกได้แบบ ``runtime(x) -> logits`` เหมือน nn.Module"""
+
+    def __init__(self, name, backend, fn, device=torch.device("cpu"), channels_last=False):
+        self.name = name
+        self.backend = backend
+        self.device = device
+        self.channels_last = channels_last
+        self.accuracy = None
+        self._fn = fn
+
+    def __call__(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self._fn(x)
+
+    def info(self):
+        return {
+            "backend": self.backend,
+            "channels_last": self.channels_last,
+            "device": str(self.device),
+            "accuracy": self.accuracy,
+        }
+
+
+# ---------------- calibration data ----------------
+def calibration_batches(name, count=CALIBRATION_SIZE, batch_size=16, calibration_dir=CALIBRATION_DIR):
+    """
+    ชุดข้อมูลสำหรับ calibrate/ตรวจความแม่นยำ: ใช้ไฟล์จริงจาก ``calibration_dir`` ถ้ามี
+    (ภาพใบหน้าสำหรับ image, ไฟล์เสียงสำหรับ audio) ไม่เช่นนั้นสร้างข้อมูลสุ่มแบบกำหนด seed
+    """
+    samples = _load_calibration_files(name, calibration_dir, count) if calibration_dir else []
+    if not samples:
+        logger.warning(
+            "%s calibration uses random inputs (EMOTION_CALIBRATION_DIR %s): int8_static ranges and the "
+            "accuracy check will not reflect real data", name,
+            f"'{calibration_dir}' has no usable files" if calibration_dir else "is not set",
+        )
+        gen = torch.Generator().manual_seed(0)
+        if name == "image":
+            samples = list(torch.rand((count,) + INPUT_SHAPES["image"], generator=gen))
+        else:
+            try:
+                from .audio_features import mfcc_features
+            except ImportError:
+                try:
+                    from Backend.audio_features import mfcc_features
+                except ImportError:
+                    from audio_features import mfcc_features
+            samples = [
+                mfcc_features(torch.randn(1, 32000, generator=gen) * 0.1, 16000)[0]
+                for _ in range(count)
+            ]
+    return [torch.stack(samples[i:i + batch_size]) for i in range(0, len(samples), batch_size)]
+
+
+def _load_calibration_files(name, calibration_dir, count):
+    files = sorted(p for p in Path(calibration_dir).rglob("*") if p.is_file())[:count]
+    samples = []
+    for path in files:
+        try:
+            if name == "image":
+                import cv2
+                img = cv2.imread(str(path))
+                if img is None:
+                    continue
+                rgb = cv2.cvtColor(cv2.resize(img, (224, 224)), cv2.COLOR_BGR2RGB)
+                samples.append(torch.from_numpy(np.ascontiguousarray(rgb)).permute(2, 0, 1).float() / 255.0)
+            else:
+                try:
+                    from .audio_io import decode_audio_bytes
+                    from .audio_features import mfcc_features
+                except ImportError:
+                    try:
+                        from Backend.audio_io import decode_audio_bytes
+                        from Backend.audio_features import mfcc_features
+                    except ImportError:
+                        from audio_io import decode_audio_bytes
+                        from audio_features import mfcc_features
+                waveform, sr = decode_audio_bytes(path.read_bytes(), path.name)
+                samples.append(mfcc_features(waveform, sr)[0])
+        except Exception as e:
+            logger.warning("skip calibration file %s: %s", path, e)
+    return samples
+
+
+# ---------------- export / load ----------------
+def _cache_path(name, version, backend, suffix):
+    """ไฟล์ cache ของ graph ที่ export แล้ว หรือ None ถ้า version ผูกกับโปรเซสนี้ (เช่นน้ำหนักสุ่ม)"""
+    if version.endswith(f"-{os.getpid()}"):
+        return None
+    RUNTIME_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return RUNTIME_CACHE_DIR / f"{name}-{version}-{backend}{'-cl' if CHANNELS_LAST else ''}{suffix}"
+
+
+def _write_atomic(path, write):
+    # เขียนไฟล์ชั่วคราวของโปรเซสนี้แล้ว os.replace: worker อื่นจะไม่เห็นไฟล์ที่เขียนไม่เสร็จ
+    tmp = path.with_suffix(f".tmp-{os.getpid()}")
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def export_torchscript(model, example, path=None):
+    """trace -> freeze -> optimize_for_inference แล้วบันทึกลงไฟล์ (ถ้าให้ ``path``)"""
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+    if path is not None:
+        _write_atomic(path, lambda tmp: torch.jit.save(frozen, str(tmp)))
+    return frozen
+
+
+def export_onnx(model, example, path):
+    kwargs = dict(
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+
+    def write(tmp):
+        try:
+            torch.onnx.export(model, (example,), str(tmp), dynamo=False, **kwargs)
+        except TypeError:  # torch รุ่นเก่าไม่มีพารามิเตอร์ dynamo
+            torch.onnx.export(model, (example,), str(tmp), **kwargs)
+
+    _write_atomic(path, write)
+
+
+def _onnx_session(path):
+    import onnxruntime as ort
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # ค่าเริ่มต้นตาม torch (ที่ thread_tuning ตั้งไว้) แทนการใช้ทุกคอร์ของเครื่อง
+    threads = int(os.environ.get("EMOTION_ONNX_THREADS", "0")) or torch.get_num_threads()
+    if threads > 0:
+        opts.intra_op_num_threads = threads
+    session = ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+
+    def run(x):
+        out = session.run(None, {"input": x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(out)
+
+    return run
+
+
+def _quantize_static(model, calibration):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+    torch.backends.quantized.engine = engine
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(engine),
+                          example_inputs=(calibration[0],))
+    with torch.no_grad():
+        for batch in calibration:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def build_runtime(name, model, version, backend="eager", channels_last=CHANNELS_LAST, calibration=None):
+    """สร้าง InferenceRuntime ของ ``model`` ตาม backend ที่เลือก (ยังไม่ตรวจความแม่นยำ)"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    model = model.eval()
+    device = next(model.parameters()).device
+    cl = channels_last and backend in ("eager", "torchscript") and device.type == "cpu"
+    if backend == "eager":
+        if cl:
+            # .to() แก้ module เดิมในที่ ต้องคัดลอกก่อน ไม่ให้โมเดลใน registry (ตัวอ้างอิงของ check_accuracy) เปลี่ยนตาม
+            model = copy.deepcopy(model).to(memory_format=torch.channels_last)
+        return InferenceRuntime(name, backend, model, device, channels_last=cl)
+
+    if device.type != "cpu":
+        raise ValueError(f"Backend '{backend}' is CPU only")
+    example = torch.rand((2,) + INPUT_SHAPES[name])
+    if backend == "torchscript":
+        path = _cache_path(name, version, backend, ".pt")
+        src = copy.deepcopy(model)
+        if cl:
+            src = src.to(memory_format=torch.channels_last)
+            example = example.contiguous(memory_format=torch.channels_last)
+        if path is not None and path.exists():
+            scripted = torch.jit.load(str(path))
+        else:
+            scripted = export_torchscript(src, example, path)
+        return InferenceRuntime(name, backend, scripted, device, channels_last=cl)
+    if backend == "onnx":
+        path = _cache_path(name, version, backend, ".onnx")
+        if path is None:
+            # ORT อ่านโมเดลเข้าหน่วยความจำตอนสร้าง session แล้ว ลบไฟล์ทิ้งได้ทันที
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tmp_path = Path(tmp_dir) / "model.onnx"
+                export_onnx(model, example, tmp_path)
+                return InferenceRuntime(name, backend, _onnx_session(tmp_path), device)
+        if not path.exists():
+            export_onnx(model, example, path)
+        return InferenceRuntime(name, backend, _onnx_session(path), device)
+    if backend == "int8_dynamic":
+        # quantize เฉพาะ nn.Linear (หัว fc ของ ResNet18) ส่วน conv ยังเป็น fp32
+        quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+        return InferenceRuntime(name, backend, quantized, device)
+    # int8_static
+    quantized = _quantize_static(model, calibration or calibration_batches(name))
+    return InferenceRuntime(name, backend, quantized, device)
+
+
+def check_accuracy(reference, runtime, batches):
+    """เทียบ logits กับโมเดล eager: สัดส่วน top-1 ที่ตรงกัน และค่าต่างสูงสุด"""
+    agree = total = 0
+    max_diff = 0.0
+    ref_time = run_time = 0.0
+    with torch.no_grad():
+        for batch in batches:
+            t0 = time.perf_counter()
+            expected = reference(batch)
+            t1 = time.perf_counter()
+            got = runtime(batch)
+            t2 = time.perf_counter()
+            ref_time += t1 - t0
+            run_time += t2 - t1
+            agree += int((expected.argmax(1) == got.argmax(1)).sum())
+            total += batch.shape[0]
+            max_diff = max(max_diff, float((expected - got.float()).abs().max()))
+    agreement = agree / total if total else 1.0
+    return {
+        "samples": total,
+        "top1_agreement": agreement,
+        "max_abs_diff": max_diff,
+        "eager_ms": ref_time * 1000.0,
+        "runtime_ms": run_time * 1000.0,
+        "passed": agreement >= MIN_AGREEMENT,
+    }
+
+
+# ---------------- process-wide runtimes ----------------
+_runtimes = {}
+_runtimes_lock = threading.Lock()
+
+
+def _load_model(name):
+    if name == "image":
+        try:
+            from .model_image import get_model, model_version
+        except ImportError:
+            try:
+                from Backend.model_image import get_model, model_version
+            except ImportError:
+                from model_image import get_model, model_version
+    elif name == "audio":
+        try:
+            from .model_audio import get_model, model_version
+        except ImportError:
+            try:
+                from Backend.model_audio import get_model, model_version
+            except ImportError:
+                from model_audio import get_model, model_version
+    else:
+        raise ValueError(f"Unknown model '{name}'")
+    return get_model(), model_version
+
+
+def get_runtime(name):
+    """
+    คืน runtime ของโมเดล ("image" หรือ "audio") ตาม config สร้างครั้งแรกเมื่อถูกเรียก
+    backend ที่ไม่ผ่านการตรวจความแม่นยำหรือสร้างไม่สำเร็จจะถอยกลับไปใช้ eager
+    """
+    runtime = _runtimes.get(name)
+    if runtime is not None:
+        return runtime
+    with _runtimes_lock:
+        runtime = _runtimes.get(name)
+        if runtime is None:
+            runtime = _runtimes[name] = _create_runtime(name)
+    return runtime
+
+
+def _create_runtime(name):
+    if MODEL_SERVER:
+        try:
+            from .model_server import remote_runtime
+        except ImportError:
+            try:
+                from Backend.model_server import remote_runtime
+            except ImportError:
+                from model_server import remote_runtime
+        return remote_runtime(name)
+    return create_local_runtime(name)
+
+
+def create_local_runtime(name):
+    """โหลดโมเดลในโปรเซสนี้แล้วสร้าง runtime ตาม backend ที่ตั้งค่าไว้"""
+    model, version = _load_model(name)
+    backend = RUNTIME_CONFIG.get(name, "eager")
+    eager = build_runtime(name, model, version, "eager", channels_last=False)
+    if backend == "eager" and not CHANNELS_LAST:
+        return eager
+    try:
+        calibration = calibration_batches(name)
+        runtime = build_runtime(name, model, version, backend, calibration=calibration)
+        runtime.accuracy = check_accuracy(model, runtime, calibration)
+    except Exception as e:
+        logger.warning("%s runtime '%s' unavailable (%s), using eager", name, backend, e)
+        eager.accuracy = {"fallback_from": backend, "error": str(e)}
+        return eager
+    if not runtime.accuracy["passed"]:
+        logger.warning("%s runtime '%s' failed accuracy check %s, using eager", name, backend, runtime.accuracy)
+        eager.accuracy = {"fallback_from": backend, **runtime.accuracy}
+        return eager
+    logger.info("%s runtime '%s' ready: %s", name, backend, runtime.accuracy)
+    return runtime
+
+
+def runtime_ready(name):
+    return name in _runtimes
+
+
+def runtime_stats():
+    with _runtimes_lock:
+        return {name: rt.info() for name, rt in _runtimes.items()}
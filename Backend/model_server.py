@@ -0,0 +1,504 @@
+"""
+Optional dedicated inference process shared by every HTTP worker.
+
+    python -m Backend.model_server --socket /tmp/emotion-model.sock
+    EMOTION_MODEL_SERVER=/tmp/emotion-model.sock uvicorn Backend.main:app --workers 8
+
+With ``EMOTION_MODEL_SERVER`` set, HTTP workers never load the ResNet18 weights:
+``get_runtime`` returns a ``RemoteRuntime`` and workers only decode, detect and
+preprocess. Several sockets may be listed (comma separated) to run a few model
+servers; each worker picks one by PID.
+
+Tensor hand-off avoids pickling entirely. Each worker creates one
+``multiprocessing.shared_memory`` segment split into ``EMOTION_MODEL_SERVER_SLOTS``
+fixed-size slots (a ring of input + output buffers). It writes a sample straight
+into a free slot and sends a 10-byte request frame (slot, model, shape) over the
+Unix socket. The server queues requests from all workers per model and gathers
+up to ``EMOTION_MODEL_SERVER_MAX_BATCH`` samples (waiting at most
+``EMOTION_MODEL_SERVER_MAX_WAIT_MS``) into one forward pass. It then writes the
+logits back into each slot and answers with a 7-byte reply frame. Audio MFCCs,
+whose three channels are copies, travel as a single channel.
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import torch
+
+try:
+    from .model_runtime import create_local_runtime
+except ImportError:
+    try:
+        from Backend.model_runtime import create_local_runtime
+    except ImportError:
+        from model_runtime import create_local_runtime
+
+logger = logging.getLogger(__name__)
+
+MODEL_SERVER_SOCKETS = [s.strip() for s in os.environ.get("EMOTION_MODEL_SERVER", "").split(",") if s.strip()]
+MODEL_SERVER_SLOTS = int(os.environ.get("EMOTION_MODEL_SERVER_SLOTS", "64"))
+MODEL_SERVER_MAX_BATCH = int(os.environ.get("EMOTION_MODEL_SERVER_MAX_BATCH", "32"))
+MODEL_SERVER_MAX_WAIT_MS = float(os.environ.get("EMOTION_MODEL_SERVER_MAX_WAIT_MS", "3"))
+MODEL_SERVER_TIMEOUT_S = float(os.environ.get("EMOTION_MODEL_SERVER_TIMEOUT_S", "30"))
+
+KINDS = ("image", "audio")
+SLOT_INPUT_BYTES = 3 * 224 * 224 * 4  # อินพุตที่ใหญ่ที่สุด: ภาพ float32 [3, 224, 224]
+SLOT_OUTPUT_FLOATS = 64
+SLOT_BYTES = SLOT_INPUT_BYTES + SLOT_OUTPUT_FLOATS * 4
+
+_REQUEST = struct.Struct("<IBBHH")  # slot, kind, channels, height, width
+_REPLY = struct.Struct("<IBH")  # slot, status (0 = ok), จำนวน logits
+_STATUS_OK, _STATUS_ERROR = 0, 1
+
+
+class ModelServerError(RuntimeError):
+    """ติดต่อ model server ไม่ได้ หรือ server ประมวลผลไม่สำเร็จ"""
+
+
+# ---------------- framing ----------------
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if k == 0:
+            return None
+        got += k
+    return bytes(buf)
+
+
+def _send_json(sock, obj):
+    data = json.dumps(obj).encode("utf-8")
+    sock.sendall(struct.pack("<I", len(data)) + data)
+
+
+def _recv_json(sock):
+    head = _recv_exact(sock, 4)
+    if head is None:
+        return None
+    data = _recv_exact(sock, struct.unpack("<I", head)[0])
+    return None if data is None else json.loads(data)
+
+
+class _SlotRing:
+    """มุมมอง numpy ของ slot ใน shared memory (ไม่มีการคัดลอก)"""
+
+    def __init__(self, shm, slots):
+        self.shm = shm
+        self.slots = slots
+
+    def input(self, slot, shape):
+        return np.ndarray(shape, dtype=np.float32, buffer=self.shm.buf, offset=slot * SLOT_BYTES)
+
+    def output(self, slot, n):
+        return np.ndarray((n,), dtype=np.float32, buffer=self.shm.buf, offset=slot * SLOT_BYTES + SLOT_INPUT_BYTES)
+
+
+# ---------------- server ----------------
+class _Connection:
+    def __init__(self, sock, ring, pid):
+        self.sock = sock
+        self.ring = ring
+        self.pid = pid
+        self.send_lock = threading.Lock()
+        self.alive = True
+
+    def reply(self, frames):
+        if not self.alive:
+            return
+        try:
+            with self.send_lock:
+                self.sock.sendall(frames)
+        except OSError:
+            self.alive = False
+
+
+class ModelServer:
+    def __init__(self, path, kinds=KINDS, max_batch=MODEL_SERVER_MAX_BATCH, max_wait_ms=MODEL_SERVER_MAX_WAIT_MS):
+        self.path = path
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        # โหลดและ warm-up โมเดลก่อนเปิด socket: worker ที่ต่อได้แปลว่าพร้อมแล้ว
+        self.runtimes = {kind: create_local_runtime(kind) for kind in kinds}
+        self.queues = {kind: queue.Queue() for kind in kinds}
+        self.stats = {kind: {"batches": 0, "items": 0, "errors": 0, "infer_ms": 0.0} for kind in kinds}
+        self.clients = 0
+        self._stats_lock = threading.Lock()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(128)
+        for kind in self.runtimes:
+            threading.Thread(target=self._batch_loop, args=(kind,), name=f"batch-{kind}", daemon=True).start()
+        logger.info("model server listening on %s (%s)", self.path, ", ".join(self.runtimes))
+        try:
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _serve_client(self, sock):
+        shm = None
+        try:
+            hello = _recv_json(sock)
+            if hello is None:
+                return
+            shm = shared_memory.SharedMemory(name=hello["shm"])
+            # segment เป็นของ worker: อย่าให้ resource_tracker ของ server ลบทิ้งตอนปิด
+            try:
+                resource_tracker.unregister(shm._name, "shared_memory")
+            except Exception:
+                pass
+            slots = int(hello["slots"])
+            if slots * SLOT_BYTES > shm.size:
+                _send_json(sock, {"ok": False, "error": "shared memory segment smaller than its slots"})
+                return
+            conn = _Connection(sock, _SlotRing(shm, slots), hello.get("pid"))
+            _send_json(sock, {"ok": True, "runtimes": {k: rt.info() for k, rt in self.runtimes.items()}})
+            with self._stats_lock:
+                self.clients += 1
+            logger.info("worker %s connected", conn.pid)
+            try:
+                self._read_requests(conn)
+            finally:
+                conn.alive = False
+                with self._stats_lock:
+                    self.clients -= 1
+                logger.info("worker %s disconnected", conn.pid)
+        except Exception:
+            logger.exception("model server connection error")
+        finally:
+            sock.close()
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:  # batch ที่กำลังรันยังอ้างถึง slot อยู่; ปล่อยให้ GC ปิดเอง
+                    pass
+
+    def _read_requests(self, conn):
+        while True:
+            frame = _recv_exact(conn.sock, _REQUEST.size)
+            if frame is None:
+                return
+            slot, kind, channels, height, width = _REQUEST.unpack(frame)
+            if (slot >= conn.ring.slots or kind >= len(KINDS) or KINDS[kind] not in self.queues
+                    or channels * height * width * 4 > SLOT_INPUT_BYTES):
+                conn.reply(_REPLY.pack(slot, _STATUS_ERROR, 0))
+                continue
+            self.queues[KINDS[kind]].put((conn, slot, (channels, height, width)))
+
+    def _batch_loop(self, kind):
+        q = self.queues[kind]
+        while True:
+            items = [q.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    items.append(q.get(timeout=remaining) if remaining > 0 else q.get_nowait())
+                except queue.Empty:
+                    break
+            groups = {}
+            for item in items:
+                groups.setdefault(item[2], []).append(item)
+            for shape, group in groups.items():
+                self._run(kind, shape, [i for i in group if i[0].alive])
+
+    def _run(self, kind, shape, items):
+        if not items:
+            return
+        channels, height, width = shape
+        # MFCC ส่งมาช่องเดียว ขยายกลับเป็น 3 ช่องตอนรวม batch (การคัดลอกครั้งเดียวที่มี)
+        batch = np.empty((len(items), 3 if channels == 1 else channels, height, width), dtype=np.float32)
+        for i, (conn, slot, _) in enumerate(items):
+            batch[i] = conn.ring.input(slot, shape)
+        started = time.perf_counter()
+        try:
+            with torch.no_grad():
+                logits = self.runtimes[kind](torch.from_numpy(batch)).float().numpy()
+            status = _STATUS_OK
+        except Exception:
+            logger.exception("%s inference failed", kind)
+            logits, status = None, _STATUS_ERROR
+        with self._stats_lock:
+            s = self.stats[kind]
+            s["batches"] += 1
+            s["items"] += len(items)
+            s["errors"] += status != _STATUS_OK
+            s["infer_ms"] += (time.perf_counter() - started) * 1000.0
+
+        replies = {}
+        n = 0 if logits is None else min(logits.shape[1], SLOT_OUTPUT_FLOATS)
+        for i, (conn, slot, _) in enumerate(items):
+            if logits is not None:
+                conn.ring.output(slot, n)[:] = logits[i, :n]
+            replies.setdefault(conn, bytearray()).extend(_REPLY.pack(slot, status, n))
+        for conn, frames in replies.items():
+            conn.reply(bytes(frames))
+
+
+# ---------------- client (ใน HTTP worker) ----------------
+class ModelServerClient:
+    def __init__(self, path, slots=MODEL_SERVER_SLOTS, timeout=MODEL_SERVER_TIMEOUT_S):
+        self.path = path
+        self.slots = max(1, int(slots))
+        self.timeout = timeout
+        self.server_info = None
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * SLOT_BYTES)
+        self._ring = _SlotRing(self._shm, self.slots)
+        self._free = list(range(self.slots))
+        self._free_cond = threading.Condition()
+        # _pending และ _lost แก้ภายใต้ _free_cond เสมอ: คำตอบที่มาช้าต้องเห็นสถานะที่ตรงกันทั้งสองฝั่ง
+        self._pending = {}
+        self._lost = set()
+        self._lock = threading.Lock()
+        self._sock = None
+        self.requests = 0
+        self.late_replies = 0
+        atexit.register(self.close)
+
+    def connect(self):
+        with self._lock:
+            if self._sock is not None:
+                return
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                _send_json(sock, {"shm": self._shm.name, "slots": self.slots, "pid": os.getpid()})
+                info = _recv_json(sock)
+                if not info or not info.get("ok"):
+                    raise ModelServerError(f"model server at {self.path} refused the connection")
+                sock.settimeout(None)
+            except OSError as e:
+                sock.close()
+                raise ModelServerError(f"cannot reach model server at {self.path}: {e}") from e
+            self.server_info = info
+            self._sock = sock
+            threading.Thread(target=self._read_replies, args=(sock,), name="model-server-reader", daemon=True).start()
+
+    def _read_replies(self, sock):
+        try:
+            while True:
+                frame = _recv_exact(sock, _REPLY.size)
+                if frame is None:
+                    break
+                slot, status, n = _REPLY.unpack(frame)
+                with self._free_cond:
+                    future = self._pending.pop(slot, None)
+                    if future is None and slot in self._lost:
+                        # คำตอบของ request ที่ timeout ไปแล้ว: server เขียน slot นี้เสร็จแล้ว คืนเข้า ring ได้
+                        self._lost.discard(slot)
+                        self._free.append(slot)
+                        self.late_replies += 1
+                        self._free_cond.notify_all()
+                if future is None:
+                    continue
+                if status == _STATUS_OK:
+                    future.set_result(self._ring.output(slot, n).copy())
+                else:
+                    future.set_exception(ModelServerError("model server failed to run the batch"))
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if self._sock is sock:
+                    self._sock = None
+            sock.close()
+            with self._free_cond:
+                orphaned, self._pending = list(self._pending.values()), {}
+                # ไม่มีคำตอบใดจะตามมาอีกแล้ว slot ที่ค้างรอทั้งหมดจึงคืนได้
+                self._free.extend(self._lost)
+                self._lost.clear()
+                self._free_cond.notify_all()
+            for future in orphaned:
+                if not future.done():
+                    future.set_exception(ModelServerError("connection to model server lost"))
+
+    def _acquire(self, n):
+        # จองทีละชุดภายใต้ condition เดียว: caller สองรายจะไม่ถือ slot คนละครึ่งแล้วรอกันตาย
+        deadline = time.monotonic() + self.timeout
+        with self._free_cond:
+            while len(self._free) < n:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._free_cond.wait(remaining):
+                    raise ModelServerError("no free shared-memory slots")
+            taken, self._free = self._free[:n], self._free[n:]
+        return taken
+
+    def infer(self, kind, x):
+        """ส่ง batch [B, C, H, W] ไปรันที่ model server คืน logits tensor [B, n_classes]"""
+        self.connect()
+        x = x.detach().to("cpu", torch.float32)
+        if kind == "audio" and x.shape[1] == 3 and x.stride(1) == 0:
+            x = x[:, :1]  # สามช่องเป็นสำเนากัน (expand) ส่งช่องเดียวพอ
+        arr = x.contiguous().numpy()
+        shape = tuple(arr.shape[1:])
+        if arr[0].nbytes > SLOT_INPUT_BYTES:
+            raise ValueError(f"input {shape} does not fit a {SLOT_INPUT_BYTES}-byte slot")
+        outputs = []
+        for start in range(0, arr.shape[0], self.slots):
+            outputs.extend(self._infer_chunk(kind, arr[start:start + self.slots], shape))
+        return torch.from_numpy(np.stack(outputs))
+
+    def _infer_chunk(self, kind, arr, shape):
+        slots = self._acquire(arr.shape[0])
+        futures = []
+        frames = bytearray()
+        for sample, slot in zip(arr, slots):
+            self._ring.input(slot, shape)[...] = sample
+            futures.append(Future())
+            frames.extend(_REQUEST.pack(slot, KINDS.index(kind), *shape))
+        with self._free_cond:
+            self._pending.update(zip(slots, futures))
+        sent = False
+        try:
+            with self._lock:
+                sock = self._sock
+            if sock is None:
+                raise ModelServerError("connection to model server lost")
+            try:
+                sock.sendall(frames)
+            except OSError as e:
+                raise ModelServerError(f"model server send failed: {e}") from e
+            sent = True
+            self.requests += len(slots)
+            try:
+                return [future.result(timeout=self.timeout) for future in futures]
+            except FutureTimeout:
+                raise ModelServerError("model server timed out") from None
+        finally:
+            with self._free_cond:
+                for slot in slots:
+                    # ยังอยู่ใน _pending = reader ยังไม่ได้รับคำตอบ: server อาจเขียนทับภายหลัง
+                    # จึงพักไว้ใน _lost จนกว่าคำตอบที่มาช้าจะมาถึงหรือการเชื่อมต่อหลุด
+                    if self._pending.pop(slot, None) is not None and sent:
+                        self._lost.add(slot)
+                    else:
+                        self._free.append(slot)
+                self._free_cond.notify_all()
+
+    def stats(self):
+        with self._free_cond:
+            free = len(self._free)
+            lost = len(self._lost)
+        return {
+            "socket": self.path,
+            "connected": self._sock is not None,
+            "slots": self.slots,
+            "slots_in_use": self.slots - free,
+            "lost_slots": lost,
+            "late_replies": self.late_replies,
+            "requests": self.requests,
+        }
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        if self._shm is not None:
+            try:
+                self._shm.close()
+                self._shm.unlink()
+            except (FileNotFoundError, BufferError):
+                pass
+            self._shm = None
+
+
+class RemoteRuntime:
+    """runtime ฝั่ง worker ที่ส่งงานไปให้ model server (เรียกแบบ ``runtime(x) -> logits`` เหมือนเดิม)"""
+
+    backend = "remote"
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.device = torch.device("cpu")
+
+    def __call__(self, x):
+        return self.client.infer(self.name, x)
+
+    def info(self):
+        server = (self.client.server_info or {}).get("runtimes", {}).get(self.name)
+        return {"backend": self.backend, "server": server, **self.client.stats()}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if not MODEL_SERVER_SOCKETS:
+                    raise ModelServerError("EMOTION_MODEL_SERVER is not set")
+                _client = ModelServerClient(MODEL_SERVER_SOCKETS[os.getpid() % len(MODEL_SERVER_SOCKETS)])
+    return _client
+
+
+def remote_runtime(name):
+    return RemoteRuntime(name, get_client())
+
+
+def model_server_ready():
+    """worker ต่อ model server ได้หรือไม่ (server เปิด socket หลังโหลดโมเดลเสร็จแล้วเท่านั้น)"""
+    try:
+        get_client().connect()
+        return True
+    except ModelServerError:
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared inference process for the emotion models")
+    parser.add_argument("--socket", default=(MODEL_SERVER_SOCKETS or ["/tmp/emotion-model.sock"])[0])
+    parser.add_argument("--models", default=",".join(KINDS), help="comma separated: image,audio")
+    parser.add_argument("--max-batch", type=int, default=MODEL_SERVER_MAX_BATCH)
+    parser.add_argument("--max-wait-ms", type=float, default=MODEL_SERVER_MAX_WAIT_MS)
+    args = parser.parse_args(argv)
+    try:
+        from .metrics import configure_logging
+    except ImportError:
+        try:
+            from Backend.metrics import configure_logging
+        except ImportError:
+            from metrics import configure_logging
+    try:
+        from .thread_tuning import tune_model_server
+    except ImportError:
+        try:
+            from Backend.thread_tuning import tune_model_server
+        except ImportError:
+            from thread_tuning import tune_model_server
+    configure_logging()
+    kinds = [k.strip() for k in args.models.split(",") if k.strip() in KINDS]
+    tune_model_server(len(kinds))
+    ModelServer(args.socket, kinds, args.max_batch, args.max_wait_ms).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
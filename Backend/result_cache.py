@@ -0,0 +1,210 @@
+"""
+Content-hash prediction cache for repeated uploads.
+
+Keys are a BLAKE2b digest of the uploaded bytes plus the model version and any
+request parameters that change the result. Values are JSON-serialisable
+responses. The in-process tier is an LRU bounded by entry count and total
+serialized size, with an optional TTL. An optional SQLite file
+(``EMOTION_CACHE_DB``) is shared by every uvicorn worker on the host, so one
+worker's miss becomes another worker's hit.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_ENABLED = os.environ.get("EMOTION_CACHE_ENABLED", "1") not in ("0", "false", "False")
+CACHE_MAX_ENTRIES = int(os.environ.get("EMOTION_CACHE_MAX_ENTRIES", "4096"))
+CACHE_MAX_BYTES = int(os.environ.get("EMOTION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL_S = float(os.environ.get("EMOTION_CACHE_TTL_S", "0"))  # 0 = ไม่หมดอายุ
+CACHE_DB = os.environ.get("EMOTION_CACHE_DB", "")
+CACHE_DB_MAX_ENTRIES = int(os.environ.get("EMOTION_CACHE_DB_MAX_ENTRIES", "100000"))
+
+
+def content_key(data, namespace, version, **params):
+    """แฮชของ bytes ที่อัพโหลด + ชื่อโมเดล/เวอร์ชัน + พารามิเตอร์ที่มีผลต่อผลลัพธ์"""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{namespace}\0{version}\0".encode("utf-8"))
+    if params:
+        h.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    h.update(b"\0")
+    h.update(data)
+    return h.hexdigest()
+
+
+class _SQLiteStore:
+    """ที่เก็บบนดิสก์ใช้ร่วมกันหลายโปรเซส (WAL mode, หนึ่ง connection ต่อเธรด)"""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, expires REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS predictions_created ON predictions(created)")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, now):
+        row = self._conn().execute(
+            "SELECT value, expires FROM predictions WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires <= now:
+            return None
+        return value, expires
+
+    def set(self, key, value, now, expires):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO predictions (key, value, created, expires) VALUES (?, ?, ?, ?)",
+            (key, value, now, expires),
+        )
+        self._writes += 1
+        if self._writes % 256 == 0:
+            self._prune(conn, now)
+
+    def _prune(self, conn, now):
+        conn.execute("DELETE FROM predictions WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        conn.execute(
+            "DELETE FROM predictions WHERE key IN ("
+            " SELECT key FROM predictions ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self):
+        self._conn().execute("DELETE FROM predictions")
+
+
+class PredictionCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 ttl_s=CACHE_TTL_S, db_path=CACHE_DB, db_max_entries=CACHE_DB_MAX_ENTRIES):
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self.ttl_s = float(ttl_s) if ttl_s else 0.0
+        self._lru = OrderedDict()  # key -> (serialized, value, expires)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._store = _SQLiteStore(db_path, db_max_entries) if db_path else None
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key):
+        """คืนผลลัพธ์ที่แคชไว้ หรือ None หากไม่มี/หมดอายุ"""
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                serialized, value, expires = entry
+                if expires is not None and expires <= now:
+                    self._drop(key)
+                    self._counters["expired"] += 1
+                else:
+                    self._lru.move_to_end(key)
+                    self._counters["hits"] += 1
+                    return value
+
+        if self._store is not None:
+            try:
+                found = self._store.get(key, now)
+            except sqlite3.Error:
+                found = None
+            if found is not None:
+                serialized, expires = found
+                value = json.loads(serialized)
+                with self._lock:
+                    self._insert(key, serialized, value, expires)
+                    self._counters["disk_hits"] += 1
+                return value
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def set(self, key, value):
+        now = time.time()
+        expires = now + self.ttl_s if self.ttl_s > 0 else None
+        serialized = json.dumps(value, separators=(",", ":"))
+        with self._lock:
+            self._insert(key, serialized, value, expires)
+            self._counters["sets"] += 1
+        if self._store is not None:
+            try:
+                self._store.set(key, serialized, now, expires)
+            except sqlite3.Error:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._bytes = 0
+        if self._store is not None:
+            self._store.clear()
+
+    # ต้องถือ self._lock ก่อนเรียก
+    def _insert(self, key, serialized, value, expires):
+        if key in self._lru:
+            self._drop(key)
+        size = len(serialized)
+        if size > self.max_bytes:
+            return
+        self._lru[key] = (serialized, value, expires)
+        self._bytes += size
+        while len(self._lru) > self.max_entries or self._bytes > self.max_bytes:
+            old_key = next(iter(self._lru))
+            self._drop(old_key)
+            self._counters["evictions"] += 1
+
+    def _drop(self, key):
+        serialized, _, _ = self._lru.pop(key)
+        self._bytes -= len(serialized)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            entries = len(self._lru)
+            size = self._bytes
+        lookups = counters["hits"] + counters["disk_hits"] + counters["misses"]
+        return {
+            **counters,
+            "hit_rate": ((counters["hits"] + counters["disk_hits"]) / lookups) if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_s": self.ttl_s,
+            "shared_db": self._store.path if self._store is not None else None,
+        }
+
+
+# Lazy init เพื่อไม่ให้เปิดไฟล์ SQLite ตอน import
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_prediction_cache():
+    """คืน PredictionCache ของโปรเซส หรือ None ถ้าปิดไว้ด้วย EMOTION_CACHE_ENABLED=0"""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PredictionCache()
+    return _cache
@@ -0,0 +1,416 @@
+"""
+CPU thread topology for torch, OpenCV and the executor pools.
+
+Left alone, every process sizes torch's intra-op pool, OpenCV's pool and the
+image/audio executors from the host's core count. With several uvicorn workers,
+or a container whose cgroup quota is smaller than the host, the same cores are
+promised many times over and tail latency suffers. ``tune()`` runs once at
+startup, before the models warm up:
+
+1. ``cpu_topology`` counts the CPUs this process may really use: the smaller of
+   the affinity mask and the cgroup CPU quota (v2 ``cpu.max`` or v1
+   ``cpu.cfs_quota_us``).
+2. ``plan`` divides them by the number of server processes (``EMOTION_WORKERS``,
+   else uvicorn's ``WEB_CONCURRENCY``) and splits each process's share between
+   the image and audio pools first (image + audio threads within the budget,
+   one each at minimum), then gives each pool thread ``budget // (image + audio)``
+   torch/OpenCV threads, so with both pools busy the total stays within the
+   budget. Inter-op threads are set to 1
+   (the models never run ops in parallel).
+3. With ``EMOTION_THREAD_TUNING=bench`` a few candidate splits are timed on the
+   real ``predict_face_image`` (plus Haar detection) and ``predict_audio``
+   paths and the one with the best combined throughput wins. The result is
+   stored in ``EMOTION_THREAD_TUNING_FILE`` keyed by a host fingerprint. Later
+   startups reuse it (``auto`` picks it up too), and workers that start
+   together wait on a file lock while the first one benchmarks.
+
+Explicit ``EMOTION_TORCH_THREADS``, ``EMOTION_CV2_THREADS`` and
+``EMOTION_*_POOL_WORKERS`` always win. ``EMOTION_THREAD_TUNING=off`` leaves
+everything at library defaults.
+
+    python -m Backend.thread_tuning             # show topology and plan
+    python -m Backend.thread_tuning --bench     # benchmark and persist
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import threading
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: ไม่มี file lock ก็ยังทำงานได้ (แค่อาจ benchmark ซ้ำกัน)
+    fcntl = None
+
+try:
+    from .executors import configure_pools
+    from .model_runtime import MODEL_SERVER, RUNTIME_CACHE_DIR
+except ImportError:
+    try:
+        from Backend.executors import configure_pools
+        from Backend.model_runtime import MODEL_SERVER, RUNTIME_CACHE_DIR
+    except ImportError:
+        from executors import configure_pools
+        from model_runtime import MODEL_SERVER, RUNTIME_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# off = ไม่ยุ่งกับค่า default, auto = คำนวณจาก topology, bench = วัดจริงแล้วบันทึกผล
+THREAD_TUNING = os.environ.get("EMOTION_THREAD_TUNING", "auto")
+SERVER_WORKERS = int(os.environ.get("EMOTION_WORKERS", os.environ.get("WEB_CONCURRENCY", "1")))
+TUNING_FILE = Path(os.environ.get("EMOTION_THREAD_TUNING_FILE", str(RUNTIME_CACHE_DIR / "thread_tuning.json")))
+BENCH_SECONDS = float(os.environ.get("EMOTION_THREAD_TUNING_SECONDS", "1.5"))
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+_applied = None
+_lock = threading.Lock()
+
+
+# ---------------- topology ----------------
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_paths():
+    """(path ของ cgroup v1 ต่อ controller, path ของ cgroup v2) จาก /proc/self/cgroup"""
+    v1, v2 = {}, None
+    for line in (_read("/proc/self/cgroup") or "").splitlines():
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        if parts[1] == "":
+            v2 = parts[2]
+        else:
+            for controller in parts[1].split(","):
+                v1[controller] = parts[2]
+    return v1, v2
+
+
+def cgroup_cpu_quota(root=CGROUP_ROOT):
+    """โควตา CPU ของ cgroup เป็นจำนวนคอร์ (ทศนิยมได้) หรือ None ถ้าไม่จำกัด"""
+    v1, v2 = _cgroup_paths()
+    if v2 is not None:
+        for base in (os.path.join(root, v2.lstrip("/")), root):
+            raw = _read(os.path.join(base, "cpu.max"))
+            if raw:
+                quota, _, period = raw.partition(" ")
+                if quota == "max":
+                    return None
+                return int(quota) / int(period or 100000)
+    path = v1.get("cpu", "/").lstrip("/")
+    for mount in ("cpu", "cpu,cpuacct"):
+        for base in (os.path.join(root, mount, path), os.path.join(root, mount)):
+            quota = _read(os.path.join(base, "cpu.cfs_quota_us"))
+            if quota is None:
+                continue
+            period = _read(os.path.join(base, "cpu.cfs_period_us")) or "100000"
+            return int(quota) / int(period) if int(quota) > 0 else None
+    return None
+
+
+def cpu_topology():
+    logical = os.cpu_count() or 1
+    try:
+        affinity = len(os.sched_getaffinity(0))
+    except AttributeError:  # macOS / Windows
+        affinity = logical
+    quota = cgroup_cpu_quota()
+    effective = affinity if quota is None else max(1, min(affinity, int(quota + 0.5)))
+    return {"logical": logical, "affinity": affinity, "cgroup_quota": quota, "effective": effective}
+
+
+# ---------------- plans ----------------
+def _split_pools(slots, max_image):
+    # แบ่ง thread ของ pool ก่อนให้ image + audio ไม่เกิน slots (ยกเว้นขั้นต่ำ pool ละ 1 เมื่อ slots < 2)
+    audio_workers = max(1, min(2, slots // 3))
+    image_workers = max(1, min(max_image, slots - audio_workers))
+    return image_workers, audio_workers
+
+
+def plan(cpus, workers=SERVER_WORKERS, remote_models=bool(MODEL_SERVER), torch_threads=None):
+    """
+    แบ่ง CPU ของโปรเซสนี้ (``cpus`` / ``workers``) ให้ pool ภาพ/เสียง และ thread ของ torch/OpenCV
+    ``torch_threads`` กำหนดเองได้ (ใช้ตอน benchmark) ไม่งั้นเลือกให้ไม่เกิน budget เมื่อทุก pool ทำงานพร้อมกัน
+    """
+    budget = max(1, cpus // max(1, workers))
+    if torch_threads is None:
+        image_workers, audio_workers = _split_pools(budget, 4)
+        torch_threads = max(1, budget // (image_workers + audio_workers))
+    else:
+        torch_threads = max(1, min(budget, int(torch_threads)))
+        image_workers, audio_workers = _split_pools(budget // torch_threads, 8)
+    return {
+        "budget": budget,
+        "image_workers": image_workers,
+        "audio_workers": audio_workers,
+        # ใน model-server mode โปรเซสนี้ไม่รันโมเดลเอง: ให้ CPU กับ detect แทน
+        "torch_threads": 1 if remote_models else torch_threads,
+        "interop_threads": 1,
+        "cv2_threads": max(1, budget // image_workers) if remote_models else torch_threads,
+    }
+
+
+def candidates(cpus, workers=SERVER_WORKERS):
+    """แผนที่จะลอง benchmark: torch threads = 1, 2, 4, ... จนถึง budget / 2 (pool เล็กลงตามสัดส่วน)"""
+    budget = max(1, cpus // max(1, workers))
+    # มีสอง pool เสมอ: torch threads เกิน budget / 2 จะเกิน budget ทันที
+    top = max(1, budget // 2)
+    threads = sorted({2 ** i for i in range(int(math.log2(top)) + 1)} | {top})
+    seen, out = set(), []
+    for t in threads:
+        p = plan(cpus, workers, remote_models=False, torch_threads=t)
+        key = (p["image_workers"], p["audio_workers"], p["torch_threads"])
+        if key not in seen:
+            seen.add(key)
+            out.append(p)
+    return out
+
+
+def fingerprint(topology, workers=SERVER_WORKERS):
+    import cv2
+    import torch
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "effective_cpus": topology["effective"],
+        "workers": workers,
+        "model_server": bool(MODEL_SERVER),
+        "torch": torch.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+# ---------------- apply ----------------
+def apply(cfg):
+    """ตั้งค่า thread ของ torch/OpenCV และขนาด pool (ค่าที่ตั้งผ่าน env มีผลเหนือกว่าเสมอ) คืนค่าที่ใช้จริง"""
+    import cv2
+    import torch
+    cfg = dict(cfg)
+    cfg["torch_threads"] = int(os.environ.get("EMOTION_TORCH_THREADS", cfg["torch_threads"]))
+    cfg["cv2_threads"] = int(os.environ.get("EMOTION_CV2_THREADS", cfg["cv2_threads"]))
+    torch.set_num_threads(cfg["torch_threads"])
+    try:
+        torch.set_num_interop_threads(cfg["interop_threads"])
+    except RuntimeError:
+        # ตั้งได้ครั้งเดียวก่อนเริ่มงาน parallel แรกของโปรเซส
+        cfg["interop_threads"] = torch.get_num_interop_threads()
+    cv2.setNumThreads(cfg["cv2_threads"])
+    pools = configure_pools(image=cfg["image_workers"], audio=cfg["audio_workers"])
+    cfg["image_workers"], cfg["audio_workers"] = pools["image"], pools["audio"]
+    return cfg
+
+
+# ---------------- benchmark ----------------
+def _bench_inputs():
+    try:
+        from .synthetic import synthetic_face, synthetic_wav
+        from .audio_io import decode_audio_bytes
+        from .utlis import crop_face_region
+    except ImportError:
+        try:
+            from Backend.synthetic import synthetic_face, synthetic_wav
+            from Backend.audio_io import decode_audio_bytes
+            from Backend.utlis import crop_face_region
+        except ImportError:
+            from synthetic import synthetic_face, synthetic_wav
+            from audio_io import decode_audio_bytes
+            from utlis import crop_face_region
+    img = synthetic_face(480)
+    face = crop_face_region(img, (120, 120, 240, 240))
+    waveform, sr = decode_audio_bytes(synthetic_wav(3.0), "bench.wav")
+    return img, face, waveform, sr
+
+
+def _run_candidate(cfg, inputs, seconds):
+    try:
+        from .face_detector import detect_faces
+        from .model_audio import predict_audio
+        from .model_image import classes as image_classes
+        from .model_runtime import get_runtime
+        from .utlis import predict_face_image
+    except ImportError:
+        try:
+            from Backend.face_detector import detect_faces
+            from Backend.model_audio import predict_audio
+            from Backend.model_image import classes as image_classes
+            from Backend.model_runtime import get_runtime
+            from Backend.utlis import predict_face_image
+        except ImportError:
+            from face_detector import detect_faces
+            from model_audio import predict_audio
+            from model_image import classes as image_classes
+            from model_runtime import get_runtime
+            from utlis import predict_face_image
+    import cv2
+    import torch
+
+    img, face, waveform, sr = inputs
+    runtime = get_runtime("image")
+    torch.set_num_threads(cfg["torch_threads"])
+    cv2.setNumThreads(cfg["cv2_threads"])
+    latencies = {"image": [], "audio": []}
+    calls = {
+        "image": lambda: (detect_faces(img), predict_face_image(face, runtime, image_classes)),
+        "audio": lambda: predict_audio(waveform, sr),
+    }
+    for call in calls.values():  # warm-up ที่จำนวน thread นี้
+        call()
+
+    deadline = time.perf_counter() + seconds
+
+    def loop(kind):
+        out = latencies[kind]
+        while time.perf_counter() < deadline:
+            t0 = time.perf_counter()
+            calls[kind]()
+            out.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=loop, args=("image",)) for _ in range(cfg["image_workers"])]
+    threads += [threading.Thread(target=loop, args=("audio",)) for _ in range(cfg["audio_workers"])]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    result = {}
+    for kind, values in latencies.items():
+        values.sort()
+        result[kind] = {
+            "ops_per_s": len(values) / elapsed,
+            "p95_ms": values[min(len(values) - 1, int(0.95 * len(values)))] * 1000.0 if values else None,
+        }
+    return result
+
+
+def benchmark(topology, workers=SERVER_WORKERS, seconds=BENCH_SECONDS):
+    """
+    วัด throughput ของแต่ละแผนบน path ทำนายจริง คืน (แผนที่ดีที่สุด, ผลทั้งหมด)
+    คะแนน = ผลรวมของ throughput ภาพและเสียงที่ normalize ด้วยค่าสูงสุดของแต่ละฝั่ง (เสมอกันดู p95 ของภาพ)
+    """
+    plans = candidates(topology["effective"], workers)
+    if len(plans) == 1:
+        return plans[0], []
+    inputs = _bench_inputs()
+    runs = [(p, _run_candidate(p, inputs, seconds)) for p in plans]
+    best_image = max(r["image"]["ops_per_s"] for _, r in runs) or 1.0
+    best_audio = max(r["audio"]["ops_per_s"] for _, r in runs) or 1.0
+    results = []
+    for p, r in runs:
+        score = r["image"]["ops_per_s"] / best_image + r["audio"]["ops_per_s"] / best_audio
+        results.append({**p, **{f"{k}_{m}": v for k, d in r.items() for m, v in d.items()}, "score": round(score, 4)})
+    best = max(results, key=lambda r: (r["score"], -(r["image_p95_ms"] or 0.0)))
+    return {k: best[k] for k in plans[0]}, results
+
+
+# ---------------- persisted config ----------------
+def _load(path, key):
+    try:
+        stored = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    return stored.get("plan") if stored.get("fingerprint") == key else None
+
+
+def _save(path, key, cfg, results):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"fingerprint": key, "plan": cfg, "benchmark": results, "created": time.time()}, indent=2))
+    os.replace(tmp, path)
+
+
+def _benchmarked_plan(topology, workers, path=TUNING_FILE):
+    """แผนจากไฟล์ถ้า fingerprint ตรง ไม่งั้น benchmark แล้วบันทึก (ถือ file lock ระหว่างนั้น)"""
+    key = fingerprint(topology, workers)
+    cfg = _load(path, key)
+    if cfg is not None:
+        return cfg, "file"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # worker อื่นอาจ benchmark เสร็จระหว่างที่เรารอ lock
+        cfg = _load(path, key)
+        if cfg is not None:
+            return cfg, "file"
+        started = time.perf_counter()
+        cfg, results = benchmark(topology, workers)
+        _save(path, key, cfg, results)
+        logger.info("thread tuning benchmark took %.1f s, saved to %s", time.perf_counter() - started, path)
+        return cfg, "benchmark"
+
+
+def tune(mode=THREAD_TUNING, workers=SERVER_WORKERS):
+    """เลือกและใช้การตั้งค่า thread ของโปรเซสนี้ (เรียกครั้งเดียวตอน startup ก่อน warm-up โมเดล)"""
+    global _applied
+    with _lock:
+        if _applied is not None or mode == "off":
+            return _applied
+        topology = cpu_topology()
+        cfg, source = plan(topology["effective"], workers), "topology"
+        if mode == "bench" and not MODEL_SERVER:
+            try:
+                cfg, source = _benchmarked_plan(topology, workers)
+            except Exception as e:
+                logger.warning("thread tuning benchmark failed, using the topology plan: %s", e)
+        elif not MODEL_SERVER:
+            # auto: ใช้ผล benchmark ครั้งก่อน (เช่นจาก CLI) ถ้าเป็นเครื่อง/จำนวน worker เดิม
+            stored = _load(TUNING_FILE, fingerprint(topology, workers))
+            if stored is not None:
+                cfg, source = stored, "file"
+        cfg = apply(cfg)
+        _applied = {**cfg, "source": source, "workers": workers, "topology": topology}
+        logger.info(
+            "threads: torch=%d interop=%d cv2=%d pools image=%d audio=%d (%s, %d cpus / %d workers)",
+            cfg["torch_threads"], cfg["interop_threads"], cfg["cv2_threads"], cfg["image_workers"],
+            cfg["audio_workers"], source, topology["effective"], workers,
+        )
+        return _applied
+
+
+def tune_model_server(kinds, mode=THREAD_TUNING):
+    """model server: หนึ่ง batch thread ต่อโมเดล จึงแบ่ง CPU ให้แต่ละตัวเท่าๆ กัน (EMOTION_TORCH_THREADS มีผลเหนือกว่า)"""
+    global _applied
+    with _lock:
+        if _applied is not None or mode == "off":
+            return _applied
+        topology = cpu_topology()
+        threads = max(1, topology["effective"] // max(1, kinds))
+        cfg = apply({"budget": topology["effective"], "image_workers": 1, "audio_workers": 1,
+                     "torch_threads": threads, "interop_threads": 1, "cv2_threads": 1})
+        _applied = {**cfg, "source": "topology", "workers": 1, "topology": topology}
+        logger.info("model server threads: torch=%d per model (%d cpus)", cfg["torch_threads"], topology["effective"])
+        return _applied
+
+
+def tuning_status():
+    return _applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CPU thread tuning for the emotion API")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="uvicorn worker processes on this host")
+    parser.add_argument("--bench", action="store_true", help="benchmark candidates and persist the best plan")
+    parser.add_argument("--seconds", type=float, default=BENCH_SECONDS, help="benchmark time per candidate")
+    args = parser.parse_args(argv)
+    topology = cpu_topology()
+    out = {"topology": topology, "plan": plan(topology["effective"], args.workers)}
+    if args.bench:
+        # สั่งจาก CLI = ตั้งใจวัดใหม่ เขียนทับไฟล์เดิม
+        cfg, results = benchmark(topology, args.workers, args.seconds)
+        TUNING_FILE.parent.mkdir(parents=True, exist_ok=True)
+        _save(TUNING_FILE, fingerprint(topology, args.workers), cfg, results)
+        out.update({"plan": cfg, "benchmark": results, "saved_to": str(TUNING_FILE)})
+    print(json.dumps(out, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Upload size limits.
+
+``RequestSizeLimitMiddleware`` (pure ASGI) caps the request body while it is
+still streaming in: a ``Content-Length`` over the limit is answered with 413
+before any byte is read, and chunked/unknown-length bodies are counted as they
+arrive and cut off as soon as they cross the limit, so an oversized upload is
+never spooled in full. The limit is ``EMOTION_MAX_REQUEST_BYTES``, with the
+larger ``EMOTION_MAX_BATCH_REQUEST_BYTES`` for the batch/stream endpoints.
+
+``read_upload`` then reads a single ``UploadFile`` with a per-file cap instead
+of an unbounded ``await file.read()``; ``spool_upload`` copies one to a temp
+file chunk by chunk for readers that need a path (``cv2.VideoCapture``).
+"""
+import json
+import os
+import tempfile
+
+MAX_REQUEST_BYTES = int(os.environ.get("EMOTION_MAX_REQUEST_BYTES", str(64 * 1024 * 1024)))
+MAX_BATCH_REQUEST_BYTES = int(os.environ.get("EMOTION_MAX_BATCH_REQUEST_BYTES", str(512 * 1024 * 1024)))
+MAX_IMAGE_UPLOAD_BYTES = int(os.environ.get("EMOTION_MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+MAX_AUDIO_UPLOAD_BYTES = int(os.environ.get("EMOTION_MAX_AUDIO_BYTES", str(50 * 1024 * 1024)))
+MAX_VIDEO_UPLOAD_BYTES = int(os.environ.get("EMOTION_MAX_VIDEO_BYTES", str(256 * 1024 * 1024)))
+SPOOL_CHUNK = 1024 * 1024
+
+# endpoint ที่รับไฟล์จำนวนมาก/ไฟล์ยาว ใช้เพดานของ batch แทน
+BATCH_PATH_PREFIXES = ("/predict/batch", "/predict-audio/batch", "/predict-audio/stream", "/predict-video", "/jobs")
+
+
+class UploadTooLarge(ValueError):
+    """ขนาด request หรือไฟล์เกินเพดานที่ตั้งไว้"""
+
+    def __init__(self, limit, what="request body"):
+        super().__init__(f"{what} exceeds {limit} bytes")
+        self.limit = limit
+
+
+def limit_for_path(path):
+    return MAX_BATCH_REQUEST_BYTES if path.startswith(BATCH_PATH_PREFIXES) else MAX_REQUEST_BYTES
+
+
+def too_large_body(limit):
+    return {"error": "payload_too_large", "limit_bytes": limit}
+
+
+async def read_upload(upload, limit, already_read=0):
+    """
+    อ่าน UploadFile ไม่เกิน ``limit`` bytes (เกินแล้ว raise UploadTooLarge โดยไม่อ่านส่วนที่เหลือ)
+    ``already_read`` = จำนวน bytes ที่ผู้เรียกอ่านไปก่อนแล้ว (นับรวมในเพดานเดียวกัน)
+    """
+    size = getattr(upload, "size", None)
+    if size is not None and size > limit:
+        raise UploadTooLarge(limit, f"file '{upload.filename}'")
+    data = await upload.read(max(0, limit - already_read) + 1)
+    if already_read + len(data) > limit:
+        raise UploadTooLarge(limit, f"file '{upload.filename}'")
+    return data
+
+
+async def spool_upload(upload, limit, suffix="", dir=None):
+    """
+    คัดลอก UploadFile ลงไฟล์ชั่วคราว (ใน ``dir`` ถ้าระบุ) ทีละ chunk ไม่เกิน ``limit`` bytes คืน path
+    ผู้เรียกต้องลบไฟล์เองเมื่อใช้เสร็จ
+    """
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=dir)
+    total = 0
+    try:
+        while True:
+            chunk = await upload.read(SPOOL_CHUNK)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > limit:
+                raise UploadTooLarge(limit, f"file '{upload.filename}'")
+            tmp.write(chunk)
+        tmp.close()
+        return tmp.name
+    except BaseException:
+        tmp.close()
+        os.unlink(tmp.name)
+        raise
+
+
+class RequestSizeLimitMiddleware:
+    def __init__(self, app, limit_for=limit_for_path):
+        self.app = app
+        self.limit_for = limit_for
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limit = self.limit_for(scope.get("path", ""))
+
+        for name, value in scope.get("headers", ()):
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > limit:
+                    await self._reject(send, limit)
+                    return
+                break
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise UploadTooLarge(limit)
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if exceeded:
+                # framework แปลง exception ตอน parse body เป็น 400 ของตัวเอง: แทนด้วย 413
+                if message["type"] == "http.response.start" and not started:
+                    started = True
+                    await self._reject(send, limit)
+                return
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadTooLarge:
+            if not started:
+                await self._reject(send, limit)
+
+    @staticmethod
+    async def _reject(send, limit):
+        body = json.dumps(too_large_body(limit)).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
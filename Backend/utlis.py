@@ -1,41 +1,93 @@
+import os
 import cv2
 import numpy as np
-from mtcnn import MTCNN
 from torchvision import transforms
 from PIL import Image
+import logging
+import threading
+import time
 import torch
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+try:
+    from .face_detector import detect_faces
+    from .face_cascade import cascade_enabled, detect_faces_tiered, mtcnn_boxes
+    from .metrics import observe_stage
+except ImportError:
+    try:
+        from Backend.face_detector import detect_faces
+        from Backend.face_cascade import cascade_enabled, detect_faces_tiered, mtcnn_boxes
+        from Backend.metrics import observe_stage
+    except ImportError:
+        from face_detector import detect_faces
+        from face_cascade import cascade_enabled, detect_faces_tiered, mtcnn_boxes
+        from metrics import observe_stage
 
-# Lazy init for MTCNN to reduce import-time overhead
-mtcnn_detector = None
+logger = logging.getLogger(__name__)
 
-def _get_mtcnn():
-    global mtcnn_detector
-    if mtcnn_detector is None:
-        mtcnn_detector = MTCNN()
-    return mtcnn_detector
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def detect_with_haar_cascade(img, target_size=(224, 224)):
+# จำนวนใบหน้าสูงสุดต่อภาพในโหมดหลายใบหน้า (multi_face)
+MAX_FACES = int(os.environ.get("EMOTION_MAX_FACES", "10"))
+
+def detect_with_haar_cascade(img, target_size=(224, 224), preset=None):
     """
     Fallback: ใช้ Haar Cascade สำหรับ detect หน้าคนจริง (รับ numpy image)
+    preset: "fast" / "balanced" / "accurate" (ดู face_detector.PRESETS), None = ค่าเริ่มต้น
     """
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(
-        gray,
-        scaleFactor=1.1,
-        minNeighbors=5,
-        minSize=(40, 40)
-    )
+    faces = detect_faces(img, preset=preset)
     if len(faces) == 0:
-        print("⚠️ ไม่พบหน้าในภาพ (Haar Cascade)")
+        logger.debug("no face found (haar)")
         return None, None
 
-    # เลือกหน้าที่ใหญ่ที่สุดเพื่อความแม่นยำของครอป
-    x, y, w, h = max(faces, key=lambda b: b[2] * b[3])
-    print("👤 พบหน้า (Haar Cascade) ขนาด:", w, h)
+    # เลือกหน้าที่ใหญ่ที่สุดเพื่อความแม่นยำของครอป (detect_faces เรียงจากใหญ่ไปเล็กแล้ว)
+    x, y, w, h = faces[0]
+    logger.debug("face found (haar) %dx%d", w, h)
+
+    face_rgb = crop_face_region(img, (x, y, w, h), target_size)
+    if face_rgb is None:
+        return None, None
+    return face_rgb, (int(x), int(y), int(w), int(h))
+
+def crop_faces(img, boxes, target_size=(224, 224), max_faces=MAX_FACES):
+    """ครอปกล่องตามลำดับที่ให้มา คืน list ของ (face_rgb, (x, y, w, h)) ไม่เกิน max_faces"""
+    results = []
+    for box in boxes:
+        if len(results) >= max_faces:
+            break
+        face_rgb = crop_face_region(img, box, target_size)
+        if face_rgb is not None:
+            results.append((face_rgb, tuple(int(v) for v in box)))
+    return results
+
+def detect_all_with_haar_cascade(img, target_size=(224, 224), preset=None, max_faces=MAX_FACES):
+    """
+    คืนทุกใบหน้าในภาพเป็น list ของ (face_rgb, (x, y, w, h)) เรียงจากใหญ่ไปเล็ก ไม่เกิน max_faces
+    """
+    results = crop_faces(img, detect_faces(img, preset=preset), target_size, max_faces)
+    if not results:
+        logger.debug("no face found (haar)")
+    return results
+
+def detect_all_with_mtcnn(img, target_size=(224, 224), max_faces=MAX_FACES):
+    """เหมือน detect_all_with_haar_cascade แต่ใช้ MTCNN (ภาพย่อ ผ่าน batcher) เรียงตามความมั่นใจ/ขนาด"""
+    return crop_faces(img, [box for box, _ in mtcnn_boxes(img, min_confidence=0.0)], target_size, max_faces)
 
+def detect_all_with_cascade(img, target_size=(224, 224), preset=None, max_faces=MAX_FACES):
+    """Haar ก่อน แล้วส่งต่อ MTCNN เมื่อไม่พบหรือคะแนนต่ำ (ดู face_cascade)"""
+    boxes, tier = detect_faces_tiered(img, preset=preset)
+    results = crop_faces(img, boxes, target_size, max_faces)
+    if not results:
+        logger.debug("no face found (cascade)")
+    else:
+        logger.debug("face found (%s)", tier)
+    return results
+
+def crop_face_region(img, box, target_size=(224, 224)):
+    """
+    ครอปกล่องใบหน้า (x, y, w, h) จากภาพ BGR พร้อม padding ตามสัดส่วนใบหน้า
+    แล้วปรับขนาดเป็น target_size คืนภาพ RGB หรือ None หากกล่องอยู่นอกภาพ
+    """
+    x, y, w, h = box
     H, W = img.shape[0], img.shape[1]
     # ใช้ padding ตามสัดส่วนใบหน้า (ช่วยให้พอดีมากขึ้นกว่าค่าคงที่)
     pad = int(round(0.2 * max(w, h)))
@@ -45,78 +97,46 @@ def detect_with_haar_cascade(img, target_size=(224, 224)):
     y2 = min(H, int(y + h + pad))
 
     if x2 <= x1 or y2 <= y1:
-        return None, None
+        return None
 
     face_crop = img[y1:y2, x1:x2]
     if face_crop.size == 0:
-        return None, None
+        return None
     face_resized = cv2.resize(face_crop, target_size)
-    face_rgb = cv2.cvtColor(face_resized, cv2.COLOR_BGR2RGB)
-
-    return face_rgb, (int(x), int(y), int(w), int(h))
-
-def detect_and_crop_face(img, target_size=(224, 224), use_anime_detection=False):
-
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return cv2.cvtColor(face_resized, cv2.COLOR_BGR2RGB)
 
+def detect_and_crop_face(img, target_size=(224, 224), use_anime_detection=False, preset=None,
+                         multi_face=False, max_faces=MAX_FACES):
+    """
+    คืน (face_rgb, (x, y, w, h)) ของใบหน้าหลักในภาพ หรือ (None, None)
+    multi_face=True: คืน list ของ (face_rgb, coords) ทุกใบหน้า (ไม่เกิน max_faces) แทน
+    use_anime_detection=True ใช้ MTCNN ก่อนเสมอ; ปกติใช้ Haar และส่งต่อ MTCNN เฉพาะภาพที่จำเป็น (face_cascade)
+    """
     if use_anime_detection:
         try:
-            detector = _get_mtcnn()
-            faces = detector.detect_faces(img_rgb)
-            if len(faces) == 0:
-                print("⚠️ ไม่พบหน้าในภาพ (MTCNN)")
-                return detect_with_haar_cascade(img, target_size)
-            # เลือกหน้าที่มั่นใจสูงสุด/ใหญ่สุด
-            face_data = max(
-                faces,
-                key=lambda f: (f.get('confidence', 0), (f['box'][2] * f['box'][3]))
-            )
-            x, y, w, h = face_data['box']
-            # clamp และปัดเป็น int
-            H, W = img_rgb.shape[0], img_rgb.shape[1]
-            x = max(0, int(round(x)))
-            y = max(0, int(round(y)))
-            w = max(1, int(round(w)))
-            h = max(1, int(round(h)))
-            confidence = face_data.get('confidence', None)
-            if confidence is not None:
-                try:
-                    print(f"🎭 พบหน้า (MTCNN) - ความมั่นใจ: {confidence:.2f}")
-                except Exception:
-                    print("🎭 พบหน้า (MTCNN)")
-
+            faces = detect_all_with_mtcnn(img, target_size, max_faces=max_faces if multi_face else 1)
+            if faces:
+                return faces if multi_face else faces[0]
+            logger.debug("no face found (mtcnn)")
         except Exception as e:
-            print(f"⚠️ MTCNN error: {e}")
-            print("🔄 เปลี่ยนไปใช้ Haar Cascade")
-            return detect_with_haar_cascade(img, target_size)
-    else:
-        return detect_with_haar_cascade(img, target_size)
-
-    # Crop หน้า (padding ตามสัดส่วนใบหน้า)
-    H, W = img_rgb.shape[0], img_rgb.shape[1]
-    pad = int(round(0.2 * max(w, h)))
-    x1 = max(0, x - pad)
-    y1 = max(0, y - pad)
-    x2 = min(W, x + w + pad)
-    y2 = min(H, y + h + pad)
-
-    if x2 <= x1 or y2 <= y1:
-        return None, None
-
-    face_crop = img_rgb[y1:y2, x1:x2]
-    if face_crop.size == 0:
-        return None, None
+            logger.warning("MTCNN error, falling back to Haar cascade: %s", e)
+    elif cascade_enabled():
+        faces = detect_all_with_cascade(img, target_size, preset=preset, max_faces=max_faces if multi_face else 1)
+        if multi_face:
+            return faces
+        return faces[0] if faces else (None, None)
 
-    face_resized = cv2.resize(face_crop, target_size)
-    return face_resized, (int(x), int(y), int(w), int(h))
+    if multi_face:
+        return detect_all_with_haar_cascade(img, target_size, preset=preset, max_faces=max_faces)
+    return detect_with_haar_cascade(img, target_size, preset=preset)
 
 # Reuse a single transform definition from model_image to avoid divergence
 try:
     from .model_image import transform as image_transform
-except Exception:
+except ImportError:
     try:
         from Backend.model_image import transform as image_transform
-    except Exception:
+    except ImportError:
         from model_image import transform as image_transform
 
 # Convenience wrappers for reuse elsewhere
@@ -147,27 +167,83 @@ def to_grayscale_224(face_image):
     ])(pil_img)
     return np.array(pil_gray)
 
+# บัฟเฟอร์อินพุตที่จองไว้ต่อ thread (ขยายเมื่อ batch ใหญ่ขึ้น) แทนการจองเทนเซอร์ใหม่ทุก request
+_input_buffers = threading.local()
+
+def faces_to_tensor(face_images, size=(224, 224)):
+    """
+    แปลงใบหน้า RGB uint8 (H, W, 3) เป็นเทนเซอร์ [B, 3, H, W] ค่า 0..1 โดยตรงจาก numpy (ไม่ผ่าน PIL)
+    ภาพที่ขนาดตรงอยู่แล้ว (เช่นผลจาก crop_face_region) ไม่ถูก resize ซ้ำ
+    ผลลัพธ์เป็น view ของบัฟเฟอร์ประจำ thread: ต้องใช้ให้เสร็จก่อนเรียกซ้ำใน thread เดียวกัน
+    """
+    n = len(face_images)
+    w, h = size
+    buf = getattr(_input_buffers, "buf", None)
+    if buf is None or buf.shape[0] < n or tuple(buf.shape[2:]) != (h, w):
+        capacity = max(n, buf.shape[0] if buf is not None else 0)
+        buf = _input_buffers.buf = torch.empty((capacity, 3, h, w), dtype=torch.float32)
+    hwc = buf.permute(0, 2, 3, 1)
+    for i, face in enumerate(face_images):
+        if face.shape[0] != h or face.shape[1] != w:
+            face = cv2.resize(face, size, interpolation=cv2.INTER_AREA)
+        hwc[i].copy_(torch.from_numpy(face))
+    # เท่ากับ transforms.ToTensor(): uint8 / 255
+    return buf[:n].div_(255.0)
+
 def preprocess_face_for_model(face_image, model):
     """
     สร้างเทนเซอร์อินพุตสำหรับโมเดล จากภาพใบหน้า (RGB numpy)
     คืนค่า torch.Tensor บนอุปกรณ์เดียวกับโมเดล
     """
-    face_pil = Image.fromarray(face_image)
-    img_t = image_transform(face_pil).unsqueeze(0)
-    model_device = next(model.parameters()).device
-    return img_t.to(model_device)
+    return faces_to_tensor([face_image]).to(_model_device(model), copy=True)
 
 def predict_face_image(face_image, model, class_names):
-    face_pil = Image.fromarray(face_image)
-    img_t = image_transform(face_pil).unsqueeze(0)
     # Send to the same device as the model to avoid CPU/CUDA mismatch
-    model_device = next(model.parameters()).device
-    img_t = img_t.to(model_device)
+    img_t = faces_to_tensor([face_image]).to(_model_device(model))
     with torch.no_grad():
         outputs = model(img_t)
         _, pred = torch.max(outputs, 1)
     return class_names[pred.item()]
 
+def _model_device(model):
+    """device ของโมเดล รองรับทั้ง nn.Module และ InferenceRuntime (model_runtime)"""
+    device = getattr(model, "device", None)
+    if isinstance(device, torch.device):
+        return device
+    try:
+        return next(model.parameters()).device
+    except (AttributeError, StopIteration):
+        return torch.device("cpu")
+
+def predict_face_images_proba(face_images, model):
+    """
+    ความน่าจะเป็น (softmax) ของใบหน้าหลายภาพ (RGB numpy) ใน forward pass เดียว
+    คืน numpy [B, n_classes] ตามลำดับคลาสของโมเดล
+    ``model`` เป็น nn.Module หรือ runtime จาก model_runtime.get_runtime("image") ก็ได้
+    """
+    if len(face_images) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    started = time.perf_counter()
+    batch = faces_to_tensor(face_images).to(_model_device(model))
+    preprocessed = time.perf_counter()
+    with torch.no_grad():
+        outputs = model(batch)
+        probs = torch.softmax(outputs.float(), dim=1)
+    result = probs.cpu().numpy()
+    observe_stage("preprocess", preprocessed - started)
+    observe_stage("forward", time.perf_counter() - preprocessed)
+    return result
+
+def predict_face_images_batch(face_images, model, class_names):
+    """
+    ทำนายอารมณ์จากใบหน้าหลายภาพ (RGB numpy) ใน forward pass เดียว
+    คืน list ของชื่ออารมณ์ตามลำดับเดิม
+    """
+    if len(face_images) == 0:
+        return []
+    probs = predict_face_images_proba(face_images, model)
+    return [class_names[i] for i in probs.argmax(axis=1).tolist()]
+
 # === Path-based helpers (for quick local testing/CLI) ===
 def detect_and_crop_face_from_path(image_path, target_size=(224, 224)):
     """
@@ -186,8 +262,7 @@ def predict_image_from_path(image_path, model, class_names):
     """
     image = Image.open(image_path).convert('RGB')
     img_t = image_transform(image).unsqueeze(0)
-    model_device = next(model.parameters()).device
-    img_t = img_t.to(model_device)
+    img_t = img_t.to(_model_device(model))
     with torch.no_grad():
         outputs = model(img_t)
         _, pred = torch.max(outputs, 1)
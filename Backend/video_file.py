@@ -0,0 +1,220 @@
+"""
+Emotion timeline for an uploaded video file (``/predict-video``).
+
+Frames are read with ``cv2.VideoCapture`` from the spooled upload and sampled
+at ``sample_fps``: frames in between are only ``grab()``-ed (demuxed, never
+converted to BGR). Each sampled frame gets a 64-bit difference hash (dHash) of
+a 9x8 grayscale thumbnail; a frame within ``EMOTION_VIDEO_HASH_DISTANCE`` bits
+of the last distinct frame is a near-duplicate and reuses that frame's result.
+The same check runs on the face crop itself, so a static talking head whose
+background flickers is still only classified once. Only the remaining faces go
+through ResNet18, in batches of ``EMOTION_VIDEO_BATCH``.
+"""
+import asyncio
+import os
+from collections import Counter
+
+import cv2
+import numpy as np
+
+try:
+    from .executors import get_pool
+    from .model_runtime import get_runtime
+    from .model_image import classes as image_classes
+    from .utlis import detect_and_crop_face, predict_face_images_proba
+    from .image_io import MAX_DECODE_SIDE, scale_coords
+except ImportError:
+    try:
+        from Backend.executors import get_pool
+        from Backend.model_runtime import get_runtime
+        from Backend.model_image import classes as image_classes
+        from Backend.utlis import detect_and_crop_face, predict_face_images_proba
+        from Backend.image_io import MAX_DECODE_SIDE, scale_coords
+    except ImportError:
+        from executors import get_pool
+        from model_runtime import get_runtime
+        from model_image import classes as image_classes
+        from utlis import detect_and_crop_face, predict_face_images_proba
+        from image_io import MAX_DECODE_SIDE, scale_coords
+
+VIDEO_SAMPLE_FPS = float(os.environ.get("EMOTION_VIDEO_SAMPLE_FPS", "2"))
+VIDEO_MAX_SAMPLES = int(os.environ.get("EMOTION_VIDEO_MAX_SAMPLES", "600"))
+VIDEO_MAX_SECONDS = float(os.environ.get("EMOTION_VIDEO_MAX_SECONDS", "600"))
+# ต่างกันไม่เกินกี่บิต (จาก 64) ถือว่าเป็นภาพเดิม
+VIDEO_HASH_DISTANCE = int(os.environ.get("EMOTION_VIDEO_HASH_DISTANCE", "4"))
+VIDEO_BATCH = int(os.environ.get("EMOTION_VIDEO_BATCH", "32"))
+VIDEO_DETECT_PRESET = os.environ.get("EMOTION_VIDEO_DETECT_PRESET", "fast")
+
+
+class VideoDecodeError(ValueError):
+    """ไฟล์วิดีโอเปิดไม่ได้หรือไม่มีเฟรม"""
+
+
+def dhash(img):
+    """difference hash 64 บิตของภาพ (BGR/RGB หรือ gray): เปรียบเทียบความสว่างของพิกเซลที่อยู่ติดกัน"""
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), "big")
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class VideoSampler:
+    """อ่านเฟรมตามอัตรา ``sample_fps`` และจับเฟรมที่แทบไม่เปลี่ยน (ใช้ผลของเฟรมก่อนหน้า)"""
+
+    def __init__(self, path, sample_fps=VIDEO_SAMPLE_FPS, max_samples=VIDEO_MAX_SAMPLES,
+                 max_seconds=VIDEO_MAX_SECONDS, hash_distance=VIDEO_HASH_DISTANCE, max_side=MAX_DECODE_SIDE):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise VideoDecodeError("Cannot open video")
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and 0 < fps < 1000 else 25.0
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        self.step = max(1, int(round(self.fps / sample_fps))) if sample_fps > 0 else 1
+        self.max_samples = max_samples
+        self.max_seconds = max_seconds
+        self.hash_distance = hash_distance
+        self.max_side = max_side
+        self.position = 0
+        self.sampled = 0
+        self.distinct = 0
+        self.truncated = False
+        self.finished = False
+        self._last_hash = None
+        self._last_distinct = None
+
+    def read(self, max_distinct):
+        """
+        อ่านต่อจนได้เฟรมที่ต่างจากเดิม ``max_distinct`` เฟรม (หรือจบไฟล์)
+        คืน list ของ dict: frame, t และ image+scale (เฟรมใหม่) หรือ same_as (เฟรมซ้ำ)
+        """
+        out = []
+        distinct = 0
+        while distinct < max_distinct and not self.finished:
+            index = self.position
+            if not self.cap.grab():
+                self.finished = True
+                break
+            self.position += 1
+            if index % self.step:
+                continue
+            t = index / self.fps
+            if self.sampled >= self.max_samples or t > self.max_seconds:
+                self.truncated = True
+                self.finished = True
+                break
+            ok, frame = self.cap.retrieve()
+            if not ok or frame is None:
+                continue
+            self.sampled += 1
+            h = dhash(frame)
+            if self._last_hash is not None and hamming(h, self._last_hash) <= self.hash_distance:
+                out.append({"frame": index, "t": t, "same_as": self._last_distinct})
+                continue
+            self._last_hash = h
+            self._last_distinct = index
+            scale = 1.0
+            long_side = max(frame.shape[:2])
+            if 0 < self.max_side < long_side:
+                scale = long_side / self.max_side
+                frame = cv2.resize(
+                    frame, (round(frame.shape[1] / scale), round(frame.shape[0] / scale)),
+                    interpolation=cv2.INTER_AREA,
+                )
+            out.append({"frame": index, "t": t, "image": frame, "scale": scale})
+            distinct += 1
+            self.distinct += 1
+        return out
+
+    def close(self):
+        self.cap.release()
+
+
+def _summary(timeline):
+    votes = Counter(e["emotion"] for e in timeline if e.get("emotion"))
+    total = sum(votes.values())
+    return {
+        "dominant_emotion": votes.most_common(1)[0][0] if votes else None,
+        "emotion_share": {k: round(v / total, 4) for k, v in votes.most_common()} if total else {},
+    }
+
+
+async def video_timeline(path, sample_fps=VIDEO_SAMPLE_FPS, max_samples=VIDEO_MAX_SAMPLES,
+                         preset=VIDEO_DETECT_PRESET, batch_size=VIDEO_BATCH):
+    """
+    สร้าง timeline อารมณ์ของวิดีโอ: หนึ่งรายการต่อเฟรมที่สุ่มมา
+    (emotion, confidence, face_coords, reused=True ถ้าใช้ผลของเฟรม/ใบหน้าก่อนหน้า)
+    """
+    pool = get_pool("image")
+    sampler = await pool.run("decode", VideoSampler, path, sample_fps, max_samples)
+    limiter = asyncio.Semaphore(pool.max_workers)
+    results = {}  # frame index ของเฟรมที่ไม่ซ้ำ -> ผลลัพธ์
+    timeline = []
+    inferred = 0
+    last_face = None  # (hash, result) ของใบหน้าล่าสุดที่ส่งเข้าโมเดล
+
+    async def detect(entry):
+        async with limiter:
+            return await pool.run(
+                "detect", detect_and_crop_face, entry["image"], use_anime_detection=False, preset=preset
+            )
+
+    try:
+        while not sampler.finished:
+            chunk = await pool.run("decode", sampler.read, max(1, batch_size))
+            fresh = [e for e in chunk if "image" in e]
+            detections = await asyncio.gather(*(detect(e) for e in fresh))
+
+            faces, slots = [], []
+            for entry, (face, coords) in zip(fresh, detections):
+                entry.pop("image")
+                if face is None:
+                    results[entry["frame"]] = {"face_coords": None}
+                    continue
+                x, y, w, h = scale_coords(coords, entry["scale"])
+                result = {"face_coords": {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}}
+                results[entry["frame"]] = result
+                face_hash = dhash(face)
+                if last_face is not None and hamming(face_hash, last_face[0]) <= sampler.hash_distance:
+                    result["same_face_as"] = last_face[1]
+                    continue
+                last_face = (face_hash, result)
+                faces.append(face)
+                slots.append(result)
+
+            if faces:
+                probs = await pool.run("infer", predict_face_images_proba, faces, get_runtime("image"))
+                inferred += len(faces)
+                for result, p in zip(slots, probs):
+                    best = int(np.argmax(p))
+                    result["emotion"] = image_classes[best]
+                    result["confidence"] = float(p[best])
+
+            for entry in chunk:
+                reused = "same_as" in entry
+                result = results[entry["same_as"] if reused else entry["frame"]]
+                source = result.get("same_face_as")
+                item = {"t": round(entry["t"], 3), "frame": entry["frame"], "face_coords": result["face_coords"]}
+                if result["face_coords"] is not None:
+                    item["emotion"] = (source or result)["emotion"]
+                    item["confidence"] = (source or result)["confidence"]
+                item["reused"] = reused or source is not None
+                timeline.append(item)
+    finally:
+        sampler.close()
+
+    if sampler.sampled == 0:
+        raise VideoDecodeError("No frames could be decoded")
+    return {
+        "fps": sampler.fps,
+        "duration": round(sampler.frame_count / sampler.fps, 3) if sampler.frame_count else None,
+        "sample_fps": sampler.fps / sampler.step,
+        "sampled_frames": sampler.sampled,
+        "distinct_frames": sampler.distinct,
+        "faces_inferred": inferred,
+        "truncated": sampler.truncated,
+        **_summary(timeline),
+        "timeline": timeline,
+    }
@@ -0,0 +1,148 @@
+"""
+Per-connection state for real-time webcam emotion tracking over WebSocket.
+
+Full Haar detection only runs every ``detect_every`` frames, when the tracked
+face is lost, or when it has drifted too far from where it was last detected.
+In between, the face is followed with a cheap normalised cross-correlation
+template match in a small search window around the previous box. Per-frame
+emotions are smoothed by a majority vote over a sliding window.
+"""
+import os
+from collections import Counter, deque
+
+import cv2
+import numpy as np
+
+try:
+    from .face_detector import detect_faces, to_gray
+    from .utlis import crop_face_region
+except ImportError:
+    try:
+        from Backend.face_detector import detect_faces, to_gray
+        from Backend.utlis import crop_face_region
+    except ImportError:
+        from face_detector import detect_faces, to_gray
+        from utlis import crop_face_region
+
+STREAM_DETECT_EVERY = int(os.environ.get("EMOTION_STREAM_DETECT_EVERY", "10"))
+STREAM_SMOOTH_WINDOW = int(os.environ.get("EMOTION_STREAM_SMOOTH_WINDOW", "8"))
+STREAM_DETECT_PRESET = os.environ.get("EMOTION_STREAM_DETECT_PRESET", "fast")
+# คะแนน TM_CCOEFF_NORMED ต่ำกว่านี้ถือว่าหลุดการติดตาม
+TRACK_MIN_SCORE = 0.55
+# เลื่อนเกินสัดส่วนนี้ของความกว้างใบหน้า (นับจาก detect ล่าสุด) ให้ detect ใหม่
+TRACK_MAX_DRIFT = 0.5
+# ค้นหา template ในหน้าต่างที่ขยายจากกล่องเดิมด้านละเท่านี้ของขนาดใบหน้า
+TRACK_SEARCH_MARGIN = 0.5
+# ย่อ template/ภาพให้ด้านกว้างใบหน้าประมาณเท่านี้ก่อน matchTemplate
+_TRACK_FACE_SIDE = 48
+
+
+class FaceStreamSession:
+    def __init__(self, detect_every=STREAM_DETECT_EVERY, window=STREAM_SMOOTH_WINDOW,
+                 preset=STREAM_DETECT_PRESET):
+        self.detect_every = max(1, int(detect_every))
+        self.preset = preset
+        self.frames = 0
+        self.detections = 0
+        self.tracked = 0
+        self._box = None
+        self._anchor = None  # กล่องจาก detect ล่าสุด ใช้วัด drift
+        self._template = None
+        self._template_scale = 1.0
+        self._since_detect = 0
+        self._history = deque(maxlen=max(1, int(window)))
+
+    # ---------- localisation (sync, รันบน image pool) ----------
+    def locate(self, img):
+        """
+        หาใบหน้าในเฟรม BGR คืน (face_rgb_224, box, was_tracked) หรือ (None, None, False)
+        """
+        self.frames += 1
+        gray = to_gray(img)
+        box = None
+        was_tracked = False
+        if self._box is not None and self._since_detect < self.detect_every:
+            box = self._track(gray)
+            if box is not None:
+                was_tracked = True
+                if self._drifted(box):
+                    box = None
+        if box is None:
+            box = self._detect(img, gray)
+        if box is None:
+            return None, None, False
+
+        face = crop_face_region(img, box)
+        if face is None:
+            self._reset()
+            return None, None, False
+        if was_tracked:
+            self.tracked += 1
+            self._since_detect += 1
+        return face, box, was_tracked
+
+    def _detect(self, img, gray):
+        self.detections += 1
+        faces = detect_faces(img, preset=self.preset, gray=gray)
+        if not faces:
+            self._reset()
+            return None
+        box = faces[0]
+        self._box = self._anchor = box
+        self._since_detect = 0
+        self._set_template(gray, box)
+        return box
+
+    def _set_template(self, gray, box):
+        x, y, w, h = box
+        self._template_scale = min(1.0, _TRACK_FACE_SIDE / float(max(1, w)))
+        patch = gray[y:y + h, x:x + w]
+        self._template = _scaled(patch, self._template_scale)
+
+    def _track(self, gray):
+        x, y, w, h = self._box
+        H, W = gray.shape[:2]
+        mx, my = int(w * TRACK_SEARCH_MARGIN), int(h * TRACK_SEARCH_MARGIN)
+        x1, y1 = max(0, x - mx), max(0, y - my)
+        x2, y2 = min(W, x + w + mx), min(H, y + h + my)
+        region = _scaled(gray[y1:y2, x1:x2], self._template_scale)
+        tpl = self._template
+        if tpl is None or region.shape[0] < tpl.shape[0] or region.shape[1] < tpl.shape[1]:
+            return None
+        result = cv2.matchTemplate(region, tpl, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (bx, by) = cv2.minMaxLoc(result)
+        if score < TRACK_MIN_SCORE:
+            return None
+        inv = 1.0 / self._template_scale
+        box = (int(x1 + bx * inv), int(y1 + by * inv), w, h)
+        self._box = box
+        return box
+
+    def _drifted(self, box):
+        ax, ay, aw, _ = self._anchor
+        dist = float(np.hypot(box[0] - ax, box[1] - ay))
+        return dist > TRACK_MAX_DRIFT * aw
+
+    def _reset(self):
+        self._box = self._anchor = self._template = None
+        self._since_detect = 0
+
+    # ---------- smoothing ----------
+    def observe(self, emotion):
+        """เพิ่มผลของเฟรมล่าสุดแล้วคืน (smoothed_emotion, confidence) จาก majority vote"""
+        self._history.append(emotion)
+        label, count = Counter(self._history).most_common(1)[0]
+        return label, count / len(self._history)
+
+    def clear_history(self):
+        self._history.clear()
+
+    def stats(self):
+        return {"frames": self.frames, "detections": self.detections, "tracked": self.tracked}
+
+
+def _scaled(img, scale):
+    if scale >= 1.0 or img.size == 0:
+        return img
+    h, w = img.shape[:2]
+    return cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)